@@ -0,0 +1,71 @@
+"""
+One-time conversion of the gzipped text embeddings of Cr5 (e.g. model_28_txt/joint_28_en.txt.gz) to
+the binary format read by Cr5_Model.read_embs_mmap:
+ - <model_name>_<lang_code>.npy: float32 matrix, one row per word
+ - <model_name>_<lang_code>.vocab.txt: the words, one per line, in the order of the rows
+
+    python convert_embeddings.py ./model_28_txt/ joint_28 en
+"""
+
+import io
+import gzip
+import argparse
+import numpy as np
+
+from cr5 import Cr5_Model
+
+DIMENSIONS = 300
+
+
+def convert_embs(model, lang_code):
+    text_path = model.get_lang_data_path(lang_code)
+
+    # first pass to size the matrix, so that it is written to disk without being held in memory
+    with gzip.open(text_path, 'rt', encoding='utf-8') as file:
+        rows = sum(1 for line in file if line.strip())
+
+    matrix = np.lib.format.open_memmap(model.get_lang_matrix_path(lang_code), mode='w+',
+                                       dtype=np.float32, shape=(rows, DIMENSIONS))
+    word_2_index = {}
+    words = []
+    with gzip.open(text_path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            parts = line.rstrip('\n').split(" ")
+            word = ' '.join(parts[:-DIMENSIONS])
+            if word in word_2_index:
+                # as with read_embs, the last embedding of a word wins
+                matrix[word_2_index[word]] = np.array(parts[-DIMENSIONS:], dtype=np.float32)
+                continue
+            word_2_index[word] = len(words)
+            matrix[len(words)] = np.array(parts[-DIMENSIONS:], dtype=np.float32)
+            words.append(word)
+
+    matrix.flush()
+    del matrix
+    if len(words) < rows:
+        # duplicated words left some rows unused at the end
+        np.save(model.get_lang_matrix_path(lang_code), np.load(model.get_lang_matrix_path(lang_code))[:len(words)])
+
+    with io.open(model.get_lang_vocab_path(lang_code), 'w', encoding='utf-8') as file:
+        for word in words:
+            file.write(word + '\n')
+
+    return len(words)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_folder_path', type=str)
+    parser.add_argument('model_name', type=str)
+    parser.add_argument('lang_codes', type=str, nargs='+')
+    args = parser.parse_args()
+    args = args.__dict__
+
+    model = Cr5_Model(args["data_folder_path"], args["model_name"])
+    for lang_code in args["lang_codes"]:
+        print("converting embeddings of `{}`...".format(lang_code))
+        words = convert_embs(model, lang_code)
+        print("{} words written to {} and {}".format(words, model.get_lang_matrix_path(lang_code),
+                                                     model.get_lang_vocab_path(lang_code)))
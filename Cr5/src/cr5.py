@@ -1,10 +1,48 @@
 import os
 import io
 import numpy as np
+import scipy.sparse as sparse
 import gzip
 
 from collections import Counter
 
+
+def tokenize(text):
+    import nltk
+    try:
+        return nltk.tokenize.word_tokenize(text)
+    except LookupError as e:
+        nltk.download('punkt')
+        return nltk.tokenize.word_tokenize(text)
+
+
+class LangEmbeddings:
+    """
+    Embeddings of a language as a single contiguous matrix (memory mapped from a .npy file written by
+    convert_embeddings.py, or built from the text embeddings) and the index of the row of each word.
+    Also behaves as the dictionary mapping words to embeddings built by Cr5_Model.read_embs.
+    """
+    def __init__(self, matrix, word_2_index):
+        self.matrix = matrix
+        self.word_2_index = word_2_index
+
+    @classmethod
+    def from_dict(cls, word_2_emb):
+        word_2_index = {word: i for i, word in enumerate(word_2_emb)}
+        matrix = np.array(list(word_2_emb.values()))
+        return cls(matrix, word_2_index)
+
+    def __contains__(self, word):
+        return word in self.word_2_index
+
+    def __getitem__(self, word):
+        # a float64 copy, as the embeddings read by Cr5_Model.read_embs
+        return np.array(self.matrix[self.word_2_index[word]], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.word_2_index)
+
+
 class Cr5_Model:
     def __init__(self, data_folder_path=None, model_name=None):
         if data_folder_path is None:
@@ -34,49 +72,101 @@ class Cr5_Model:
 
         return word_2_emb
 
+    def read_embs_mmap(self, lang_code):
+        # the matrix is not read, its pages are loaded (and shared between processes) by the os when used
+        matrix = np.load(self.get_lang_matrix_path(lang_code), mmap_mode='r')
+
+        with io.open(self.get_lang_vocab_path(lang_code), 'r', encoding='utf-8') as file:
+            word_2_index = {line.rstrip('\n'): i for i, line in enumerate(file)}
+
+        if len(word_2_index) != matrix.shape[0]:
+            raise Exception("The vocabulary at `{}` does not match the matrix at `{}`.".format(self.get_lang_vocab_path(lang_code), self.get_lang_matrix_path(lang_code)))
+
+        return LangEmbeddings(matrix, word_2_index)
+
     def get_lang_data_path(self, lang_code):
         lang_data_path = os.path.join(self.data_folder_path, '{}_{}.txt.gz'.format(self.model_name, lang_code))
 
         return lang_data_path
 
+    def get_lang_matrix_path(self, lang_code):
+        return os.path.join(self.data_folder_path, '{}_{}.npy'.format(self.model_name, lang_code))
+
+    def get_lang_vocab_path(self, lang_code):
+        return os.path.join(self.data_folder_path, '{}_{}.vocab.txt'.format(self.model_name, lang_code))
+
+    def has_binary_embs(self, lang_code):
+        return os.path.isfile(self.get_lang_matrix_path(lang_code)) and os.path.isfile(self.get_lang_vocab_path(lang_code))
 
     def load_langs(self, lang_codes):
         for lang_code in lang_codes:
-            if not os.path.isfile(self.get_lang_data_path(lang_code)):
+            if not self.has_binary_embs(lang_code) and not os.path.isfile(self.get_lang_data_path(lang_code)):
                 raise Exception("The model for language code `{}` is not available in the folder at `{}`.".format(lang_code, self.get_lang_data_path(lang_code)))
         self.lang_codes = lang_codes
 
         for lang_code in lang_codes:
-            self.embs_per_lang[lang_code] = self.read_embs(lang_code)
+            # the binary format written by convert_embeddings.py is preferred, it loads instantly
+            if self.has_binary_embs(lang_code):
+                self.embs_per_lang[lang_code] = self.read_embs_mmap(lang_code)
+            else:
+                self.embs_per_lang[lang_code] = LangEmbeddings.from_dict(self.read_embs(lang_code))
 
-    def get_document_embedding(self, tokens, lang_code):
+    def check_lang_loaded(self, lang_code):
         if lang_code not in self.lang_codes:
             raise Exception("Model for language code `{}` has not been loaded.".format(lang_code))
 
-        tf_tokens = dict(Counter(tokens))
+    def get_document_embedding(self, tokens, lang_code):
+        self.check_lang_loaded(lang_code)
+        embs = self.embs_per_lang[lang_code]
 
-        words_in_vocab = [word for word in tf_tokens.keys() if word in self.embs_per_lang[lang_code]]
+        tf_tokens = Counter(tokens)
 
-        if len(words_in_vocab) == 0:
-            raise Exception("No matching tokens with the vocabulary were found.")
+        rows = [embs.word_2_index[word] for word in tf_tokens if word in embs.word_2_index]
 
-        tfs = np.array([tf_tokens[word] for word in words_in_vocab])
-        embs = np.array([self.embs_per_lang[lang_code][word] for word in words_in_vocab])
-
-        normalized_tfs = tfs / np.linalg.norm(tfs)
+        if len(rows) == 0:
+            raise Exception("No matching tokens with the vocabulary were found.")
 
-        for i in range(len(tfs)):
-            embs[i] = embs[i] * tfs[i]
+        tfs = np.array([tf_tokens[word] for word in tf_tokens if word in embs.word_2_index], dtype=np.float64)
 
-        doc_emb = embs.sum(axis=0)
+        # sum of the embeddings weighted by their term frequency, divided by the norm of the term frequencies
+        doc_emb = tfs.dot(embs.matrix[rows])
         doc_emb = doc_emb / np.linalg.norm(tfs)
 
         return doc_emb
-    
+
+    def get_document_embeddings(self, list_of_tokens, lang_code):
+        """
+        Embeddings of many documents, computed as in get_document_embedding with a single product of
+        the sparse (documents x words) term frequency matrix by the embeddings of the words in it.
+
+        Returns: A (documents x dimensions) float64 matrix, and a boolean array telling for each document
+            whether any of its tokens is in the vocabulary (if not its row is all zeros).
+        """
+        self.check_lang_loaded(lang_code)
+        embs = self.embs_per_lang[lang_code]
+
+        doc_indices, rows = [], []
+        for doc_index, tokens in enumerate(list_of_tokens):
+            for token in tokens:
+                row = embs.word_2_index.get(token, None)
+                if row is not None:
+                    doc_indices.append(doc_index)
+                    rows.append(row)
+
+        # only the rows of the words appearing in the documents are read
+        used_rows, columns = np.unique(np.array(rows, dtype=np.int64), return_inverse=True)
+        # repeated (document, word) entries are summed, giving the term frequencies
+        tfs = sparse.csr_matrix((np.ones(len(rows)), (np.array(doc_indices, dtype=np.int64), columns)),
+                                shape=(len(list_of_tokens), len(used_rows)))
+
+        norms = np.sqrt(np.asarray(tfs.multiply(tfs).sum(axis=1)).ravel())
+        found = norms > 0
+
+        doc_embs = tfs.dot(np.asarray(embs.matrix[used_rows], dtype=np.float64))
+        doc_embs[found] /= norms[found, None]
+
+        return doc_embs, found
+
     def tokenize(self, text):
-        import nltk
-        try:
-            return nltk.tokenize.word_tokenize(text)
-        except LookupError as e:
-            nltk.download('punkt')
-            return nltk.tokenize.word_tokenize(text) 
\ No newline at end of file
+        # a function of the module, so that it can be used by processes without the model
+        return tokenize(text) 
\ No newline at end of file
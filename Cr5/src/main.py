@@ -1,13 +1,66 @@
-import ast
 import os
+import time
+import argparse
+import multiprocessing as mp
 import redis
 
-from cr5 import Cr5_Model
+from cr5 import Cr5_Model, tokenize
+from message_codec import codec
+from queue_transport import transport, lag_report
+
+# seconds between two reports of the throughput and of the lag of the input queue
+LAG_REPORT_EVERY = 30
 
 # error message written here to not repeat myself
 dict_field_error_message = "Received input is either not a dict or it is missing required fields, which are:" \
                            "_id, text"
 
+
+def decode_input(raw_input):
+    """
+    Decode and check a task of the input queue.
+    Args:
+        raw_input: Raw task, as popped from redis.
+
+    Returns: The decoded task, or None if it is not valid.
+
+    """
+    try:
+        received_input = codec.decode(raw_input)
+        assert isinstance(received_input, dict), dict_field_error_message
+        assert "id" in received_input, dict_field_error_message
+        assert "text" in received_input, dict_field_error_message
+        assert isinstance(received_input["text"], str), dict_field_error_message
+        return received_input
+    except AssertionError as e:
+        print(str(e))
+    except ValueError:
+        print("Data from job embedding input not a valid message, discarding input:\n%s" % raw_input)
+    return None
+
+
+def compute_embeddings(model, pool, received_inputs):
+    """
+    Compute the embeddings of a batch of tasks, texts are tokenized in the pool (if any) and
+    embedded with a single sparse matrix product.
+    Args:
+        model: Cr5_Model, with "en" loaded.
+        pool: multiprocessing Pool used for tokenizing, or None to tokenize in this process.
+        received_inputs: List of decoded tasks.
+
+    Returns: List with the embedding of each task, None for texts without any token in the vocabulary.
+
+    """
+    texts = [received_input["text"] for received_input in received_inputs]
+    if pool is not None and len(texts) > 1:
+        list_of_tokens = pool.map(tokenize, texts)
+    else:
+        list_of_tokens = [tokenize(text) for text in texts]
+
+    embeddings, found = model.get_document_embeddings(list_of_tokens, 'en')
+    return [embedding if is_found else None for embedding, is_found in zip(embeddings, found)]
+
+
 if __name__ == "__main__":
     for name in ["JOB_EMBEDDING_INPUT_QUEUE", "JOB_EMBEDDING_OUTPUT_QUEUE", "REDIS_HOST", "REDIS_PORT"]:
         assert name in os.environ, "%s environment variable is missing" % name
@@ -15,6 +68,20 @@ if __name__ == "__main__":
     input_queue = os.environ["JOB_EMBEDDING_INPUT_QUEUE"]
     output_queue = os.environ["JOB_EMBEDDING_OUTPUT_QUEUE"]
 
+    parser = argparse.ArgumentParser()
+    # max number of texts popped and embedded together
+    parser.add_argument('--batch_size', type=int, default=64)
+    # processes tokenizing the texts, 0 to tokenize in the main process
+    parser.add_argument('--tokenize_processes', type=int, default=mp.cpu_count())
+    args = parser.parse_args()
+    args = args.__dict__
+    print("Passed args:")
+    print(args)
+    assert args["batch_size"] > 0, "The batch size should be a positive integer."
+
+    # started before loading the model, so that processes do not inherit it
+    pool = mp.Pool(args["tokenize_processes"]) if args["tokenize_processes"] > 0 else None
+
     print("loading model...")
     model = Cr5_Model('./model_28_txt/', 'joint_28')
     model.load_langs(['en'])
@@ -24,38 +91,35 @@ if __name__ == "__main__":
     redis_connection = redis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], charset="utf-8")
     print("connected to redis")
 
+    last_lag_report, processed = time.time(), 0
     print("starting work")
     while True:
-        print("waiting for task")
-        task = redis_connection.blpop(input_queue, 0)
-        print("obtained task")
-
-        try:
-            received_input = task[1].decode("utf-8")
-            received_input = ast.literal_eval(received_input)
-            assert isinstance(received_input, dict), dict_field_error_message
-            assert "id" in received_input, dict_field_error_message
-            assert "text" in received_input, dict_field_error_message
-
-            tokens = model.tokenize(received_input["text"])
-            embedding = model.get_document_embedding(tokens, 'en')
-
-            print("embedding computed, pushing to queue")
-            del received_input["text"]
-            # make it into a list so that no newlines are added when converting to string
-            received_input["embedding"] = list(embedding)
-            redis_connection.lpush(output_queue, str(received_input))
-
-        except AssertionError as e:
-            print(str(e))
-        except (SyntaxError, ValueError):
-            print("Data from job embedding input not a valid python dict, discarding input:\n%s" % received_input)
-        except Exception as e:
-            print("Unexpected exception occurred:")
-            print(str(e))
-            print("Pushing None to queue")
-
-            del received_input["text"]
-            received_input["embedding"] = str(None)
-            print(received_input)
-            redis_connection.lpush(output_queue, str(received_input))
+        tasks = transport.pop(redis_connection, [input_queue], args["batch_size"])
+
+        received_inputs = [decode_input(task[2]) for task in tasks]
+        received_inputs = [received_input for received_input in received_inputs if received_input is not None]
+
+        if received_inputs:
+            try:
+                embeddings = compute_embeddings(model, pool, received_inputs)
+            except Exception as e:
+                print("Unexpected exception occurred:")
+                print(str(e))
+                print("Pushing None to queue")
+                embeddings = [None] * len(received_inputs)
+
+            # all the results are sent with a single round trip
+            redis_pipe = redis_connection.pipeline(transaction=False)
+            for received_input, embedding in zip(received_inputs, embeddings):
+                del received_input["text"]
+                received_input["embedding"] = codec.encode_floats(embedding) if embedding is not None else None
+                transport.push(redis_pipe, output_queue, codec.encode(received_input))
+            redis_pipe.execute()
+
+        transport.ack(redis_connection, tasks)
+        processed += len(tasks)
+
+        if time.time() - last_lag_report > LAG_REPORT_EVERY:
+            print("embedded %.1f docs/s" % (processed / (time.time() - last_lag_report)))
+            print("queues: %s" % lag_report(redis_connection, [input_queue]))
+            last_lag_report, processed = time.time(), 0
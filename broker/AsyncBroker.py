@@ -0,0 +1,175 @@
+"""
+For running the broker on an asyncio event loop.
+Batches of tasks are popped from redis with redis.asyncio and split into lanes by the same hash used
+by the worker pool, each lane processes its tasks in order in a thread of an executor, so that many batches
+(and their mongodb queries, language predictions, matchings between jobs and companies) are in flight at
+the same time while the tasks of a company (its crawler output, and the embeddings and sentiments computed
+for its jobs and reviews) are still applied in the order they are received, see WorkerPool.shard_key.
+The handlers are the same used by the synchronous broker, mongoengine/pymongo being thread safe.
+With the stream transport tasks are read in an executor thread, and acknowledged by the lanes once handled.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import redis.asyncio as aioredis
+
+from BrokerSetup import input_queue_names, get_queues, load_language_model, connect_redis, connect_mongodb, \
+    seed_company_metrics
+from ProcessBatch import decode_tasks, process_decoded_batch
+from QueueTransport import transport, pop_batch_script, lag_report
+from WorkerPool import split_in_shards
+
+
+class AsyncRedisBatchPopper(object):
+    """
+    Asyncio version of the pop of QueueTransport.ListTransport.
+    """
+
+    def __init__(self, redis_c, queues, batch_size):
+        """
+        Args:
+            redis_c: redis.asyncio connection.
+            queues: List of names of the redis queues to pop from, earlier queues have priority.
+            batch_size: Maximum number of tasks to return for each call to pop.
+        """
+        assert batch_size > 0, "The batch size should be a positive integer."
+        self.redis_c = redis_c
+        self.queues = queues
+        self.batch_size = batch_size
+        self.pop_script = redis_c.register_script(pop_batch_script)
+
+    async def pop_nowait(self, count):
+        """
+        Pop up to count tasks without blocking.
+        Args:
+            count: Maximum number of tasks to pop.
+
+        Returns: List of (queue, None, raw task) tuples, possibly empty.
+
+        """
+        if count <= 0:
+            return []
+        result = await self.pop_script(keys=self.queues, args=[count])
+        return [(result[i].decode("utf-8"), None, result[i + 1]) for i in range(0, len(result), 2)]
+
+    async def pop(self):
+        """
+        Pop a batch of tasks, waiting until at least one task is available.
+
+        Returns: List of (queue, None, raw task) tuples, with at least one element.
+
+        """
+        tasks = await self.pop_nowait(self.batch_size)
+        if tasks:
+            return tasks
+
+        task = await self.redis_c.blpop(self.queues, 0)
+        tasks = [(task[0].decode("utf-8"), None, task[1])]
+        return tasks + await self.pop_nowait(self.batch_size - 1)
+
+
+class AsyncBroker(object):
+    """
+    Broker processing batches of tasks concurrently on a number of lanes.
+    """
+
+    def __init__(self, concurrency, batch_size, stats_every=30):
+        """
+        Args:
+            concurrency: Number of lanes, i.e. max number of batches being processed at the same time.
+            batch_size: Maximum number of tasks popped from redis at once.
+            stats_every: Seconds between two prints of the throughput.
+        """
+        assert concurrency > 0, "The concurrency should be a positive integer."
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.stats_every = stats_every
+        self.processed = 0
+
+        self.language_model = load_language_model()
+        # used by the handlers, from the executor threads
+        self.redis_c = connect_redis()
+        connect_mongodb()
+        seed_company_metrics()
+        self.queues = get_queues()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def process_lane_batch(self, decoded_tasks):
+        """
+        Process (and acknowledge) the tasks of a lane, runs in an executor thread.
+        Args:
+            decoded_tasks: List of (queue, message id, decoded task) tuples.
+        """
+        process_decoded_batch(self.redis_c, self.queues, self.language_model, decoded_tasks)
+        transport.ack(self.redis_c, decoded_tasks)
+
+    async def lane(self, lane_queue):
+        """
+        Process, in order, the batches routed to a lane.
+        Args:
+            lane_queue: asyncio queue of lists of (queue, message id, decoded task) tuples.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            decoded_tasks = await lane_queue.get()
+            try:
+                await loop.run_in_executor(self.executor, self.process_lane_batch, decoded_tasks)
+            except Exception as e:
+                print("Unexpected exception occurred while processing a batch:")
+                print(str(e))
+            self.processed += len(decoded_tasks)
+
+    async def stats(self):
+        """
+        Periodically print the number of tasks processed per second and the lag of the input queues.
+        """
+        loop = asyncio.get_event_loop()
+        redis_queues = [self.queues[name] for name in input_queue_names]
+        last_processed, last_time = self.processed, time.time()
+        while True:
+            await asyncio.sleep(self.stats_every)
+            now = time.time()
+            print("processed %.1f items/s" % ((self.processed - last_processed) / (now - last_time)))
+            last_processed, last_time = self.processed, now
+            print("queues: %s" % await loop.run_in_executor(None, lag_report, self.redis_c, redis_queues))
+
+    async def run(self):
+        """
+        Pop batches from redis and route them to the lanes, it never returns.
+        """
+        loop = asyncio.get_event_loop()
+        redis_queues = [self.queues[name] for name in input_queue_names]
+        if transport.name == "list":
+            redis_async = aioredis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"])
+            pop = AsyncRedisBatchPopper(redis_async, redis_queues, self.batch_size).pop
+        else:
+            # streams are read with the synchronous client, without blocking the loop
+            def pop():
+                return loop.run_in_executor(None, transport.pop, self.redis_c, redis_queues, self.batch_size)
+
+        # bounded, so that tasks stay in redis while all the lanes are busy
+        lane_queues = [asyncio.Queue(2) for _ in range(self.concurrency)]
+        for lane_queue in lane_queues:
+            asyncio.ensure_future(self.lane(lane_queue))
+        asyncio.ensure_future(self.stats())
+
+        print("starting to work asynchronously on %d lanes" % self.concurrency)
+        while True:
+            tasks = await pop()
+            shards = split_in_shards(self.queues, decode_tasks(tasks), len(lane_queues))
+            for lane_queue, shard in zip(lane_queues, shards):
+                if shard:
+                    await lane_queue.put(shard)
+
+
+def run_async(concurrency, batch_size):
+    """
+    Run the asyncio broker, it never returns.
+    Args:
+        concurrency: Number of batches being processed at the same time.
+        batch_size: Maximum number of tasks popped from redis at once.
+    """
+    broker = AsyncBroker(concurrency, batch_size)
+    asyncio.get_event_loop().run_until_complete(broker.run())
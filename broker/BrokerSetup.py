@@ -0,0 +1,77 @@
+"""
+For setting up what the broker needs to work: the language model, the redis and mongodb connections
+and the rollups of the company metrics.
+Every broker process (e.g. each worker of a pool) should set up its own.
+"""
+
+import os
+from pyfasttext import FastText
+import redis
+from mongoengine import connect
+from data_collections.Company import Company
+from data_collections.CompanyMetrics import COMPANY_METRICS, get_built_generation, build_company_metrics
+
+# queues the broker reads from and writes to
+queue_names = ["JOB_EMBEDDING_OUTPUT_QUEUE", "CRAWLER_OUTPUT_QUEUE",
+               "SENTIMENT_ANALYSIS_OUTPUT_QUEUE", "CRAWLER_COMPANY_INPUT_QUEUE",
+               "JOB_EMBEDDING_INPUT_QUEUE", "SENTIMENT_ANALYSIS_INPUT_QUEUE"]
+
+# queues the broker waits on for tasks, in order of priority
+input_queue_names = ["JOB_EMBEDDING_OUTPUT_QUEUE", "CRAWLER_OUTPUT_QUEUE", "SENTIMENT_ANALYSIS_OUTPUT_QUEUE"]
+
+
+def check_environment():
+    """
+    Check that all the needed environment variables are set.
+    """
+    for name in queue_names + ["MONGODB_NAME", "REDIS_HOST", "REDIS_PORT", "MONGODB_HOST", "MONGODB_PORT"]:
+        assert name in os.environ, "%s environment variable is missing." % name
+
+
+def get_queues():
+    """
+    Returns: Dictionary mapping the names of the environment variables of the queues to their names.
+    """
+    return {name: os.environ[name] for name in queue_names}
+
+
+def load_language_model():
+    """
+    Returns: The fasttext model to detect languages.
+    """
+    print("import language prediction model")
+    language_model = FastText('language_prediction_model/lid.176.ftz')
+    print("imported language prediction model")
+    return language_model
+
+
+def connect_redis():
+    """
+    Returns: A new redis connection.
+    """
+    print("connecting to redis...")
+    redis_c = redis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], charset="utf-8")
+    print("connected to redis")
+    return redis_c
+
+
+def connect_mongodb():
+    """
+    Create the default mongoengine connection.
+    """
+    print("creating connection to mongodb")
+    connect(os.environ["MONGODB_NAME"], host=os.environ["MONGODB_HOST"], port=int(os.environ["MONGODB_PORT"]))
+    print("connection to mongodb created")
+
+
+def seed_company_metrics():
+    """
+    Build the rollups of the company metrics from all the companies if they were never built (e.g. on
+    the db of a previous version), until then the client averages the metrics with an aggregation and
+    the broker does not increment them. Needs the mongodb connection.
+    """
+    if get_built_generation() is not None:
+        return
+    print("building the rollups of the company metrics")
+    generation, count = build_company_metrics(Company.objects().only("industry", *COMPANY_METRICS).no_cache())
+    print("built %d rollups of the company metrics, generation %s in use" % (count, generation))
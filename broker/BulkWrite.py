@@ -0,0 +1,87 @@
+"""
+For writing many documents to mongodb with a single unordered bulk operation per collection,
+instead of a .save() (and the query that preceded it) per document.
+"""
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def document_update(document, upsert_filter):
+    """
+    Build the update operation that brings the stored version of a document up to date with
+    its in-memory version.
+    Documents that are not in the db yet are upserted on upsert_filter, so that if a document
+    matching the filter has been created in the meantime it is updated instead of duplicated.
+    Documents already in the db only get the fields that actually changed.
+
+    Args:
+        document: mongoengine document, already validated.
+        upsert_filter: Filter identifying the document if it does not have an id yet.
+
+    Returns: An UpdateOne operation, or None if there is nothing to write.
+
+    """
+    if document.pk is None:
+        data = document.to_mongo().to_dict()
+        data.pop("_id", None)
+        return UpdateOne(upsert_filter, {"$set": data}, upsert=True)
+
+    sets, unsets = document._delta()
+    if not sets and not unsets:
+        return None
+
+    update = dict()
+    if sets:
+        update["$set"] = sets
+    if unsets:
+        update["$unset"] = unsets
+    return UpdateOne({"_id": document.pk}, update)
+
+
+def bulk_write(document_class, documents):
+    """
+    Write the given documents of a collection with a single unordered bulk operation.
+    After the write documents that were created get their id set, and every document is marked as
+    not changed, as it would be after a .save().
+
+    Args:
+        document_class: mongoengine document class of the collection, e.g. Job.
+        documents: List of (document, upsert_filter) tuples, see document_update.
+
+    Returns: Number of operations sent to the db.
+
+    """
+    operations = []
+    written = []
+    for document, upsert_filter in documents:
+        operation = document_update(document, upsert_filter)
+        if operation is not None:
+            operations.append(operation)
+            written.append((document, upsert_filter))
+
+    if not operations:
+        return 0
+
+    collection = document_class._get_collection()
+    try:
+        upserted = collection.bulk_write(operations, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        # unordered, everything but the failed operations has been applied
+        print("Bulk write on %s partially failed:" % collection.name)
+        for error in e.details["writeErrors"]:
+            print(error["errmsg"])
+        upserted = {item["index"]: item["_id"] for item in e.details["upserted"]}
+
+    for index, (document, upsert_filter) in enumerate(written):
+        if document.pk is None:
+            if index in upserted:
+                document.pk = upserted[index]
+            else:
+                # the filter matched a document created in the meantime (or the write failed)
+                found = collection.find_one(upsert_filter, {"_id": 1})
+                document.pk = found["_id"] if found else None
+        document._clear_changed_fields()
+        document._created = False
+
+    return len(operations)
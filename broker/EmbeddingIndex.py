@@ -0,0 +1,55 @@
+"""
+For appending job embeddings to the index searched by the client for similar jobs.
+
+The index is a folder shared with the client (EMBEDDING_INDEX_FOLDER), the broker only appends
+records to the log of its current generation: the 24 characters of the job id followed by its
+embedding packed as float32, a zero embedding removes the job. The client applies the log to its
+copy of the index and saves snapshots, see modules/embedding_index.py in the client.
+"""
+
+import fcntl
+import json
+import os
+
+from data_collections.Job import EMBEDDING_DIMENSIONS, pack_embedding
+
+ID_LENGTH = 24
+
+
+def read_generation(folder):
+    """
+    Returns: The current generation of the index in the folder.
+    """
+    try:
+        with open(os.path.join(folder, "snapshot.json")) as f:
+            return json.load(f)["generation"]
+    except FileNotFoundError:
+        return 0
+
+
+def append_embeddings(folder, ids, embeddings):
+    """
+    Append embeddings to the log of the index in a folder.
+    Args:
+        folder: Folder of the index, created if needed.
+        ids: List of job ids, as strings.
+        embeddings: List with the embedding of each job, as lists of EMBEDDING_DIMENSIONS floats,
+            None to remove the job from the index.
+    """
+    records = bytearray()
+    for job_id, embedding in zip(ids, embeddings):
+        assert len(job_id) == ID_LENGTH, "Not a valid job id: %s" % job_id
+        records += job_id.encode("ascii")
+        records += pack_embedding(embedding if embedding else [0.] * EMBEDDING_DIMENSIONS, "float32")
+    if not records:
+        return
+
+    os.makedirs(folder, exist_ok=True)
+    # snapshots are saved holding the same lock, records always go to the log of the current generation
+    with open(os.path.join(folder, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(folder, "log_%d" % read_generation(folder)), "ab") as log:
+                log.write(records)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,166 @@
+"""
+Codec for the messages exchanged through the redis queues by crawlers, broker and workers.
+The same module is copied in each service.
+
+Messages are dictionaries, encoded with one of:
+ - "json" (default): utf-8 json, bytes values are sent as {"__bytes__": <base64>}
+ - "msgpack": msgpack, bytes values are sent as they are, needs the msgpack package
+ - "literal": the python literal (str of a dict) used before this codec existed, to be used
+    while old workers are still around
+Encoded messages (but literal ones) carry the version of the format in the "v" field.
+Decoding does not depend on the configured codec, messages in any of the formats are accepted,
+so that old and new workers can coexist during a rollout: first deploy everything with
+MESSAGE_CODEC=literal, then switch producers to the new format.
+
+Embeddings are sent as raw little-endian float32 bytes (see pack_floats) by the codecs that support it.
+"""
+
+import ast
+import array
+import base64
+import json
+import os
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# version of the message format written by this module
+VERSION = 1
+VERSION_FIELD = "v"
+
+CODECS = ["json", "msgpack", "literal"]
+
+# first byte of a msgpack encoded map: fixmap, map 16, map 32
+_msgpack_map_markers = set(range(0x80, 0x90)) | {0xde, 0xdf}
+
+
+def pack_floats(values):
+    """
+    Pack floats as little-endian float32 bytes.
+    Args:
+        values: Iterable of floats.
+
+    Returns: bytes, 4 for each value.
+
+    """
+    packed = array.array("f", values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_floats(data):
+    """
+    Unpack little-endian float32 bytes, see pack_floats.
+    Args:
+        data: bytes.
+
+    Returns: List of floats.
+
+    """
+    assert len(data) % 4 == 0, "Packed floats should be a multiple of 4 bytes."
+    unpacked = array.array("f")
+    unpacked.frombytes(data)
+    if sys.byteorder != "little":
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError("Object of type %s is not serializable" % type(value).__name__)
+
+
+def _json_object_hook(value):
+    if len(value) == 1 and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+class MessageCodec(object):
+    """
+    Encodes messages with the configured format, decodes messages in any format.
+    """
+
+    def __init__(self, name=None):
+        """
+        Args:
+            name: One of CODECS, if not given the MESSAGE_CODEC environment variable is used, defaulting to json.
+        """
+        name = name or os.environ.get("MESSAGE_CODEC", "json")
+        assert name in CODECS, "Unknown message codec %s, should be one of %s" % (name, CODECS)
+        assert name != "msgpack" or msgpack is not None, "The msgpack codec needs the msgpack package."
+        self.name = name
+
+    def encode(self, message):
+        """
+        Encode a message.
+        Args:
+            message: Dictionary.
+
+        Returns: The encoded message, bytes or str, ready to be pushed to redis.
+
+        """
+        if self.name == "literal":
+            return str(message)
+
+        message = dict(message)
+        message[VERSION_FIELD] = VERSION
+        if self.name == "msgpack":
+            return msgpack.packb(message, use_bin_type=True)
+        return json.dumps(message, default=_json_default, separators=(",", ":"))
+
+    def encode_floats(self, values):
+        """
+        Encode a list of floats (e.g. an embedding) to be put in a message: packed float32
+        bytes, or a list of floats for the literal codec.
+        Args:
+            values: Iterable of floats.
+
+        Returns: bytes or list of floats.
+
+        """
+        if self.name == "literal":
+            return [float(value) for value in values]
+        return pack_floats(values)
+
+    def decode(self, raw):
+        """
+        Decode a message in any of the formats.
+        Args:
+            raw: bytes or str, as obtained from redis.
+
+        Returns: The decoded message.
+
+        Raises:
+            ValueError: if the message can not be decoded, or has a newer version than the one supported.
+
+        """
+        if isinstance(raw, bytes) and len(raw) > 0 and raw[0] in _msgpack_map_markers:
+            if msgpack is None:
+                raise ValueError("Received a msgpack message but the msgpack package is missing.")
+            message = msgpack.unpackb(raw, raw=False)
+        else:
+            if isinstance(raw, bytes):
+                raw = raw.decode("utf-8")
+            try:
+                message = json.loads(raw, object_hook=_json_object_hook)
+            except ValueError:
+                try:
+                    message = ast.literal_eval(raw)
+                except SyntaxError as e:
+                    raise ValueError(str(e))
+
+        if isinstance(message, dict):
+            version = message.pop(VERSION_FIELD, 0)
+            if not isinstance(version, int) or version > VERSION:
+                raise ValueError("Unsupported message version %s." % version)
+        return message
+
+
+# codec configured for this process
+codec = MessageCodec()
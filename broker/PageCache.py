@@ -0,0 +1,25 @@
+"""
+For invalidating the company_details and job_details pages cached by the client in redis.
+
+The client keys the cached pages with a generation of the company they show (the company of the
+job for job_details), the broker increments it whenever it writes the company, its reviews or its
+jobs, so that the cached pages of that company are not read anymore and expire on their own.
+"""
+
+
+def company_generation_key(glassdoor_id):
+    return "page_cache:generation:%s" % glassdoor_id
+
+
+def invalidate_company_pages(redis_c, glassdoor_ids):
+    """
+    Invalidate the cached pages of some companies.
+    Args:
+        redis_c: redis connection or pipeline, None to do nothing.
+        glassdoor_ids: Iterable of company glassdoor ids, None ids are skipped.
+    """
+    if redis_c is None:
+        return
+    for glassdoor_id in set(glassdoor_ids):
+        if glassdoor_id:
+            redis_c.incr(company_generation_key(glassdoor_id))
@@ -0,0 +1,128 @@
+"""
+For processing batches of tasks popped from the broker input queues.
+"""
+
+from MessageCodec import codec
+from ProcessJob import process_jobs, process_job_embeddings
+from ProcessReview import process_reviews, process_reviews_sentiment
+from ProcessCompany import process_companies_general_info, process_companies_aggregate_reviews_info
+
+# order in which the crawler output types of a batch are handled, companies first so that jobs
+# and reviews in the same batch can already find them in the db
+__crawler_output_types = ["company_general_info", "company_aggregate_reviews_info", "job", "review"]
+
+
+def decode_task(received_queue, received_input):
+    """
+    Decode the raw input of a task received from a queue.
+    Args:
+        received_queue: Name of the queue the task comes from.
+        received_input: Raw task, as popped from redis.
+
+    Returns: The decoded task, or None if it could not be decoded.
+
+    """
+    try:
+        return codec.decode(received_input)
+    except ValueError as e:
+        print("Data from %s not a valid message (%s), discarding:\n %s" % (received_queue, str(e), received_input))
+        return None
+
+
+def decode_tasks(tasks):
+    """
+    Decode a batch of tasks, tasks that could not be decoded are kept (so that they can be acknowledged)
+    but their decoded task is None.
+    Args:
+        tasks: List of (queue, message id, raw task) tuples, as returned by the queue transport.
+
+    Returns: List of (queue, message id, decoded task) tuples.
+
+    """
+    return [(received_queue, message_id, decode_task(received_queue, received_input))
+            for received_queue, message_id, received_input in tasks]
+
+
+def group_tasks(queues, decoded_tasks):
+    """
+    Group a batch of decoded tasks by the handler they should be sent to, keeping
+    the order in which they were received inside each group.
+
+    Args:
+        queues: Dictionary mapping the names of the environment variables of the queues to their names.
+        decoded_tasks: List of (queue, message id, decoded task) tuples, as returned by decode_tasks.
+
+    Returns: Dictionary mapping crawler output types, "job_embedding" and "sentiment" to lists of decoded tasks.
+
+    """
+    groups = {name: [] for name in __crawler_output_types + ["job_embedding", "sentiment"]}
+
+    for received_queue, _, received_input in decoded_tasks:
+        if received_input is None:
+            continue
+        if received_queue == queues["CRAWLER_OUTPUT_QUEUE"]:
+            if not isinstance(received_input, dict) or "type" not in received_input:
+                print("Data from %s is a valid dictionary but is missing key 'type'" % received_queue)
+                continue
+            data_type = received_input["type"]
+            if data_type in __crawler_output_types:
+                groups[data_type].append(received_input)
+            else:
+                print("Unknown crawler output type %s, discarding" % data_type)
+        elif received_queue == queues["JOB_EMBEDDING_OUTPUT_QUEUE"]:
+            groups["job_embedding"].append(received_input)
+        elif received_queue == queues["SENTIMENT_ANALYSIS_OUTPUT_QUEUE"]:
+            groups["sentiment"].append(received_input)
+
+    return groups
+
+
+def process_batch(redis_c, queues, language_model, tasks):
+    """
+    Process a batch of tasks coming from the broker input queues, each group of tasks of the
+    same kind is handled together, with a single bulk write per collection.
+
+    Args:
+        redis_c: redis connection, used by handlers to push new tasks.
+        queues: Dictionary mapping the names of the environment variables of the queues to their names.
+        language_model: fasttext model to detect languages
+        tasks: List of (queue, message id, raw task) tuples, as returned by the queue transport.
+
+    Returns: Dictionary mapping each kind of task to the number of tasks of that kind in the batch.
+
+    """
+    return process_decoded_batch(redis_c, queues, language_model, decode_tasks(tasks))
+
+
+def process_decoded_batch(redis_c, queues, language_model, decoded_tasks):
+    """
+    Process a batch of already decoded tasks, see process_batch.
+
+    Args:
+        redis_c: redis connection, used by handlers to push new tasks.
+        queues: Dictionary mapping the names of the environment variables of the queues to their names.
+        language_model: fasttext model to detect languages
+        decoded_tasks: List of (queue, message id, decoded task) tuples, as returned by decode_tasks.
+
+    Returns: Dictionary mapping each kind of task to the number of tasks of that kind in the batch.
+
+    """
+    groups = group_tasks(queues, decoded_tasks)
+
+    # tasks pushed (and cached pages invalidated) by the handlers are sent to redis all together at the end
+    # of the batch
+    redis_pipe = redis_c.pipeline(transaction=False)
+
+    process_companies_general_info(groups["company_general_info"], redis_pipe)
+    process_companies_aggregate_reviews_info(groups["company_aggregate_reviews_info"], redis_pipe)
+    # embeddings first, as the embedding output queue came first when tasks were popped one at a time, so that
+    # a description changed in the same batch resets the embedding after it is stored, not before
+    process_job_embeddings(groups["job_embedding"])
+    process_jobs(redis_pipe, queues["CRAWLER_COMPANY_INPUT_QUEUE"], queues["JOB_EMBEDDING_INPUT_QUEUE"],
+                 language_model, groups["job"])
+    process_reviews(redis_pipe, queues["SENTIMENT_ANALYSIS_INPUT_QUEUE"], language_model, groups["review"])
+    process_reviews_sentiment(groups["sentiment"], redis_pipe)
+
+    redis_pipe.execute()
+
+    return {name: len(group) for name, group in groups.items()}
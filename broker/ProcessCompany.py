@@ -5,10 +5,16 @@ For processing company data and reviews aggregation.
 import datetime  # for getting the time of update/creation of a document
 from mongoengine import ValidationError
 from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from data_collections.Company import Company
+from data_collections.CompanyMetrics import CompanyMetrics, company_metrics_state, company_metrics_increments, \
+    get_built_generation, rollup_key
 from data_collections.Job import Job
 from ProcessJob import job_is_from_company
+from BulkWrite import bulk_write
+from PageCache import invalidate_company_pages
 
 # error message written here to not repeat myself
 __general_info_dict_field_error_message = "Received input is either not a dict or it is missing either the " \
@@ -25,7 +31,7 @@ __general_info_fields = [
 ]
 
 
-def process_company_general_info(general_info):
+def process_company_general_info(general_info, redis_c=None):
     """
     Process general company info coming from a glassdoor crawler. Given the input data
     it will save a company document in the database or update the existing one.
@@ -35,48 +41,87 @@ def process_company_general_info(general_info):
     Args:
         general_info: General info of a company, required fields are employer_name and employer_glassdoor_id,
             the latter required because this kind of data can only arrive from a glassdoor spider.
+        redis_c: redis connection, used to invalidate the pages of the company cached by the client.
     """
-    try:
-        assert isinstance(general_info, dict), __general_info_dict_field_error_message
-        assert "employer_glassdoor_id" in general_info, __general_info_dict_field_error_message
-        assert "employer_name" in general_info, __general_info_dict_field_error_message
-
-        # remove extra whitespace from strings
-        for key, value in general_info.items():
-            if isinstance(value, str):
-                general_info[key] = " ".join(value.split())
-            if isinstance(value, list):
-                if all([isinstance(item, str) for item in value]):
-                    value = [" ".join(item.split()) for item in value]
-                    general_info[key] = " ".join(value)
-
-        # check if it already exists, if it exists update it
-        company = Company.objects(glassdoor_id=general_info["employer_glassdoor_id"])
-        company = company[0] if company else Company()
-        modified = False
-
-        # so that we create/update with the same code
-        for field in __general_info_fields:
-            # necessary because it might have been set to None instead of not being in the dict
-            value = general_info.get(field, None)
-            if value and ((field not in company) or company[field] != value):
-                company[field] = value
-                modified = True
-
-        if modified:
-            company.date_last_modify = datetime.datetime.utcnow()
-            # need to set these if it was created
-            company.name = general_info["employer_name"]
-            company.glassdoor_id = general_info["employer_glassdoor_id"]
-            company.save()
-
-    except ValidationError as e:
-        # would be captured anyway because it is an AssertionError, being explicit
-        print("The provided document was not valid.")
-        print(str(e))
-
-    except AssertionError as e:
-        print(str(e))
+    process_companies_general_info([general_info], redis_c)
+
+
+def process_companies_general_info(general_infos, redis_c=None):
+    """
+    Process a batch of general company info coming from glassdoor crawlers, see process_company_general_info.
+    Existing companies are fetched with a single query, and new or modified companies are written
+    with a single bulk operation.
+
+    Args:
+        general_infos: List of general info of companies, see process_company_general_info.
+        redis_c: redis connection, used to invalidate the pages of the companies cached by the client.
+    """
+    valid_general_infos = []
+    for general_info in general_infos:
+        try:
+            assert isinstance(general_info, dict), __general_info_dict_field_error_message
+            assert "employer_glassdoor_id" in general_info, __general_info_dict_field_error_message
+            assert "employer_name" in general_info, __general_info_dict_field_error_message
+
+            # remove extra whitespace from strings
+            for key, value in general_info.items():
+                if isinstance(value, str):
+                    general_info[key] = " ".join(value.split())
+                if isinstance(value, list):
+                    if all([isinstance(item, str) for item in value]):
+                        value = [" ".join(item.split()) for item in value]
+                        general_info[key] = " ".join(value)
+            valid_general_infos.append(general_info)
+
+        except AssertionError as e:
+            print(str(e))
+
+    if not valid_general_infos:
+        return
+
+    # get the companies that already exist
+    companies = get_companies_by_glassdoor_id([info["employer_glassdoor_id"] for info in valid_general_infos])
+    old_states = {glassdoor_id: company_metrics_state(company) for glassdoor_id, company in companies.items()}
+    modified_ids = []
+
+    for general_info in valid_general_infos:
+        glassdoor_id = general_info["employer_glassdoor_id"]
+        try:
+            # if it exists update it, the same company might appear more than once in a batch
+            company = companies[glassdoor_id] if glassdoor_id in companies else Company()
+            modified = False
+
+            # so that we create/update with the same code
+            for field in __general_info_fields:
+                # necessary because it might have been set to None instead of not being in the dict
+                value = general_info.get(field, None)
+                if value and ((field not in company) or company[field] != value):
+                    company[field] = value
+                    modified = True
+
+            if modified:
+                company.date_last_modify = datetime.datetime.utcnow()
+                # need to set these if it was created
+                company.name = general_info["employer_name"]
+                company.glassdoor_id = glassdoor_id
+                company.validate()
+                companies[glassdoor_id] = company
+                if glassdoor_id not in modified_ids:
+                    modified_ids.append(glassdoor_id)
+
+        except ValidationError as e:
+            # would be captured anyway because it is an AssertionError, being explicit
+            print("The provided document was not valid.")
+            print(str(e))
+            # do not write the invalid changes
+            companies.pop(glassdoor_id, None)
+            if glassdoor_id in modified_ids:
+                modified_ids.remove(glassdoor_id)
+
+    bulk_write(Company, [(companies[glassdoor_id], {"glassdoor_id": glassdoor_id}) for glassdoor_id in modified_ids])
+    update_company_metrics([(old_states.get(glassdoor_id, None), company_metrics_state(companies[glassdoor_id]))
+                            for glassdoor_id in modified_ids])
+    invalidate_company_pages(redis_c, modified_ids)
 
 
 # error message written here to not repeat myself
@@ -111,7 +156,7 @@ __aggregate_info_float_fields = [
 ]
 
 
-def process_company_aggregate_reviews_info(aggregate_info):
+def process_company_aggregate_reviews_info(aggregate_info, redis_c=None):
     """
     Process aggregate company review info coming from a glassdoor crawler. Given the input data
     it will save a company document in the database or update the existing one.
@@ -120,50 +165,146 @@ def process_company_aggregate_reviews_info(aggregate_info):
         aggregate_info: Aggregate reviews info of a company, required fields are employer_name
             and employer_glassdoor_id, with the latter required because this kind of data can
             only arrive from a glassdoor spider.
+        redis_c: redis connection, used to invalidate the pages of the company cached by the client.
 
     """
-    try:
-        assert isinstance(aggregate_info, dict), __aggregate_info_dict_field_error_message
-        assert "employer_glassdoor_id" in aggregate_info, __aggregate_info_dict_field_error_message
-        assert "employer_name" in aggregate_info, __aggregate_info_dict_field_error_message
+    process_companies_aggregate_reviews_info([aggregate_info], redis_c)
 
-        # make sure numeric fields are float
-        for key, value in aggregate_info.items():
-            if key in __aggregate_info_float_fields and value:
-                aggregate_info[key] = float(value)
 
-        # make sure the id and name are a string
-        aggregate_info["employer_glassdoor_id"] = str(aggregate_info["employer_glassdoor_id"])
-        aggregate_info["employer_name"] = str(aggregate_info["employer_name"])
+def process_companies_aggregate_reviews_info(aggregate_infos, redis_c=None):
+    """
+    Process a batch of aggregate company review info coming from glassdoor crawlers, see
+    process_company_aggregate_reviews_info.
+    Existing companies are fetched with a single query, and new or modified companies are written
+    with a single bulk operation.
 
-        # check if it already exists, if it exists update it
-        company = Company.objects(glassdoor_id=aggregate_info["employer_glassdoor_id"])
-        company = company[0] if company else Company()
-        modified = False
+    Args:
+        aggregate_infos: List of aggregate reviews info of companies, see process_company_aggregate_reviews_info.
+        redis_c: redis connection, used to invalidate the pages of the companies cached by the client.
 
-        # so that we create/update with the same code
-        for field in __aggregate_reviews_fields:
-            # necessary because it might have been set to None instead of not being in the dict
-            value = aggregate_info.get(field, None)
-            mapped_name = __aggregate_reviews_fields[field]
-            if value and ((mapped_name not in company) or company[mapped_name] != value):
-                company[mapped_name] = value
-                modified = True
+    """
+    valid_aggregate_infos = []
+    for aggregate_info in aggregate_infos:
+        try:
+            assert isinstance(aggregate_info, dict), __aggregate_info_dict_field_error_message
+            assert "employer_glassdoor_id" in aggregate_info, __aggregate_info_dict_field_error_message
+            assert "employer_name" in aggregate_info, __aggregate_info_dict_field_error_message
+
+            # make sure numeric fields are float
+            for key, value in aggregate_info.items():
+                if key in __aggregate_info_float_fields and value:
+                    aggregate_info[key] = float(value)
+
+            # make sure the id and name are a string
+            aggregate_info["employer_glassdoor_id"] = str(aggregate_info["employer_glassdoor_id"])
+            aggregate_info["employer_name"] = str(aggregate_info["employer_name"])
+            valid_aggregate_infos.append(aggregate_info)
+
+        except (AssertionError, ValueError) as e:
+            print(str(e))
+
+    if not valid_aggregate_infos:
+        return
+
+    # get the companies that already exist
+    companies = get_companies_by_glassdoor_id([info["employer_glassdoor_id"] for info in valid_aggregate_infos])
+    old_states = {glassdoor_id: company_metrics_state(company) for glassdoor_id, company in companies.items()}
+    modified_ids = []
+    processed_ids = []
+
+    for aggregate_info in valid_aggregate_infos:
+        glassdoor_id = aggregate_info["employer_glassdoor_id"]
+        try:
+            # if it exists update it, the same company might appear more than once in a batch
+            company = companies[glassdoor_id] if glassdoor_id in companies else Company()
+            modified = False
+
+            # so that we create/update with the same code
+            for field in __aggregate_reviews_fields:
+                # necessary because it might have been set to None instead of not being in the dict
+                value = aggregate_info.get(field, None)
+                mapped_name = __aggregate_reviews_fields[field]
+                if value and ((mapped_name not in company) or company[mapped_name] != value):
+                    company[mapped_name] = value
+                    modified = True
+
+            if modified:
+                company.date_last_modify = datetime.datetime.utcnow()
+                company.validate()
+                if glassdoor_id not in modified_ids:
+                    modified_ids.append(glassdoor_id)
+
+            companies[glassdoor_id] = company
+            if glassdoor_id not in processed_ids:
+                processed_ids.append(glassdoor_id)
+
+        except ValidationError as e:
+            # would be captured anyway because it is an AssertionError, being explicit
+            print("The provided document was not valid.")
+            print(str(e))
+            # do not write the invalid changes
+            companies.pop(glassdoor_id, None)
+            for ids in [modified_ids, processed_ids]:
+                if glassdoor_id in ids:
+                    ids.remove(glassdoor_id)
+
+    bulk_write(Company, [(companies[glassdoor_id], {"glassdoor_id": glassdoor_id}) for glassdoor_id in modified_ids])
+    update_company_metrics([(old_states.get(glassdoor_id, None), company_metrics_state(companies[glassdoor_id]))
+                            for glassdoor_id in modified_ids])
+
+    # check for matching companies/jobs in the db
+    for glassdoor_id in processed_ids:
+        company_matchings(companies[glassdoor_id])
+
+    # matching jobs might have been added to any of the processed companies
+    invalidate_company_pages(redis_c, processed_ids)
+
+
+def update_company_metrics(changes):
+    """
+    Apply the changes of some companies to the rollups of the company metrics (see
+    data_collections.CompanyMetrics) with a single bulk operation. Rollups are only incremented, so
+    that changes applied at the same time by different workers add up, and only once they were built
+    from all the companies (see seed_company_metrics in BrokerSetup.py), an increment alone is not a sum.
+    Args:
+        changes: List of (old state, new state) tuples of companies, see company_metrics_increments.
+    """
+    increments = dict()
+    for old_state, new_state in changes:
+        for key, increment in company_metrics_increments(old_state, new_state).items():
+            rollup_increment = increments.setdefault(key, dict())
+            for name, value in increment.items():
+                rollup_increment[name] = rollup_increment.get(name, 0) + value
+    if not any(increments.values()):
+        return
+    generation = get_built_generation()
+    if generation is None:
+        return
+    # a rollup created by an increment is the one of a group without any company until now
+    operations = [UpdateOne({"key": rollup_key(generation, key)},
+                            {"$inc": increment, "$setOnInsert": {"generation": generation}}, upsert=True)
+                  for key, increment in increments.items() if increment]
 
-        if modified:
-            company.date_last_modify = datetime.datetime.utcnow()
-            company.save()
+    try:
+        CompanyMetrics._get_collection().bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # two workers upserting a new rollup at the same time, the one that lost is applied again
+        failed = [error["index"] for error in e.details["writeErrors"] if error["code"] == 11000]
+        if len(failed) < len(e.details["writeErrors"]):
+            raise
+        CompanyMetrics._get_collection().bulk_write([operations[i] for i in failed], ordered=False)
 
-        # check for matching companies/jobs in the db
-        company_matchings(company)
 
-    except ValidationError as e:
-        # would be captured anyway because it is an AssertionError, being explicit
-        print("The provided document was not valid.")
-        print(str(e))
+def get_companies_by_glassdoor_id(glassdoor_ids):
+    """
+    Get the companies with the given glassdoor ids with a single query.
+    Args:
+        glassdoor_ids: List of glassdoor ids.
 
-    except AssertionError as e:
-        print(str(e))
+    Returns: Dictionary mapping glassdoor ids to company documents.
+
+    """
+    return {company.glassdoor_id: company for company in Company.objects(glassdoor_id__in=list(set(glassdoor_ids)))}
 
 
 def company_matchings(company):
@@ -184,13 +325,18 @@ def company_matchings(company):
     """
     # delete placeholder companies with same name and no id
     same_named_cs = Company.objects(Q(name=company.name) & Q(glassdoor_id=None))
+    deleted_states = []
     for same_named_company in same_named_cs:
+        deleted_states.append((company_metrics_state(same_named_company), None))
         same_named_company.delete()
+    update_company_metrics(deleted_states)
 
     # for each job with matching employer name check if it is related to the company
     jobs = Job.objects(Q(employer_name=company.name) & Q(employer_glassdoor_id=None))
+    matching_jobs = []
     for job in jobs:
         if job_is_from_company(job, company):
             job.employer_glassdoor_id = company.glassdoor_id
             job.date_last_modify = datetime.datetime.utcnow()
-            job.save()
+            matching_jobs.append((job, None))
+    bulk_write(Job, matching_jobs)
@@ -2,14 +2,24 @@
 For processing job related data.
 """
 
+import os
 import datetime  # for getting the time of update/creation of a document
+import hashlib
+from bson import ObjectId
+from pymongo import UpdateOne
 import nltk
 from nltk.corpus import stopwords
 from mongoengine import ValidationError
 from mongoengine.queryset.visitor import Q
 
-from data_collections.Job import Job
+from data_collections.Job import Job, EMBEDDING_DIMENSIONS, EMBEDDING_STORAGES, pack_embedding
+from data_collections.WordCounts import count_words
+from EmbeddingIndex import append_embeddings
+from PageCache import invalidate_company_pages
 from data_collections.Company import Company
+from BulkWrite import bulk_write
+from MessageCodec import codec, unpack_floats
+from QueueTransport import transport
 
 # error message written here to not repeat myself
 __job_dict_field_error_message = "Received input is either not a dict or it is missing required fields, which are:  \
@@ -22,6 +32,14 @@ __non_description_fields = ["title", "job_title", "employer_name", "city", "stat
 nltk.download('stopwords')
 __stopwords = set(stopwords.words("english"))
 
+# how embeddings are stored, see data_collections.Job
+__embedding_storage = os.environ.get("EMBEDDING_STORAGE", "list")
+assert __embedding_storage in EMBEDDING_STORAGES, \
+    "Unknown embedding storage %s, should be one of %s" % (__embedding_storage, EMBEDDING_STORAGES)
+
+# folder of the index of the embeddings searched by the client for similar jobs, not kept if not set
+__embedding_index_folder = os.environ.get("EMBEDDING_INDEX_FOLDER", None)
+
 # don't crawl a company for updated info if the last time it was craled
 # was less than 2 days
 __CRAWL_COMPANY_DAYS_THRESHOLD = 2
@@ -44,96 +62,268 @@ def process_job(redis_c, crawler_company_input_queue, job_embedding_input_queue,
         job_data: Dictionary that must contain three keys: description_text, description_html, employer_name, those
             should be mapped to strings.
     """
-    try:
-        assert isinstance(job_data, dict), __job_dict_field_error_message
-        assert "description_text" in job_data, __job_dict_field_error_message
-        assert "description_html" in job_data, __job_dict_field_error_message
-        assert "employer_name" in job_data, __job_dict_field_error_message
-
-        # remove extra whitespace from strings
-        for key, value in job_data.items():
-            if isinstance(value, str):
-                job_data[key] = " ".join(value.split())
-            if isinstance(value, list):
-                if all([isinstance(item, str) for item in value]):
-                    value = [" ".join(item.split()) for item in value]
-                    job_data[key] = " ".join(value)
-
-        # check if job already exist
-        if "job_glassdoor_id" in job_data:
-            """
-            In the case we receive the same job but in a different language.
-            (empName & text) | glassdoor_id
-            """
-            job = Job.objects(
-                (Q(employer_name=job_data["employer_name"]) & Q(description_text=job_data["description_text"]) |
-                 Q(job_glassdoor_id=job_data["job_glassdoor_id"])))
-        else:
-            # (empName & text)
-            job = Job.objects(employer_name=job_data["employer_name"], description_text=job_data["description_text"])
-
-        # if the job is to be newly created the description is new for sure
-        new_description = bool(job)
-        modified = new_description
-
-        # if already exist, update the job
-        job = job[0] if job else Job()
-
-        # create/update the description of the job
-        updating_description = (not new_description) and job.description_text != job_data["description_text"]
-
-        if updating_description:
-            predicted_language = language_model.predict_proba_single(job_data["description_text"], k=1)
-            predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
-            old_description_language = job.description_language
-
-            # keep the old english description if the new one is not in english
-            new_description = not (old_description_language != predicted_language and old_description_language == "en")
-
-        if new_description:
-            predicted_language = language_model.predict_proba_single(job_data["description_text"], k=1)
-            predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
-
-            job.description_text = job_data["description_text"]
-            job.description_html = job_data["description_html"]
-            job.description_language = predicted_language
-            job.embedding = None
-            modified = True
-
-        # update/create fields not related to the job description
-        for field in __non_description_fields:
-            # necessary because it might have been set to None instead of not being in the dict
-            value = job_data.get(field, None)
-            if value and ((field not in job) or job[field] != value):
-                job[field] = value
+    process_jobs(redis_c, crawler_company_input_queue, job_embedding_input_queue, language_model, [job_data])
+
+
+def process_jobs(redis_c, crawler_company_input_queue, job_embedding_input_queue, language_model, jobs_data):
+    """
+    Process a batch of job data coming from crawlers, see process_job.
+    Existing jobs are fetched with a single query, and new or modified jobs are written
+    with a single bulk operation.
+
+    Args:
+        redis_c: redis connection, used to push text to redis for computing the embedding of the job description
+            if necessary, and to invalidate the pages of the companies of the jobs cached by the client
+        crawler_company_input_queue: Redis queue to which the function might add new crawling tasks to look
+            for a specific company.
+        job_embedding_input_queue: Redis queue to which to send tasks to compute the embedding of a job.
+        language_model: fasttext model to detect languages
+        jobs_data: List of job data, see process_job.
+    """
+    valid_jobs_data = []
+    for job_data in jobs_data:
+        try:
+            assert isinstance(job_data, dict), __job_dict_field_error_message
+            assert "description_text" in job_data, __job_dict_field_error_message
+            assert "description_html" in job_data, __job_dict_field_error_message
+            assert "employer_name" in job_data, __job_dict_field_error_message
+
+            # remove extra whitespace from strings
+            for key, value in job_data.items():
+                if isinstance(value, str):
+                    job_data[key] = " ".join(value.split())
+                if isinstance(value, list):
+                    if all([isinstance(item, str) for item in value]):
+                        value = [" ".join(item.split()) for item in value]
+                        job_data[key] = " ".join(value)
+            valid_jobs_data.append(job_data)
+
+        except AssertionError as e:
+            print(str(e))
+
+    if not valid_jobs_data:
+        return
+
+    # get the jobs that already exist
+    jobs = BatchJobs(valid_jobs_data)
+    # and the companies of the jobs
+    companies = BatchCompanies(valid_jobs_data)
+    # jobs to write as (job, upsert filter) and jobs for which to compute the embedding (with the data that
+    # updated them), by position in the batch
+    to_write = dict()
+    to_embed = dict()
+    # ids of existing jobs whose embedding is not valid anymore
+    reset_embeddings = set()
+
+    for job_data in valid_jobs_data:
+        try:
+            # check if job already exist, the same job might appear more than once in a batch
+            job = jobs.find(job_data)
+
+            # if the job is to be newly created the description is new for sure
+            new_description = job is not None
+            modified = new_description
+
+            # if already exist, update the job
+            job = job if job is not None else Job()
+
+            # create/update the description of the job
+            updating_description = (not new_description) and job.description_text != job_data["description_text"]
+
+            if updating_description:
+                predicted_language = language_model.predict_proba_single(job_data["description_text"], k=1)
+                predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
+                old_description_language = job.description_language
+
+                # keep the old english description if the new one is not in english
+                new_description = not (old_description_language != predicted_language and
+                                       old_description_language == "en")
+
+            if new_description:
+                predicted_language = language_model.predict_proba_single(job_data["description_text"], k=1)
+                predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
+
+                job.description_text = job_data["description_text"]
+                job.description_html = job_data["description_html"]
+                job.description_language = predicted_language
+                job.word_counts = count_words([job.description_text], __stopwords)
+                job.embedding = None
+                job.embedding_data = None
                 modified = True
+                if job.pk is not None:
+                    reset_embeddings.add(str(job.pk))
+
+            # update/create fields not related to the job description
+            for field in __non_description_fields:
+                # necessary because it might have been set to None instead of not being in the dict
+                value = job_data.get(field, None)
+                if value and ((field not in job) or job[field] != value):
+                    job[field] = value
+                    modified = True
+
+            # check for a matching company for the job, or create a company if it doesn't exist, etc.
+            added_company = job_company_matching(redis_c, crawler_company_input_queue, job, companies)
+            modified = modified or added_company
+
+            if modified:
+                job.date_last_modify = datetime.datetime.utcnow()
+                job.validate()
+                jobs.add(job)
+                to_write[id(job)] = (job, job_upsert_filter(job))
+
+            # send the embedding job to the queue if necessary
+            if new_description and job.description_language == "en":
+                to_embed[id(job)] = (job, job_data)
+
+        except ValidationError as e:
+            # would be captured anyway because it is an AssertionError, being explicit
+            print("The provided document was not valid.")
+            print(str(e))
+
+        except AssertionError as e:
+            print(str(e))
+
+    # placeholder companies created while matching jobs to companies, before the jobs referring to them
+    bulk_write(Company, companies.created)
+    bulk_write(Job, list(to_write.values()))
+    invalidate_company_pages(redis_c, [job.employer_glassdoor_id for job, _ in to_write.values()])
+
+    if __embedding_index_folder and reset_embeddings:
+        append_embeddings(__embedding_index_folder, list(reset_embeddings), [None] * len(reset_embeddings))
+
+    for job, job_data in to_embed.values():
+        if job.pk is None:
+            continue
+        embedding_input = dict()
+        embedding_input["id"] = str(job.id)
+        # echoed back by the embedding workers, so that the output is routed to the worker of the job's
+        # crawler tasks (see WorkerPool.shard_key)
+        embedding_input["employer_glassdoor_id"] = job_data.get("employer_glassdoor_id", None)
+        embedding_input["employer_name"] = job_data["employer_name"]
+        # echoed back too, the embedding is not stored if the description changed in the meantime
+        embedding_input["description_hash"] = description_hash(job.description_text)
+
+        # remove stop words
+        job_text = " ".join([word.lower() for word in job.description_text.split()
+                             if word.lower() not in __stopwords])
+        embedding_input["text"] = job_text
+        transport.push(redis_c, job_embedding_input_queue, codec.encode(embedding_input))
+
+
+def job_upsert_filter(job):
+    """
+    Filter identifying a job that is not in the db yet, the same used to look for existing jobs.
+    Args:
+        job: Job document.
+
+    Returns: Filter for the job collection.
+
+    """
+    if job.job_glassdoor_id:
+        return {"job_glassdoor_id": job.job_glassdoor_id}
+    return {"employer_name": job.employer_name, "description_text": job.description_text}
+
+
+class BatchJobs(object):
+    """
+    Jobs related to a batch of job data, fetched from the db with a single query, and kept up to
+    date with the jobs created while processing the batch.
+    """
+
+    def __init__(self, jobs_data):
+        """
+        Args:
+            jobs_data: List of job data, each must have description_text and employer_name.
+        """
+        # in the case we receive the same job but in a different language: (empName & text) | glassdoor_id
+        glassdoor_ids = list(set(job_data["job_glassdoor_id"] for job_data in jobs_data
+                                 if job_data.get("job_glassdoor_id", None)))
+        employer_names = list(set(job_data["employer_name"] for job_data in jobs_data))
+        descriptions = list(set(job_data["description_text"] for job_data in jobs_data))
+
+        self.by_glassdoor_id = dict()
+        self.by_employer_and_text = dict()
+        for job in Job.objects(Q(job_glassdoor_id__in=glassdoor_ids) |
+                               (Q(employer_name__in=employer_names) & Q(description_text__in=descriptions))):
+            self.add(job)
+
+    def add(self, job):
+        """
+        Add a job to the ones that can be found.
+        Args:
+            job: Job document.
+        """
+        if job.job_glassdoor_id:
+            self.by_glassdoor_id.setdefault(job.job_glassdoor_id, job)
+        self.by_employer_and_text.setdefault((job.employer_name, job.description_text), job)
 
-        # check for a matching company for the job, or create a company if it doesn't exist, etc.
-        added_company = job_company_matching(redis_c, crawler_company_input_queue, job)
-        modified = modified or added_company
+    def find(self, job_data):
+        """
+        Find the job related to some job data.
+        Args:
+            job_data: Job data, with description_text and employer_name.
 
-        if modified:
-            job.date_last_modify = datetime.datetime.utcnow()
-            job.save()
+        Returns: The job document, or None if there is no such job.
 
-        # send the embedding job to the queue if necessary
-        if new_description and job.description_language == "en":
-            embedding_input = dict()
-            embedding_input["id"] = str(job.id)
+        """
+        job = self.by_employer_and_text.get((job_data["employer_name"], job_data["description_text"]), None)
+        if job is None and job_data.get("job_glassdoor_id", None):
+            job = self.by_glassdoor_id.get(job_data["job_glassdoor_id"], None)
+        return job
 
-            # remove stop words
-            job_text = " ".join([word.lower() for word in job.description_text.split()
-                                 if word.lower() not in __stopwords])
-            embedding_input["text"] = job_text
-            redis_c.lpush(job_embedding_input_queue, str(embedding_input))
 
-    except ValidationError as e:
-        # would be captured anyway because it is an AssertionError, being explicit
-        print("The provided document was not valid.")
-        print(str(e))
+class BatchCompanies(object):
+    """
+    Companies related to a batch of job data, fetched from the db with a single query, and the placeholder
+    companies created while matching the jobs to companies, to be written all together.
+    """
 
-    except AssertionError as e:
-        print(str(e))
+    def __init__(self, jobs_data):
+        """
+        Args:
+            jobs_data: List of job data, each must have employer_name.
+        """
+        glassdoor_ids = list(set(str(job_data["employer_glassdoor_id"]) for job_data in jobs_data
+                                 if job_data.get("employer_glassdoor_id", None)))
+        employer_names = list(set(job_data["employer_name"] for job_data in jobs_data))
+
+        self.by_glassdoor_id = dict()
+        self.by_name = dict()
+        # created companies as (company, upsert filter), see BulkWrite.bulk_write
+        self.created = []
+        for company in Company.objects(Q(glassdoor_id__in=glassdoor_ids) | Q(name__in=employer_names)):
+            self.add(company)
+
+    def add(self, company):
+        """
+        Add a company to the ones that can be found.
+        Args:
+            company: Company document.
+        """
+        if company.glassdoor_id:
+            self.by_glassdoor_id.setdefault(company.glassdoor_id, company)
+        # companies with a glassdoor id are the ones jobs without it can be matched to
+        if company.name and (company.name not in self.by_name or
+                             (company.glassdoor_id and not self.by_name[company.name].glassdoor_id)):
+            self.by_name[company.name] = company
+
+    def create(self, name, glassdoor_id=None):
+        """
+        Create a placeholder company, written with the others at the end of the batch.
+        Args:
+            name: Name of the company.
+            glassdoor_id: Glassdoor id of the company, None if not known.
+
+        Returns: The company document.
+
+        """
+        company = Company(name=name, glassdoor_id=glassdoor_id)
+        company.date_last_modify = datetime.datetime.utcnow()
+        company.validate()
+        self.add(company)
+        upsert_filter = {"glassdoor_id": glassdoor_id} if glassdoor_id else {"name": name, "glassdoor_id": None}
+        self.created.append((company, upsert_filter))
+        return company
 
 
 # error message written here to not repeat myself
@@ -144,33 +334,102 @@ __embedding_dict_field_error_message = "Received input is either not a dict or i
 def process_job_embedding(job_embedding_data):
     """
     Process data coming from a job embedding output, it should be a dict
-    containing "id" and "embedding", with embedding either being None or a list
-    of 300 floats.
+    containing "id" and "embedding", with embedding either being None, a list
+    of 300 floats, or 300 floats packed as float32 bytes, and possibly the "description_hash" of the
+    description the embedding was computed for.
     This function will take care of updating the related job document (from the "id") with
-    the newly computed embedding.
+    the newly computed embedding, unless the description of the job changed since.
     Args:
         job_embedding_data:
     """
-    try:
-        assert isinstance(job_embedding_data, dict), __embedding_dict_field_error_message
-        assert "id" in job_embedding_data, __embedding_dict_field_error_message
-        assert "embedding" in job_embedding_data, __embedding_dict_field_error_message
-        assert isinstance(job_embedding_data["embedding"], list) or isinstance(job_embedding_data["embedding"],
-                                                                               type(None)), __embedding_dict_field_error_message
-        if job_embedding_data["embedding"]:
-            assert len(job_embedding_data["embedding"]) == 300, __embedding_dict_field_error_message
-            assert all([isinstance(value, float) for value in job_embedding_data["embedding"]]), \
-                __embedding_dict_field_error_message
-
-        # the job related to this embedding should already be in the db, if it happens for some reason
-        # to not be there, this line will do nothing
-        Job.objects(id=job_embedding_data["id"]).update(embedding=job_embedding_data["embedding"])
-
-    except AssertionError as e:
-        print(str(e))
-
-
-def job_company_matching(redis_c, crawler_company_input_queue, job):
+    process_job_embeddings([job_embedding_data])
+
+
+def process_job_embeddings(jobs_embedding_data):
+    """
+    Process a batch of data coming from a job embedding output, see process_job_embedding.
+    All the related jobs are updated with a single bulk operation.
+    Args:
+        jobs_embedding_data: List of job embedding outputs.
+    """
+    # descriptions of the jobs whose embedding was computed for a known description, with a single query
+    hashed_ids = [ObjectId(data["id"]) for data in jobs_embedding_data
+                  if isinstance(data, dict) and "description_hash" in data and ObjectId.is_valid(data.get("id", None))]
+    descriptions = {str(job.id): job.description_text
+                    for job in Job.objects(id__in=hashed_ids).only("description_text")} if hashed_ids else dict()
+
+    operations = []
+    # ids and embeddings to add to the index of the embeddings
+    ids, embeddings = [], []
+    for job_embedding_data in jobs_embedding_data:
+        try:
+            assert isinstance(job_embedding_data, dict), __embedding_dict_field_error_message
+            assert "id" in job_embedding_data, __embedding_dict_field_error_message
+            assert "embedding" in job_embedding_data, __embedding_dict_field_error_message
+            # embeddings might arrive packed as float32 bytes
+            if isinstance(job_embedding_data["embedding"], bytes):
+                job_embedding_data["embedding"] = unpack_floats(job_embedding_data["embedding"])
+            assert isinstance(job_embedding_data["embedding"], list) or \
+                isinstance(job_embedding_data["embedding"], type(None)), __embedding_dict_field_error_message
+            assert ObjectId.is_valid(job_embedding_data["id"]), __embedding_dict_field_error_message
+            if job_embedding_data["embedding"]:
+                assert len(job_embedding_data["embedding"]) == EMBEDDING_DIMENSIONS, \
+                    __embedding_dict_field_error_message
+                assert all([isinstance(value, float) for value in job_embedding_data["embedding"]]), \
+                    __embedding_dict_field_error_message
+
+            # an embedding of an older description would overwrite the reset done when the description changed,
+            # the embedding of the new one is on its way
+            if "description_hash" in job_embedding_data:
+                description = descriptions.get(str(job_embedding_data["id"]), None)
+                if description is None or description_hash(description) != job_embedding_data["description_hash"]:
+                    print("Discarding the embedding of an outdated description of job %s" % job_embedding_data["id"])
+                    continue
+
+            # the job related to this embedding should already be in the db, if it happens for some reason
+            # to not be there, the operation will do nothing
+            operations.append(UpdateOne({"_id": ObjectId(job_embedding_data["id"])},
+                                        embedding_update(job_embedding_data["embedding"])))
+            ids.append(str(job_embedding_data["id"]))
+            embeddings.append(job_embedding_data["embedding"])
+
+        except AssertionError as e:
+            print(str(e))
+
+    if operations:
+        Job._get_collection().bulk_write(operations, ordered=False)
+    if __embedding_index_folder and ids:
+        append_embeddings(__embedding_index_folder, ids, embeddings)
+
+
+def description_hash(description_text):
+    """
+    Returns: A short hash of the description of a job, sent along with the tasks computing its embedding.
+    """
+    return hashlib.sha1((description_text or "").encode("utf-8")).hexdigest()[:16]
+
+
+def embedding_update(embedding, storage=None):
+    """
+    Build the update storing an embedding in a job document, in the field of the configured storage,
+    removing it from the field of any other storage. The date of last modification is updated too, the
+    client reloads the embeddings of the jobs modified since it last loaded them.
+    Args:
+        embedding: List of floats, or None.
+        storage: One of EMBEDDING_STORAGES, the one configured through EMBEDDING_STORAGE if not given.
+
+    Returns: The update document.
+
+    """
+    storage = storage or __embedding_storage
+    date_last_modify = datetime.datetime.utcnow()
+    if embedding and storage != "list":
+        return {"$set": {"embedding_data": pack_embedding(embedding, storage), "date_last_modify": date_last_modify},
+                "$unset": {"embedding": ""}}
+    return {"$set": {"embedding": embedding, "date_last_modify": date_last_modify}, "$unset": {"embedding_data": ""}}
+
+
+def job_company_matching(redis_c, crawler_company_input_queue, job, companies):
     """
     Check if the job has any matching company in the database, if not, a Company with job.employer_name as name
     or/and job.employer_glassdoor_id as id is created and a task to search for info about the company
@@ -181,6 +440,7 @@ def job_company_matching(redis_c, crawler_company_input_queue, job):
         redis_c:
         crawler_company_input_queue:
         job:
+        companies: BatchCompanies of the batch of the job, created companies are added to it.
 
     Returns: True if the job document has been updated, False otherwise.
 
@@ -191,15 +451,11 @@ def job_company_matching(redis_c, crawler_company_input_queue, job):
         if the job has an employer_glassdoor_id but there are no companies with that
         id create a record and enqueue a task to search for that company on glassdoor
         """
-        company = Company.objects(glassdoor_id=job.employer_glassdoor_id)
-        if not company:
-            company = Company(name=job.employer_name, glassdoor_id=job.employer_glassdoor_id)
-            company.date_last_modify = datetime.datetime.utcnow()
-            company.save()
+        company = companies.by_glassdoor_id.get(str(job.employer_glassdoor_id), None)
+        if company is None:
+            companies.create(job.employer_name, job.employer_glassdoor_id)
             add_crawl_company_task(redis_c, crawler_company_input_queue, job)
         else:
-            company = company[0]
-
             # crawl the company again if the info is old
             if (datetime.datetime.utcnow() - company.date_last_modify).days > __CRAWL_COMPANY_DAYS_THRESHOLD:
                 add_crawl_company_task(redis_c, crawler_company_input_queue, job)
@@ -208,18 +464,15 @@ def job_company_matching(redis_c, crawler_company_input_queue, job):
                 job.employer_name = company.name
                 return True
     else:
-        company = Company.objects(glassdoor_id=job.employer_name)
+        company = companies.by_name.get(job.employer_name, None)
 
         # if no company with such name exist, search for it on glassdoor after creating a document
-        if not company:
-            company = Company(name=job.employer_name)
-            company.date_last_modify = datetime.datetime.utcnow()
-            company.save()
+        if company is None:
+            companies.create(job.employer_name)
             add_crawl_company_task(redis_c, crawler_company_input_queue, job)
         else:
             # if a company with such name exist, if it has a glassdoor id try to understand if that company
             # is the same employer posting this job offer, if so, set the employer_glassdoor_id of the job
-            company = company[0]
 
             # crawl the company again if the info is old
             if (datetime.datetime.utcnow() - company.date_last_modify).days > __CRAWL_COMPANY_DAYS_THRESHOLD:
@@ -305,4 +558,4 @@ def add_crawl_company_task(redis_c, redis_queue, job):
     """
     locations = [job[item] for item in ["city", "state", "country"] if item in job] + [""]
     for loc in locations:
-        redis_c.lpush(redis_queue, "%s|||sep|||%s" % (job.employer_name, loc))
+        transport.push(redis_c, redis_queue, "%s|||sep|||%s" % (job.employer_name, loc))
@@ -3,9 +3,18 @@ For processing review related data.
 """
 
 import datetime  # for getting the time of update/creation of a document
+from bson import ObjectId
+from pymongo import UpdateOne
 from mongoengine import ValidationError
+import nltk
+from nltk.corpus import stopwords
 
 from data_collections.Review import Review
+from data_collections.WordCounts import count_words
+from BulkWrite import bulk_write
+from PageCache import invalidate_company_pages
+from MessageCodec import codec
+from QueueTransport import transport
 
 __review_dict_field_error_message = "Received input is either not a dict or it is missing required fields, which are:  \
                                      employer_name, review_glassdoor_id, employer_glassdoor_id"
@@ -19,6 +28,16 @@ __look_for_fields = ["employer_name", "employer_glassdoor_id", "review_glassdoor
                      "senior_management", "compensation_and_benefits", "overall_rating", "sentiment_score",
                      "recommendation_tags"]
 
+# fields whose sentiment is computed by the sentiment analysis workers
+__sentiment_input_fields = ["title", "job_title", "pros", "cons", "advice_to_management"]
+
+# fields whose words are counted for the word clouds of the client
+__word_count_fields = ["pros", "cons", "advice_to_management"]
+
+# to remove stopwords when counting words
+nltk.download('stopwords')
+__stopwords = set(stopwords.words("english"))
+
 __review_info_float_fields = [
     "work_life_balance",
     "culture_and_values",
@@ -30,6 +49,31 @@ __review_info_float_fields = [
 ]
 
 
+def clean_review_data(review_data):
+    """
+    Check that review data coming from a glassdoor crawler has the required fields and clean it in place.
+
+    Args:
+        review_data: Given the data has to come from a glassdoor spider, 3 keys are required:
+            review_glassdoor_id, employer_glassdoor_id, employer_name
+    """
+    assert isinstance(review_data, dict), __review_dict_field_error_message
+    assert "review_glassdoor_id" in review_data, __review_dict_field_error_message
+    assert "employer_glassdoor_id" in review_data, __review_dict_field_error_message
+    assert "employer_name" in review_data, __review_dict_field_error_message
+
+    # remove extra whitespace from strings
+    for key, value in review_data.items():
+        if isinstance(value, str):
+            review_data[key] = " ".join(value.split())
+        if isinstance(value, list):
+            if all([isinstance(item, str) for item in value]):
+                value = [" ".join(item.split()) for item in value]
+                review_data[key] = " ".join(value) if key != "recommendation_tags" else value
+        if key in __review_info_float_fields and value:
+            review_data[key] = float(value)
+
+
 def process_review(redis_c, sentiment_analysis_input_queue, language_model, review_data):
     """
     Process review data coming from a glassdoor crawler. Given the input data
@@ -42,71 +86,115 @@ def process_review(redis_c, sentiment_analysis_input_queue, language_model, revi
         review_data: Given the data has to come from a glassdoor spider, 3 keys are required:
             review_glassdoor_id, employer_glassdoor_id, employer_name
     """
-    try:
-        assert isinstance(review_data, dict), __review_dict_field_error_message
-        assert "review_glassdoor_id" in review_data, __review_dict_field_error_message
-        assert "employer_glassdoor_id" in review_data, __review_dict_field_error_message
-        assert "employer_name" in review_data, __review_dict_field_error_message
-
-        # remove extra whitespace from strings
-        for key, value in review_data.items():
-            if isinstance(value, str):
-                review_data[key] = " ".join(value.split())
-            if isinstance(value, list):
-                if all([isinstance(item, str) for item in value]):
-                    value = [" ".join(item.split()) for item in value]
-                    review_data[key] = " ".join(value) if key != "recommendation_tags" else value
-            if key in __review_info_float_fields and value:
-                review_data[key] = float(value)
-
-        text = [review_data.get("pros", None), review_data.get("cons", None),
-                review_data.get("advice_to_management", None)]
-        text = " ".join(item for item in text if item)
-        predicted_language = language_model.predict_proba_single(text, k=1)
-        predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
-
-        # check if it already exists
-        review = Review.objects(employer_glassdoor_id=review_data["employer_glassdoor_id"],
-                                review_glassdoor_id=review_data["review_glassdoor_id"])
-        # if it exist we will simply update it (without checking if fields are actually different)
-        review = review[0] if review else Review()
-        modified = False
-
-        # so that we create/update with the same code
-        for field in __look_for_fields:
-            # necessary because it might have been set to None instead of not being in the dict
-            value = review_data.get(field, None)
-            if value and ((field not in review) or review[field] != value):
-                review[field] = value
-                modified = True
-
-        review.review_language = predicted_language
-        if modified:
-            review.date_last_modify = datetime.datetime.utcnow()
-
-        review.save()
-
-        if modified and review.review_language == "en":
+    process_reviews(redis_c, sentiment_analysis_input_queue, language_model, [review_data])
+
+
+def process_reviews(redis_c, sentiment_analysis_input_queue, language_model, reviews_data):
+    """
+    Process a batch of review data coming from glassdoor crawlers, see process_review.
+    Existing reviews are fetched with a single query, and new or modified reviews are written
+    with a single bulk operation.
+
+    Args:
+        redis_c: redis connection
+        sentiment_analysis_input_queue: Redis queue to which to send tasks to compute the sentiment score of a review.
+        language_model: fasttext model to detect languages
+        reviews_data: List of review data, see process_review.
+    """
+    valid_reviews_data = []
+    for review_data in reviews_data:
+        try:
+            clean_review_data(review_data)
+            valid_reviews_data.append(review_data)
+        except AssertionError as e:
+            print(str(e))
+
+    if not valid_reviews_data:
+        return
+
+    # get the reviews that already exist
+    existing = Review.objects(employer_glassdoor_id__in=[data["employer_glassdoor_id"] for data in valid_reviews_data],
+                              review_glassdoor_id__in=[data["review_glassdoor_id"] for data in valid_reviews_data])
+    reviews = {(review.employer_glassdoor_id, review.review_glassdoor_id): review for review in existing}
+    modified_keys = []
+    # reviews whose sentiment has to be computed (again)
+    sentiment_keys = []
+
+    for review_data in valid_reviews_data:
+        try:
+            text = [review_data.get("pros", None), review_data.get("cons", None),
+                    review_data.get("advice_to_management", None)]
+            text = " ".join(item for item in text if item)
+            predicted_language = language_model.predict_proba_single(text, k=1)
+            predicted_language = predicted_language[0][0] if len(predicted_language) > 0 else None
+
+            # if it exist we will simply update it, the same review might appear more than once in a batch
+            key = (review_data["employer_glassdoor_id"], review_data["review_glassdoor_id"])
+            review = reviews[key] if key in reviews else Review()
+            modified = False
+            text_modified = review.pk is None
+
+            # so that we create/update with the same code
+            for field in __look_for_fields:
+                # necessary because it might have been set to None instead of not being in the dict
+                value = review_data.get(field, None)
+                if value and ((field not in review) or review[field] != value):
+                    review[field] = value
+                    modified = True
+                    text_modified = text_modified or field in __sentiment_input_fields
+
+            review.review_language = predicted_language
+            if text_modified:
+                review.word_counts = count_words([review[field] for field in __word_count_fields], __stopwords)
+            if modified:
+                review.date_last_modify = datetime.datetime.utcnow()
+
+            review.validate()
+            reviews[key] = review
+            if modified and key not in modified_keys:
+                modified_keys.append(key)
+            if text_modified and key not in sentiment_keys:
+                sentiment_keys.append(key)
+
+        except ValidationError as e:
+            # would be captured anyway because it is an AssertionError, being explicit
+            print("The provided document was not valid.")
+            print(str(e))
+            # do not write the invalid changes
+            reviews.pop(key, None)
+            if key in modified_keys:
+                modified_keys.remove(key)
+            if key in sentiment_keys:
+                sentiment_keys.remove(key)
+
+        except AssertionError as e:
+            print(str(e))
+
+    # new reviews are written only if modified, existing ones only if any field changed
+    bulk_write(Review, [(review, {"employer_glassdoor_id": key[0], "review_glassdoor_id": key[1]})
+                        for key, review in reviews.items() if review.pk is not None or key in modified_keys])
+    invalidate_company_pages(redis_c, [key[0] for key in modified_keys + sentiment_keys])
+
+    # the sentiment does not change if the texts did not, even if other fields did
+    for key in sentiment_keys:
+        review = reviews[key]
+        if review.pk is not None and review.review_language == "en":
             sentiment_input = dict()
             sentiment_input["id"] = str(review.id)
+            # echoed back by the sentiment analysis workers, to route the output to the worker of the review's
+            # crawler tasks (see WorkerPool.shard_key) and to invalidate the pages of the company
+            sentiment_input["employer_glassdoor_id"] = review.employer_glassdoor_id
+            sentiment_input["employer_name"] = review.employer_name
             input_texts = dict()
-            for name in ["title", "job_title", "pros", "cons", "advice_to_management"]:
+            for name in __sentiment_input_fields:
                 if name in review and review[name] and review[name] != "":
                     input_texts[name] = review[name]
             sentiment_input["inputs"] = input_texts
 
-            redis_c.lpush(sentiment_analysis_input_queue, str(sentiment_input))
-
-    except ValidationError as e:
-        # would be captured anyway because it is an AssertionError, being explicit
-        print("The provided document was not valid.")
-        print(str(e))
+            transport.push(redis_c, sentiment_analysis_input_queue, codec.encode(sentiment_input))
 
-    except AssertionError as e:
-        print(str(e))
 
-
-def process_review_sentiment(sentiment_analysis_data):
+def process_review_sentiment(sentiment_analysis_data, redis_c=None):
     """
     Process data coming from a sentiment analysis output, it should be a dict
     containing "id" and "sentiment_analysis_output, with the latter either being
@@ -115,26 +203,55 @@ def process_review_sentiment(sentiment_analysis_data):
     This function will take care of updating the related review document with its sentiment value.
     Args:
         sentiment_analysis_data
+        redis_c: redis connection, used to invalidate the pages of the company cached by the client.
+    """
+    process_reviews_sentiment([sentiment_analysis_data], redis_c)
+
+
+def process_reviews_sentiment(sentiments_analysis_data, redis_c=None):
+    """
+    Process a batch of data coming from a sentiment analysis output, see process_review_sentiment.
+    All the related reviews are updated with a single bulk operation.
+    Args:
+        sentiments_analysis_data: List of sentiment analysis outputs.
+        redis_c: redis connection, used to invalidate the pages of the companies cached by the client.
     """
-    try:
-        sa_field = "sentiments"
-        assert isinstance(sentiment_analysis_data, dict), __sentiment_dict_field_error_message
-        assert "id" in sentiment_analysis_data, __sentiment_dict_field_error_message
-        assert sa_field in sentiment_analysis_data, __sentiment_dict_field_error_message
-        assert isinstance(sentiment_analysis_data[sa_field], dict) or \
-               isinstance(sentiment_analysis_data[sa_field], type(None)), __sentiment_dict_field_error_message
-
-        sentiment_score = None
-        if sentiment_analysis_data[sa_field] and len(sentiment_analysis_data[sa_field]) > 0:
-            assert all([isinstance(value, float) for value in sentiment_analysis_data[sa_field].values()])
-            assert all([0 <= value <= 1 for value in sentiment_analysis_data[sa_field].values()])
-
-            sentiment_score = sum([value for value in sentiment_analysis_data[sa_field].values()])
-            sentiment_score /= len(sentiment_analysis_data[sa_field])
-
-        # the review related to this embedding should already be in the db, if it happens for some reason
-        # to not be there, this line will do nothing
-        Review.objects(id=sentiment_analysis_data["id"]).update(sentiment_score=sentiment_score)
-
-    except AssertionError as e:
-        print(str(e))
+    operations = []
+    company_ids = []
+    # reviews whose company was not sent along with the sentiment, by tasks pushed before it was
+    review_ids = []
+    for sentiment_analysis_data in sentiments_analysis_data:
+        try:
+            sa_field = "sentiments"
+            assert isinstance(sentiment_analysis_data, dict), __sentiment_dict_field_error_message
+            assert "id" in sentiment_analysis_data, __sentiment_dict_field_error_message
+            assert sa_field in sentiment_analysis_data, __sentiment_dict_field_error_message
+            assert isinstance(sentiment_analysis_data[sa_field], dict) or \
+                   isinstance(sentiment_analysis_data[sa_field], type(None)), __sentiment_dict_field_error_message
+            assert ObjectId.is_valid(sentiment_analysis_data["id"]), __sentiment_dict_field_error_message
+
+            sentiment_score = None
+            if sentiment_analysis_data[sa_field] and len(sentiment_analysis_data[sa_field]) > 0:
+                assert all([isinstance(value, float) for value in sentiment_analysis_data[sa_field].values()])
+                assert all([0 <= value <= 1 for value in sentiment_analysis_data[sa_field].values()])
+
+                sentiment_score = sum([value for value in sentiment_analysis_data[sa_field].values()])
+                sentiment_score /= len(sentiment_analysis_data[sa_field])
+
+            # the review related to this embedding should already be in the db, if it happens for some reason
+            # to not be there, the operation will do nothing
+            operations.append(UpdateOne({"_id": ObjectId(sentiment_analysis_data["id"])},
+                                        {"$set": {"sentiment_score": sentiment_score}}))
+            if sentiment_analysis_data.get("employer_glassdoor_id", None):
+                company_ids.append(sentiment_analysis_data["employer_glassdoor_id"])
+            else:
+                review_ids.append(ObjectId(sentiment_analysis_data["id"]))
+
+        except AssertionError as e:
+            print(str(e))
+
+    if operations:
+        Review._get_collection().bulk_write(operations, ordered=False)
+    if redis_c is not None and review_ids:
+        company_ids += Review.objects(id__in=review_ids).distinct("employer_glassdoor_id")
+    invalidate_company_pages(redis_c, company_ids)
@@ -0,0 +1,195 @@
+"""
+For running the broker as a supervisor process that pops tasks from redis and routes them to a pool
+of worker processes.
+Tasks are routed by a hash of the name of the company they are related to, so that the updates to a
+company, its jobs and its reviews, and the embeddings and sentiments computed for them, are applied by the
+same worker in the order they are received, and so are the matchings between jobs and companies (the
+placeholder companies created for jobs, deleted once the company is crawled), see shard_key.
+With the list transport tasks are removed from redis when the supervisor pops them: the batch being
+processed by a worker that crashes is lost. With QUEUE_TRANSPORT=stream tasks are acknowledged once
+processed, the ones of a crashed worker are claimed again.
+"""
+
+import multiprocessing
+import time
+import zlib
+
+from BrokerSetup import input_queue_names, get_queues, load_language_model, connect_redis, connect_mongodb, \
+    seed_company_metrics
+from ProcessBatch import decode_tasks, process_decoded_batch
+from QueueTransport import transport, lag_report
+
+# seconds between two reports of the lag of the input queues
+LAG_REPORT_EVERY = 30
+
+
+def shard_key(queues, received_queue, received_input):
+    """
+    Get the key by which a decoded task is routed to a worker.
+    Tasks are routed by the name of the employer, which all the crawler output has, whereas the glassdoor
+    id is missing from the jobs of employers not matched yet. The compute workers echo back the employer
+    sent along with their input, so that their outputs go to the same worker as the crawler output of the
+    document they update; outputs of inputs pushed without the employer name are routed by the glassdoor
+    id of the employer, or by the id of the document.
+
+    Args:
+        queues: Dictionary mapping the names of the environment variables of the queues to their names.
+        received_queue: Queue the task comes from.
+        received_input: Decoded task, None if it could not be decoded.
+
+    Returns: A string.
+
+    """
+    if not isinstance(received_input, dict):
+        return ""
+    key = received_input.get("employer_name", None) or received_input.get("employer_glassdoor_id", None)
+    if key is None and received_queue != queues["CRAWLER_OUTPUT_QUEUE"]:
+        key = received_input.get("id", None)
+    # the same as the handlers clean it, crawler output is routed before being cleaned
+    return " ".join(str(key).split()) if key is not None else ""
+
+
+def shard_index(key, workers):
+    """
+    Get the worker a key is routed to, the hash is stable across processes and restarts.
+    Args:
+        key: String, see shard_key.
+        workers: Number of workers.
+
+    Returns: Index of the worker.
+
+    """
+    return zlib.crc32(key.encode("utf-8")) % workers
+
+
+def split_in_shards(queues, decoded_tasks, shards):
+    """
+    Split a batch of decoded tasks in shards, keeping the order in which tasks were received in each shard.
+    Args:
+        queues: Dictionary mapping the names of the environment variables of the queues to their names.
+        decoded_tasks: List of (queue, message id, decoded task) tuples.
+        shards: Number of shards.
+
+    Returns: List of shards, each a list of (queue, message id, decoded task) tuples.
+
+    """
+    split = [[] for _ in range(shards)]
+    for decoded_task in decoded_tasks:
+        key = shard_key(queues, decoded_task[0], decoded_task[2])
+        split[shard_index(key, shards)].append(decoded_task)
+    return split
+
+
+def worker_loop(worker_index, task_queue):
+    """
+    Loop of a worker process: set up its own language model and connections then process
+    the batches of decoded tasks it receives from the supervisor, acknowledging them once done.
+    Args:
+        worker_index: Index of the worker, for logging, the first one also builds the rollups of the
+            company metrics if needed.
+        task_queue: multiprocessing queue on which batches of (queue, message id, decoded task) tuples
+            are received.
+    """
+    language_model = load_language_model()
+    redis_c = connect_redis()
+    connect_mongodb()
+    if worker_index == 0:
+        seed_company_metrics()
+    queues = get_queues()
+
+    print("worker %d starting to work" % worker_index)
+    while True:
+        decoded_tasks = task_queue.get()
+        start = time.time()
+        counts = process_decoded_batch(redis_c, queues, language_model, decoded_tasks)
+        transport.ack(redis_c, decoded_tasks)
+        elapsed = time.time() - start
+        print("worker %d processed batch %s in %.3fs (%.1f tasks/s)"
+              % (worker_index, counts, elapsed, len(decoded_tasks) / max(elapsed, 1e-6)))
+
+
+class WorkerPool(object):
+    """
+    Pool of worker processes, each receiving the tasks of its own shard.
+    """
+
+    def __init__(self, workers, max_pending_batches):
+        """
+        Args:
+            workers: Number of worker processes.
+            max_pending_batches: Maximum number of batches waiting to be processed by a worker,
+                once reached the supervisor waits, leaving the tasks in redis.
+        """
+        assert workers > 0, "The number of workers should be a positive integer."
+        self.max_pending_batches = max_pending_batches
+        self.task_queues = [None] * workers
+        self.processes = [None] * workers
+        for worker_index in range(workers):
+            self.start_worker(worker_index)
+
+    def start_worker(self, worker_index):
+        """
+        Start (or restart) a worker process, a restarted worker keeps the batches that were waiting for it.
+        Args:
+            worker_index: Index of the worker.
+        """
+        if self.task_queues[worker_index] is None:
+            self.task_queues[worker_index] = multiprocessing.Queue(self.max_pending_batches)
+        process = multiprocessing.Process(target=worker_loop, args=(worker_index, self.task_queues[worker_index]),
+                                          daemon=True)
+        process.start()
+        self.processes[worker_index] = process
+
+    def check_workers(self):
+        """
+        Restart workers that died.
+        """
+        for worker_index, process in enumerate(self.processes):
+            if not process.is_alive():
+                print("worker %d died with exit code %s, restarting it" % (worker_index, process.exitcode))
+                self.start_worker(worker_index)
+
+    def dispatch(self, queues, decoded_tasks):
+        """
+        Send a batch of decoded tasks to the workers, each worker gets the tasks of its shard
+        in the order in which they were received.
+        Args:
+            queues: Dictionary mapping the names of the environment variables of the queues to their names.
+            decoded_tasks: List of (queue, message id, decoded task) tuples.
+
+        Returns: List with the number of tasks sent to each worker.
+
+        """
+        shards = split_in_shards(queues, decoded_tasks, len(self.processes))
+        for worker_index, shard in enumerate(shards):
+            if shard:
+                self.task_queues[worker_index].put(shard)
+        return [len(shard) for shard in shards]
+
+
+def run_supervisor(workers, batch_size, max_pending_batches=4):
+    """
+    Run the broker as a supervisor of a pool of workers, it never returns.
+    Args:
+        workers: Number of worker processes.
+        batch_size: Maximum number of tasks popped from redis at once.
+        max_pending_batches: Maximum number of batches waiting to be processed by each worker.
+    """
+    # workers are forked before the supervisor opens any connection
+    pool = WorkerPool(workers, max_pending_batches)
+
+    redis_c = connect_redis()
+    queues = get_queues()
+    redis_queues = [queues[name] for name in input_queue_names]
+    last_lag_report = 0
+
+    print("supervisor starting to work with %d workers" % workers)
+    while True:
+        tasks = transport.pop(redis_c, redis_queues, batch_size)
+        pool.check_workers()
+        sent = pool.dispatch(queues, decode_tasks(tasks))
+        print("dispatched %d tasks to workers: %s" % (len(tasks), sent))
+
+        if time.time() - last_lag_report > LAG_REPORT_EVERY:
+            last_lag_report = time.time()
+            print("queues: %s" % lag_report(redis_c, redis_queues))
@@ -0,0 +1,155 @@
+from bson import ObjectId
+from mongoengine import *
+from pymongo.errors import DuplicateKeyError
+
+# aggregate glassdoor reviews metrics of a company that are averaged over groups of companies
+COMPANY_METRICS = ["overall_rating", "culture_and_values", "career_opportunities", "work_life_balance",
+                   "senior_management", "ceo_rating", "biz_outlook", "recommend", "comp_and_benefits"]
+
+ALL_COMPANIES_KEY = "all"
+
+# key of the document holding the generation of the rollups in use, the rollups are not used (nor kept up
+# to date) until it exists, so that rollups only incremented from an existing db are never read
+BUILT_KEY = "built"
+
+
+def industry_key(industry):
+    return "industry:%s" % industry
+
+
+def rollup_key(generation, key):
+    """
+    Returns: The key of the rollup of a group (ALL_COMPANIES_KEY or an industry_key) in a generation of the rollups.
+    """
+    return "%s:%s" % (generation, key)
+
+
+def company_metrics_state(company):
+    """
+    Get what a company adds to the rollups: the keys of the groups it belongs to and its metrics.
+    Args:
+        company: Company document, or dict of its fields.
+
+    Returns: (list of rollup keys, dictionary mapping metrics to their float values).
+
+    """
+    keys = [ALL_COMPANIES_KEY]
+    if "industry" in company and company["industry"]:
+        keys.append(industry_key(company["industry"]))
+    metrics = {metric: company[metric] for metric in COMPANY_METRICS
+               if metric in company and isinstance(company[metric], float)}
+    return keys, metrics
+
+
+def company_metrics_increments(old_state, new_state):
+    """
+    Get the increments to apply to the rollups when a company changes.
+    Args:
+        old_state: State of the company before the change (see company_metrics_state), None for a new company.
+        new_state: State of the company after the change, None for a deleted company.
+
+    Returns: Dictionary mapping rollup keys to $inc documents, keys without changes are left out.
+
+    """
+    increments = dict()
+    for state, sign in [(old_state, -1), (new_state, 1)]:
+        if state is None:
+            continue
+        keys, metrics = state
+        for key in keys:
+            increment = increments.setdefault(key, dict())
+            for metric, value in metrics.items():
+                increment["sums.%s" % metric] = increment.get("sums.%s" % metric, 0) + sign * value
+                increment["counts.%s" % metric] = increment.get("counts.%s" % metric, 0) + sign
+
+    return {key: {name: value for name, value in increment.items() if value != 0}
+            for key, increment in increments.items() if any(value != 0 for value in increment.values())}
+
+
+def company_metrics_rollups(companies):
+    """
+    Compute the rollups from scratch.
+    Args:
+        companies: Iterable of Company documents, with at least their industry and metrics.
+
+    Returns: Dictionary mapping the keys of the groups to {"sums": {...}, "counts": {...}} dictionaries.
+
+    """
+    rollups = dict()
+    for company in companies:
+        for key, increment in company_metrics_increments(None, company_metrics_state(company)).items():
+            rollup = rollups.setdefault(key, {"sums": dict(), "counts": dict()})
+            for name, value in increment.items():
+                group, metric = name.split(".", 1)
+                rollup[group][metric] = rollup[group].get(metric, 0) + value
+    return rollups
+
+
+def get_built_generation():
+    """
+    Returns: The generation of the rollups in use, None if they were never built.
+    """
+    built = CompanyMetrics._get_collection().find_one({"key": BUILT_KEY}, {"generation": 1})
+    return built.get("generation", None) if built else None
+
+
+def build_company_metrics(companies):
+    """
+    Build a new generation of the rollups from scratch, then make it the one in use and delete the
+    previous one. The previous rollups are read until the new ones are complete, and when several
+    processes build them at the same time only the first to finish is kept. Increments applied by the
+    broker to the previous generation while companies are scanned are not in the new one.
+    Args:
+        companies: Iterable of Company documents, with at least their industry and metrics.
+
+    Returns: (generation in use, number of rollups built), the generation is not the new one if another
+    build finished first.
+
+    """
+    collection = CompanyMetrics._get_collection()
+    previous = get_built_generation()
+    # ObjectIds sort by creation time, so older generations are the ones lower than a new one
+    generation = str(ObjectId())
+    rollups = company_metrics_rollups(companies)
+    if rollups:
+        collection.insert_many([{"key": rollup_key(generation, key), "generation": generation,
+                                 "sums": rollup["sums"], "counts": rollup["counts"]}
+                                for key, rollup in rollups.items()])
+
+    try:
+        # only swapped if the generation in use is still the one the build started from
+        collection.update_one({"key": BUILT_KEY, "generation": previous}, {"$set": {"generation": generation}},
+                              upsert=True)
+    except DuplicateKeyError:
+        collection.delete_many({"generation": generation})
+        return get_built_generation(), 0
+
+    # rollups of previous generations and the ones kept before generations existed, but not the ones of a
+    # build started after this one
+    collection.delete_many({"key": {"$ne": BUILT_KEY},
+                            "$or": [{"generation": {"$lt": generation}}, {"generation": {"$exists": False}}]})
+    return generation, len(rollups)
+
+
+class CompanyMetrics(Document):
+    """
+    Sums and counts of the metrics of a group of companies, all the companies (ALL_COMPANIES_KEY) or the
+    companies of an industry (industry_key), kept up to date by the broker so that averages are read
+    without scanning the companies. The rollups of a group are stored under rollup_key(generation, key),
+    the generation in use being in the document of key BUILT_KEY.
+    """
+    key = StringField(required=True, unique=True)
+    generation = StringField()
+    sums = DictField()
+    counts = DictField()
+
+    def averages(self, metrics=None):
+        """
+        Args:
+            metrics: Metrics to average, all by default.
+
+        Returns: Dictionary mapping the metrics to their average, metrics without values are left out.
+
+        """
+        return {metric: self.sums[metric] / self.counts[metric] for metric in metrics or COMPANY_METRICS
+                if self.counts.get(metric, 0) > 0 and metric in self.sums}
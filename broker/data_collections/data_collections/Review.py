@@ -33,6 +33,8 @@ class Review(DynamicDocument):
 
     # recommendation tags (recommends, business outlook, ceo)
     recommendation_tags = ListField(StringField(required=False, max_length=30), required=False)
+    # counts of the most frequent words of pros, cons and advice, as [word, count] pairs (see WordCounts.count_words)
+    word_counts = ListField(required=False)
     date_last_modify = DateTimeField(default=datetime.datetime.utcnow)
 
     meta = {
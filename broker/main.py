@@ -1,74 +1,63 @@
-import ast
-import os
-from pyfasttext import FastText
-import redis
-from mongoengine import *
+import argparse
+import time
 
-from data_collections.Company import Company
-from data_collections.Job import Job
-from data_collections.Review import Review
-from ProcessJob import process_job, process_job_embedding
-from ProcessReview import process_review, process_review_sentiment
-from ProcessCompany import process_company_general_info, process_company_aggregate_reviews_info
+from BrokerSetup import input_queue_names, check_environment, get_queues, load_language_model, connect_redis, \
+    connect_mongodb, seed_company_metrics
+from ProcessBatch import process_batch
+from QueueTransport import transport, lag_report
+from WorkerPool import run_supervisor
 
-if __name__ == "__main__":
-    for name in ["JOB_EMBEDDING_OUTPUT_QUEUE", "CRAWLER_OUTPUT_QUEUE",
-                 "SENTIMENT_ANALYSIS_OUTPUT_QUEUE", "CRAWLER_COMPANY_INPUT_QUEUE",
-                 "JOB_EMBEDDING_INPUT_QUEUE", "SENTIMENT_ANALYSIS_INPUT_QUEUE", "MONGODB_NAME",
-                 "REDIS_HOST", "REDIS_PORT", "MONGODB_HOST", "MONGODB_PORT"]:
-        assert name in os.environ, "%s environment variable is missing." % name
-
-    print("import language prediction model")
-    language_model = FastText('language_prediction_model/lid.176.ftz')
-    print("imported language prediction model")
-
-    print("connecting to redis...")
-    redis_c = redis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], charset="utf-8")
-    print("connected to redis")
+# seconds between two reports of the lag of the input queues
+LAG_REPORT_EVERY = 30
 
-    print("creating connection to mongodb")
-    connect(os.environ["MONGODB_NAME"], host=os.environ["MONGODB_HOST"], port=int(os.environ["MONGODB_PORT"]))
-    print("connection to mongodb created")
-
-    # set up redis queues to wait on for tasks
-    redis_queues = []
-    for name in ["JOB_EMBEDDING_OUTPUT_QUEUE", "CRAWLER_OUTPUT_QUEUE",
-                 "SENTIMENT_ANALYSIS_OUTPUT_QUEUE"]:
-        redis_queues.append(os.environ[name])
+if __name__ == "__main__":
+    check_environment()
+
+    parser = argparse.ArgumentParser()
+    # max number of tasks popped from the queues and processed together
+    parser.add_argument('--batch_size', type=int, default=1)
+    # number of worker processes, with more than one worker this process only routes tasks to them
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes, tasks are routed to them by company; with the list transport "
+                             "the batch of a worker that crashes is lost, use QUEUE_TRANSPORT=stream to have "
+                             "it claimed again")
+    # run on an asyncio event loop, processing up to --concurrency batches at the same time
+    parser.add_argument('--async', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+    args = args.__dict__
+    print("Passed args:")
+    print(args)
+
+    if args["async"]:
+        # needs redis.asyncio, imported only when used
+        from AsyncBroker import run_async
+        run_async(args["concurrency"], args["batch_size"])
+
+    if args["workers"] > 1:
+        run_supervisor(args["workers"], args["batch_size"])
+
+    language_model = load_language_model()
+    redis_c = connect_redis()
+    connect_mongodb()
+    seed_company_metrics()
+
+    queues = get_queues()
+    redis_queues = [queues[name] for name in input_queue_names]
+    last_lag_report = 0
 
     print("starting to work")
     while True:
-        print("waiting for task")
-        task = redis_c.blpop(redis_queues, 0)
-        received_queue = task[0].decode("utf-8")
-        received_input = task[1].decode("utf-8")
-        print("received task from %s" % received_queue)
-
-        try:
-            received_input = ast.literal_eval(received_input)
-
-            if received_queue == os.environ["CRAWLER_OUTPUT_QUEUE"]:
-                assert "type" in received_input, "Data from %s is a valid dictionary but is missing key 'type'" \
-                                                 % received_queue
-                data_type = received_input["type"]
-                print("crawler output type %s" % data_type)
-
-                if data_type == "job":
-                    process_job(redis_c, os.environ["CRAWLER_COMPANY_INPUT_QUEUE"],
-                                os.environ["JOB_EMBEDDING_INPUT_QUEUE"], language_model, received_input)
-                elif data_type == "review":
-                    process_review(redis_c, os.environ["SENTIMENT_ANALYSIS_INPUT_QUEUE"], language_model,
-                                   received_input)
-                elif data_type == "company_general_info":
-                    process_company_general_info(received_input)
-                elif data_type == "company_aggregate_reviews_info":
-                    process_company_aggregate_reviews_info(received_input)
-
-            elif received_queue == os.environ["JOB_EMBEDDING_OUTPUT_QUEUE"]:
-                process_job_embedding(received_input)
-            elif received_queue == os.environ["SENTIMENT_ANALYSIS_OUTPUT_QUEUE"]:
-                process_review_sentiment(received_input)
-        except AssertionError as e:
-            print(str(e))
-        except SyntaxError:
-            print("Data from %s not a valid python dict, discarding:\n %s" % (received_queue, received_input))
+        print("waiting for tasks")
+        tasks = transport.pop(redis_c, redis_queues, args["batch_size"])
+        print("received %d tasks" % len(tasks))
+
+        start = time.time()
+        counts = process_batch(redis_c, queues, language_model, tasks)
+        transport.ack(redis_c, tasks)
+        elapsed = time.time() - start
+        print("processed batch %s in %.3fs (%.1f tasks/s)" % (counts, elapsed, len(tasks) / max(elapsed, 1e-6)))
+
+        if time.time() - last_lag_report > LAG_REPORT_EVERY:
+            last_lag_report = time.time()
+            print("queues: %s" % lag_report(redis_c, redis_queues))
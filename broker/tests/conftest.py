@@ -0,0 +1,35 @@
+"""
+For testing the broker with pytest (python -m pytest broker/tests), its modules are imported as top level
+modules as when running main.py, redis is faked with fakeredis and mongodb with mongomock.
+"""
+
+import os
+import sys
+import fakeredis
+import mongomock
+import pytest
+from mongoengine import connect, disconnect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_collections.Company import Company
+from data_collections.CompanyMetrics import CompanyMetrics
+from data_collections.Job import Job
+from data_collections.Review import Review
+
+
+@pytest.fixture
+def redis_c():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def mongodb():
+    # the client tests might have registered their own connection
+    disconnect()
+    connect("broker_test", host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+    yield
+    # dropped through the documents, so that their indexes are created again on the next connection
+    for document in [Company, CompanyMetrics, Job, Review]:
+        document.drop_collection()
+    disconnect()
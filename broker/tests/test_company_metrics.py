@@ -0,0 +1,86 @@
+from data_collections.Company import Company
+from data_collections.CompanyMetrics import CompanyMetrics, ALL_COMPANIES_KEY, BUILT_KEY, industry_key, rollup_key, \
+    company_metrics_state, company_metrics_increments, build_company_metrics, get_built_generation
+from ProcessCompany import update_company_metrics
+
+
+def test_increments_of_a_new_company():
+    state = company_metrics_state({"industry": "IT", "overall_rating": 4.0, "ceo_rating": "n/a"})
+    assert company_metrics_increments(None, state) == {
+        ALL_COMPANIES_KEY: {"sums.overall_rating": 4.0, "counts.overall_rating": 1},
+        industry_key("IT"): {"sums.overall_rating": 4.0, "counts.overall_rating": 1}}
+
+
+def test_increments_of_a_changed_company():
+    old = company_metrics_state({"industry": "IT", "overall_rating": 4.0})
+    new = company_metrics_state({"industry": "IT", "overall_rating": 3.0, "recommend": 0.5})
+    increments = company_metrics_increments(old, new)
+    assert increments[ALL_COMPANIES_KEY] == {"sums.overall_rating": -1.0, "sums.recommend": 0.5,
+                                             "counts.recommend": 1}
+    assert increments[industry_key("IT")] == increments[ALL_COMPANIES_KEY]
+
+
+def test_increments_of_a_company_moving_industry_or_deleted():
+    old = company_metrics_state({"industry": "IT", "overall_rating": 4.0})
+    new = company_metrics_state({"industry": "Finance", "overall_rating": 4.0})
+    assert company_metrics_increments(old, new) == {
+        industry_key("IT"): {"sums.overall_rating": -4.0, "counts.overall_rating": -1},
+        industry_key("Finance"): {"sums.overall_rating": 4.0, "counts.overall_rating": 1}}
+    assert company_metrics_increments(old, None)[ALL_COMPANIES_KEY] == {"sums.overall_rating": -4.0,
+                                                                        "counts.overall_rating": -1}
+    assert company_metrics_increments(old, old) == {}
+
+
+def rollup(generation, key):
+    return CompanyMetrics.objects(key=rollup_key(generation, key)).first()
+
+
+def test_rollups_are_incremented_only_once_built(mongodb):
+    for glassdoor_id, industry, rating in [("1", "IT", 4.0), ("2", "IT", 2.0), ("3", "Finance", 3.0)]:
+        Company(glassdoor_id=glassdoor_id, name="company %s" % glassdoor_id, industry=industry,
+                overall_rating=rating).save(validate=False)
+    # a rollup kept before they were built, only holding the changes since
+    CompanyMetrics._get_collection().insert_one({"key": ALL_COMPANIES_KEY, "sums": {"overall_rating": 5.0},
+                                                 "counts": {"overall_rating": 1}})
+    new_company = company_metrics_state({"industry": "IT", "overall_rating": 5.0})
+
+    update_company_metrics([(None, new_company)])
+    assert get_built_generation() is None
+    assert CompanyMetrics.objects.count() == 1
+
+    generation, count = build_company_metrics(Company.objects())
+    assert count == 3 and get_built_generation() == generation
+    assert rollup(generation, ALL_COMPANIES_KEY).averages(["overall_rating"]) == {"overall_rating": 3.0}
+    assert rollup(generation, industry_key("IT")).averages() == {"overall_rating": 3.0}
+    assert CompanyMetrics.objects(key=ALL_COMPANIES_KEY).count() == 0
+
+    update_company_metrics([(None, new_company)])
+    assert rollup(generation, ALL_COMPANIES_KEY).averages() == {"overall_rating": 3.5}
+    update_company_metrics([(None, company_metrics_state({"industry": "Retail", "overall_rating": 1.0}))])
+    assert rollup(generation, industry_key("Retail")).averages() == {"overall_rating": 1.0}
+
+
+def test_rebuild_swaps_generations(mongodb):
+    Company(glassdoor_id="1", name="company", industry="IT", overall_rating=4.0).save(validate=False)
+    first, _ = build_company_metrics(Company.objects())
+    Company.objects(glassdoor_id="1").update(set__overall_rating=2.0)
+
+    second, count = build_company_metrics(Company.objects())
+    assert second > first and count == 2
+    assert rollup(second, ALL_COMPANIES_KEY).averages() == {"overall_rating": 2.0}
+    assert sorted(document.key for document in CompanyMetrics.objects) == sorted(
+        [BUILT_KEY, rollup_key(second, ALL_COMPANIES_KEY), rollup_key(second, industry_key("IT"))])
+
+
+def test_concurrent_build_keeps_the_first_to_finish(mongodb, monkeypatch):
+    Company(glassdoor_id="1", name="company", industry="IT", overall_rating=4.0).save(validate=False)
+    first, _ = build_company_metrics(Company.objects())
+
+    # a build that started before the first one finished
+    import data_collections.CompanyMetrics as company_metrics
+    monkeypatch.setattr(company_metrics, "get_built_generation", lambda: None)
+    _, count = build_company_metrics(Company.objects())
+    monkeypatch.undo()
+
+    assert count == 0 and get_built_generation() == first
+    assert CompanyMetrics.objects(generation__ne=first, key__ne=BUILT_KEY).count() == 0
@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from data_collections.Job import EMBEDDING_DIMENSIONS, pack_embedding, unpack_embedding
+from ProcessJob import embedding_update
+
+random.seed(0)
+EMBEDDING = [random.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+def test_float32_round_trip():
+    data = pack_embedding(EMBEDDING, "float32")
+    assert len(data) == 4 * EMBEDDING_DIMENSIONS
+    assert unpack_embedding(data) == pytest.approx(EMBEDDING, abs=1e-6)
+
+
+def test_int8_round_trip():
+    data = pack_embedding(EMBEDDING, "int8")
+    assert len(data) == 4 + EMBEDDING_DIMENSIONS
+    # each value is within half a quantization step of the original one
+    scale = max(abs(value) for value in EMBEDDING) / 127.
+    assert unpack_embedding(data) == pytest.approx(EMBEDDING, abs=scale / 2 + 1e-6)
+    assert unpack_embedding(pack_embedding([0.] * EMBEDDING_DIMENSIONS, "int8")) == [0.] * EMBEDDING_DIMENSIONS
+
+
+def test_unknown_storage_or_size():
+    with pytest.raises(AssertionError):
+        pack_embedding(EMBEDDING, "float16")
+    with pytest.raises(AssertionError):
+        unpack_embedding(b"\x00" * 10)
+
+
+def test_embedding_update_uses_a_single_field():
+    update = embedding_update(EMBEDDING, "int8")
+    assert update["$set"]["embedding_data"] == pack_embedding(EMBEDDING, "int8")
+    assert update["$unset"] == {"embedding": ""}
+    update = embedding_update(EMBEDDING, "list")
+    assert update["$set"]["embedding"] == EMBEDDING and update["$unset"] == {"embedding_data": ""}
+    assert embedding_update(None, "float32")["$set"]["embedding"] is None
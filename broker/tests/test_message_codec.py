@@ -0,0 +1,47 @@
+import pytest
+
+from MessageCodec import MessageCodec, VERSION, VERSION_FIELD, pack_floats, unpack_floats
+
+MESSAGE = {"type": "job", "id": "5e8f1c2a9d3b4a0012345678", "text": "Data scientist, python",
+           "rating": 4.5, "tags": ["a", "b"], "data": b"\x00\xff"}
+
+
+@pytest.mark.parametrize("name", ["json", "literal"])
+def test_round_trip(name):
+    codec = MessageCodec(name)
+    assert codec.decode(codec.encode(MESSAGE)) == MESSAGE
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    codec = MessageCodec("msgpack")
+    encoded = codec.encode(MESSAGE)
+    assert isinstance(encoded, bytes)
+    assert MessageCodec("json").decode(encoded) == MESSAGE
+
+
+def test_decodes_any_format():
+    codec = MessageCodec("json")
+    # messages of old workers, and the bytes read from redis
+    assert codec.decode(str({"type": "review", "id": 1})) == {"type": "review", "id": 1}
+    assert codec.decode(MessageCodec("literal").encode(MESSAGE).encode("utf-8")) == MESSAGE
+    assert codec.decode(MessageCodec("json").encode(MESSAGE).encode("utf-8")) == MESSAGE
+
+
+def test_rejects_newer_versions_and_garbage():
+    codec = MessageCodec("json")
+    with pytest.raises(ValueError):
+        codec.decode('{"%s": %d, "type": "job"}' % (VERSION_FIELD, VERSION + 1))
+    with pytest.raises(ValueError):
+        codec.decode("{not a message")
+
+
+def test_encode_floats():
+    values = [0.5, -1.25, 3.0]
+    assert unpack_floats(MessageCodec("json").encode_floats(values)) == values
+    assert MessageCodec("literal").encode_floats(values) == values
+    assert len(pack_floats(values)) == 4 * len(values)
+
+    message = {"id": "1", "embedding": MessageCodec("json").encode_floats(values)}
+    decoded = MessageCodec("json").decode(MessageCodec("json").encode(message))
+    assert unpack_floats(decoded["embedding"]) == values
@@ -0,0 +1,31 @@
+import random
+
+from bson import ObjectId
+
+from data_collections.Job import Job, EMBEDDING_DIMENSIONS
+from ProcessJob import process_job_embeddings, description_hash
+
+random.seed(0)
+EMBEDDING = [random.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+def save_job(description_text):
+    job = Job(employer_name="company", description_text=description_text, description_html=description_text,
+              description_language="en")
+    job.save(validate=False)
+    return job
+
+
+def test_embeddings_of_outdated_descriptions_are_discarded(mongodb):
+    current, changed, legacy = save_job("current"), save_job("new description"), save_job("legacy")
+    process_job_embeddings([
+        {"id": str(current.id), "embedding": EMBEDDING, "description_hash": description_hash("current")},
+        {"id": str(changed.id), "embedding": EMBEDDING, "description_hash": description_hash("old description")},
+        # outputs of workers that do not echo the hash are stored as before
+        {"id": str(legacy.id), "embedding": EMBEDDING},
+        {"id": str(ObjectId()), "embedding": EMBEDDING, "description_hash": description_hash("current")}])
+
+    embeddings = {str(job.id): job.embedding for job in Job.objects()}
+    assert embeddings[str(current.id)] == EMBEDDING
+    assert embeddings[str(legacy.id)] == EMBEDDING
+    assert not embeddings[str(changed.id)]
@@ -0,0 +1,87 @@
+from QueueTransport import ListTransport, StreamTransport
+
+
+def test_list_pop_takes_earlier_queues_first(redis_c):
+    transport = ListTransport()
+    for i in range(3):
+        transport.push(redis_c, "high", "h%d" % i)
+    for i in range(2):
+        transport.push(redis_c, "low", "l%d" % i)
+
+    tasks = transport.pop(redis_c, ["high", "low"], 4)
+    assert [queue for queue, _, _ in tasks] == ["high", "high", "high", "low"]
+    assert sorted(message for _, _, message in tasks[:3]) == [b"h0", b"h1", b"h2"]
+    assert all(message_id is None for _, message_id, _ in tasks)
+
+    tasks = transport.pop(redis_c, ["high", "low"], 4)
+    assert len(tasks) == 1 and tasks[0][0] == "low"
+    assert transport.pop_nowait(redis_c, ["high", "low"], 4) == []
+
+
+def test_list_pop_blocks_until_a_task_arrives(redis_c):
+    transport = ListTransport()
+    transport.push(redis_c, "low", "l0")
+    # nothing for pop_nowait to take on the high queue, the task of the low one is taken all the same
+    assert transport.pop(redis_c, ["high", "low"], 2) == [("low", None, b"l0")]
+
+
+def test_stream_pop_caps_count_over_all_queues(redis_c):
+    transport = StreamTransport("group", consumer="a")
+    for i in range(3):
+        transport.push(redis_c, "high", "h%d" % i)
+        transport.push(redis_c, "low", "l%d" % i)
+
+    tasks = transport.pop_nowait(redis_c, ["high", "low"], 4)
+    assert [message for _, _, message in tasks] == [b"h0", b"h1", b"h2", b"l0"]
+    assert transport.lag(redis_c, "low")["pending"] == 1
+
+
+def test_stream_blocking_read_buffers_tasks_beyond_count(redis_c):
+    transport = StreamTransport("group", consumer="a")
+    transport.create_groups(redis_c, ["high", "low"])
+    for i in range(2):
+        transport.push(redis_c, "high", "h%d" % i)
+        transport.push(redis_c, "low", "l%d" % i)
+
+    tasks = transport.read(redis_c, ["high", "low"], 2, 10)
+    assert [message for _, _, message in tasks] == [b"h0", b"h1"]
+    # already delivered to this consumer, so returned by the next pops rather than read again
+    tasks = transport.pop_nowait(redis_c, ["high", "low"], 3)
+    assert [message for _, _, message in tasks] == [b"l0", b"l1"]
+
+
+def test_stream_ack_removes_pending_tasks(redis_c):
+    transport = StreamTransport("group", consumer="a")
+    transport.push(redis_c, "queue", "m0")
+    tasks = transport.pop(redis_c, ["queue"], 1)
+    assert transport.lag(redis_c, "queue")["pending"] == 1
+    transport.ack(redis_c, tasks)
+    assert transport.lag(redis_c, "queue")["pending"] == 0
+
+
+def test_stream_claims_only_tasks_pending_for_other_consumers(redis_c):
+    crashed = StreamTransport("group", consumer="a", claim_idle_ms=0)
+    other = StreamTransport("group", consumer="b", claim_idle_ms=0)
+    for i in range(2):
+        crashed.push(redis_c, "queue", "m%d" % i)
+
+    popped = crashed.pop_nowait(redis_c, ["queue"], 2)
+    assert len(popped) == 2
+    # its own pending tasks are still being handled, they are not delivered to it again
+    assert crashed.pop_nowait(redis_c, ["queue"], 2) == []
+
+    claimed = other.pop_nowait(redis_c, ["queue"], 2)
+    assert sorted(message_id for _, message_id, _ in claimed) == sorted(message_id for _, message_id, _ in popped)
+    pending = redis_c.xpending_range("queue", "group", "-", "+", 10)
+    assert {item["consumer"] for item in pending} == {b"b"}
+
+
+def test_stream_discards_tasks_delivered_too_many_times(redis_c):
+    first = StreamTransport("group", consumer="a", claim_idle_ms=0, max_deliveries=2)
+    second = StreamTransport("group", consumer="b", claim_idle_ms=0, max_deliveries=2)
+    first.push(redis_c, "queue", "poison")
+
+    assert len(first.pop_nowait(redis_c, ["queue"], 1)) == 1
+    assert len(second.pop_nowait(redis_c, ["queue"], 1)) == 1
+    assert first.pop_nowait(redis_c, ["queue"], 1) == []
+    assert first.lag(redis_c, "queue")["pending"] == 0
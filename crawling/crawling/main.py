@@ -5,6 +5,8 @@ from scrapy.crawler import CrawlerRunner
 from scrapy.settings import Settings
 from spiders import GlassdoorCompanies, GlassdoorJobs
 from scrapy.utils.log import configure_logging
+from message_codec import codec
+from queue_transport import transport, lag_report
 
 
 def set_settings(settings):
@@ -31,7 +33,7 @@ class SendToRedis(object):
     """ A custom pipeline that stores scrape results in 'results'"""
 
     def process_item(self, item, spider):
-        redis_connection.lpush(crawler_output_queue, str(item))
+        transport.push(redis_connection, crawler_output_queue, codec.encode(item))
         return item
 
 
@@ -40,28 +42,32 @@ def check_for_task():
 
     while not found_correct_input:
         print("waiting for a task")
-        task = redis_connection.blpop([company_input_queue, job_input_queue], 0)
-        task0 = task[0].decode("utf-8")
-        task1 = task[1].decode("utf-8")
+        print("queues: %s" % lag_report(redis_connection, [company_input_queue, job_input_queue]))
+        task = transport.pop(redis_connection, [company_input_queue, job_input_queue])[0]
+        task0 = task[0]
+        task1 = task[2].decode("utf-8")
         if task1.count("|||sep|||") != 1:
             print("Discarding %s, not properly formatted (missing or more than 1 internal-separator |||sep|||)" % str(
                 task))
+            transport.ack(redis_connection, [task])
         else:
             keyword, location = task1.split("|||sep|||")
             if task0 == job_input_queue:
-                run_spiders(JOB_SPIDERS, settings, {"job": keyword, "country": location})
+                run_spiders(JOB_SPIDERS, settings, {"job": keyword, "country": location}, task)
             elif task0 == company_input_queue:
-                run_spiders(COMPANY_SPIDERS, settings, {"company": keyword, "country": location})
+                run_spiders(COMPANY_SPIDERS, settings, {"company": keyword, "country": location}, task)
             found_correct_input = True
 
 
-def run_spiders(spiders_to_run, settings, kwargs):
+def run_spiders(spiders_to_run, settings, kwargs, task):
     """
-    Runs a list of spiders with some given arguments and settings.
+    Runs a list of spiders with some given arguments and settings, the task that started
+    the crawl is acknowledged once the crawl is over.
     Args:
         spiders_to_run:
         settings:
         kwargs:
+        task: Task popped from the input queue.
 
     Returns:
 
@@ -72,6 +78,7 @@ def run_spiders(spiders_to_run, settings, kwargs):
         runner.crawl(spider, stop_after_crawl=False, **kwargs)
     # what to do once crawling is over
     d = runner.join()
+    d.addBoth(lambda _: transport.ack(redis_connection, [task]))
     d.addBoth(lambda _: check_for_task())
 
 
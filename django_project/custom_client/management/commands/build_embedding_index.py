@@ -0,0 +1,50 @@
+"""
+For adding the embeddings of the jobs already in the db to the embedding index (EMBEDDING_INDEX_FOLDER),
+e.g. the first time the index is used, the broker then keeps it up to date:
+
+    python manage.py build_embedding_index
+"""
+
+import os
+from django.core.management.base import BaseCommand
+from mongoengine import Q
+from modules.data_collections.Job import Job, EMBEDDING_DIMENSIONS, unpack_embedding
+from modules.embedding_index import EmbeddingIndex, append_embeddings
+from modules.mongodb import connect_mongodb
+
+
+class Command(BaseCommand):
+    help = "Add the embeddings of all the jobs to the embedding index."
+
+    def add_arguments(self, parser):
+        # embeddings appended to the index at once
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for name in ["MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT", "EMBEDDING_INDEX_FOLDER"]:
+            assert name in os.environ, "%s environment variable is missing." % name
+        assert options["batch_size"] > 0, "The batch size should be a positive integer."
+        connect_mongodb()
+        folder = os.environ["EMBEDDING_INDEX_FOLDER"]
+
+        jobs = Job.objects(Q(embedding__size=EMBEDDING_DIMENSIONS) | Q(embedding_data__exists=True))
+        jobs = jobs.only("id", "embedding", "embedding_data").no_cache()
+
+        ids, embeddings, added = [], [], 0
+        for job in jobs:
+            ids.append(str(job.id))
+            embeddings.append(unpack_embedding(bytes(job.embedding_data)) if job.embedding_data
+                              else list(job.embedding))
+            if len(ids) >= options["batch_size"]:
+                append_embeddings(folder, ids, embeddings)
+                added += len(ids)
+                ids, embeddings = [], []
+                self.stdout.write("added %d embeddings" % added)
+        append_embeddings(folder, ids, embeddings)
+        added += len(ids)
+
+        # the whole log goes in a snapshot, so that the client does not have to apply it when starting
+        index = EmbeddingIndex(folder)
+        index.refresh()
+        index.compact()
+        self.stdout.write("added %d embeddings, the index has %d jobs" % (added, len(index)))
@@ -0,0 +1,62 @@
+"""
+For converting the embeddings of the jobs already in the db to the given storage (see EMBEDDING_STORAGE
+in the broker), e.g. after switching the broker from lists of floats to float32:
+
+    python manage.py compact_embeddings --storage float32
+"""
+
+import os
+from django.core.management.base import BaseCommand
+from mongoengine import Q
+from pymongo import UpdateOne
+from modules.data_collections.Job import Job, EMBEDDING_DIMENSIONS, EMBEDDING_STORAGES, pack_embedding, \
+    unpack_embedding
+from modules.mongodb import connect_mongodb
+
+
+class Command(BaseCommand):
+    help = "Convert the stored job embeddings to a list of floats, float32 or int8."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--storage', type=str, default="float32", choices=EMBEDDING_STORAGES)
+        # jobs updated with a single bulk operation
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for name in ["MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT"]:
+            assert name in os.environ, "%s environment variable is missing." % name
+        assert options["batch_size"] > 0, "The batch size should be a positive integer."
+        connect_mongodb()
+
+        storage = options["storage"]
+        # only the jobs whose embedding is not stored as wanted, int8 embeddings are not converted back
+        # to float32 since the precision is lost anyway
+        if storage == "list":
+            query = Q(embedding_data__exists=True)
+        else:
+            query = Q(embedding__size=EMBEDDING_DIMENSIONS)
+        jobs = Job.objects(query).only("id", "embedding", "embedding_data").no_cache()
+
+        operations, converted = [], 0
+        for job in jobs:
+            if job.embedding_data:
+                embedding = unpack_embedding(bytes(job.embedding_data))
+            else:
+                embedding = list(job.embedding)
+
+            if storage == "list":
+                update = {"$set": {"embedding": embedding}, "$unset": {"embedding_data": ""}}
+            else:
+                update = {"$set": {"embedding_data": pack_embedding(embedding, storage)}, "$unset": {"embedding": ""}}
+            operations.append(UpdateOne({"_id": job.id}, update))
+
+            if len(operations) >= options["batch_size"]:
+                Job._get_collection().bulk_write(operations, ordered=False)
+                converted += len(operations)
+                operations = []
+                self.stdout.write("converted %d embeddings" % converted)
+
+        if operations:
+            Job._get_collection().bulk_write(operations, ordered=False)
+            converted += len(operations)
+        self.stdout.write("converted %d embeddings to %s" % (converted, storage))
@@ -0,0 +1,50 @@
+"""
+For counting the words of the jobs and reviews already in the db (see modules/data_collections/WordCounts.py),
+e.g. the first time word counts are used, the broker then counts the words of the new ones:
+
+    python manage.py compute_word_counts
+"""
+
+import os
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+import nltk
+from nltk.corpus import stopwords
+from modules.data_collections.Job import Job
+from modules.data_collections.Review import Review
+from modules.data_collections.WordCounts import count_words
+from modules.mongodb import connect_mongodb
+
+# fields whose words are counted, for each document
+counted_fields = {Job: ["description_text"], Review: ["pros", "cons", "advice_to_management"]}
+
+
+class Command(BaseCommand):
+    help = "Count the words of the jobs and reviews whose words were not counted by the broker."
+
+    def add_arguments(self, parser):
+        # documents updated with a single bulk operation
+        parser.add_argument('--batch_size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for name in ["MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT"]:
+            assert name in os.environ, "%s environment variable is missing." % name
+        assert options["batch_size"] > 0, "The batch size should be a positive integer."
+        connect_mongodb()
+
+        nltk.download('stopwords')
+        stopwords_set = set(stopwords.words("english"))
+
+        for document, fields in counted_fields.items():
+            operations, counted = [], 0
+            for item in document.objects(word_counts__exists=False).only(*fields).no_cache():
+                word_counts = count_words([item[field] for field in fields], stopwords_set)
+                operations.append(UpdateOne({"_id": item.pk}, {"$set": {"word_counts": word_counts}}))
+                if len(operations) >= options["batch_size"]:
+                    document._get_collection().bulk_write(operations, ordered=False)
+                    counted += len(operations)
+                    operations = []
+            if operations:
+                document._get_collection().bulk_write(operations, ordered=False)
+                counted += len(operations)
+            self.stdout.write("counted the words of %d %s documents" % (counted, document.__name__))
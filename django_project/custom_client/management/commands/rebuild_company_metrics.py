@@ -0,0 +1,33 @@
+"""
+For computing from scratch the rollups of the company metrics (see modules/data_collections/CompanyMetrics.py),
+the broker builds them when it starts if they were never built and then keeps them up to date, this is for
+fixing them if they drifted:
+
+    python manage.py rebuild_company_metrics
+
+The new rollups are written under a new generation and swapped in once complete, the current ones are
+read until then.
+"""
+
+import os
+from django.core.management.base import BaseCommand
+from modules.data_collections.Company import Company
+from modules.data_collections.CompanyMetrics import COMPANY_METRICS, build_company_metrics
+from modules.mongodb import connect_mongodb
+
+
+class Command(BaseCommand):
+    help = "Compute the sums and counts of the metrics of all the companies and of each industry."
+
+    def handle(self, *args, **options):
+        for name in ["MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT"]:
+            assert name in os.environ, "%s environment variable is missing." % name
+        connect_mongodb()
+
+        # increments applied by the broker while the companies are scanned are lost, better run it when
+        # crawlers are idle
+        generation, count = build_company_metrics(Company.objects().only("industry", *COMPANY_METRICS).no_cache())
+        if count:
+            self.stdout.write("rebuilt %d rollups, generation %s in use" % (count, generation))
+        else:
+            self.stdout.write("no rollup built, generation %s in use" % generation)
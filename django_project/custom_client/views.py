@@ -1,49 +1,127 @@
 import os
+import threading
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 from django.http import HttpResponse
 from mongoengine import *
-from modules.data_collections.Job import Job
+from modules.data_collections.Job import Job, EMBEDDING_DIMENSIONS
 from modules.data_collections.Company import Company
+from modules.data_collections.CompanyMetrics import CompanyMetrics, COMPANY_METRICS, ALL_COMPANIES_KEY, industry_key, \
+    rollup_key, get_built_generation
 from modules.data_collections.Review import Review
+from modules.data_collections.WordCounts import count_words, merge_word_counts
+from modules.queue_transport import transport
+from modules.embedding_index import EmbeddingIndex
+from modules.embedding_matrix import JobEmbeddingMatrix
+from modules.mongodb import connect_mongodb
+from modules.page_cache import page_cache_key, get_cached_context, cache_context
 import nltk
 from nltk.corpus import stopwords
 import collections
 import numpy as np
-from numpy import dot
-from numpy.linalg import norm
 from sklearn.preprocessing import normalize
 import redis
 import datetime
+from bson import ObjectId
 
 for name in ["CRAWLER_JOB_INPUT_QUEUE", "CRAWLER_COMPANY_INPUT_QUEUE",
              "REDIS_HOST", "REDIS_PORT", "MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT"]:
     assert name in os.environ, "%s environment variable is missing." % name
 
 mongo_db_name = os.environ["MONGODB_NAME"]
-connect(os.environ["MONGODB_NAME"], host=os.environ["MONGODB_HOST"], port=int(os.environ["MONGODB_PORT"]))
+connect_mongodb()
 
 # to remove stopwords when comparing jobs
 nltk.download('stopwords')
 __stopwords = set(stopwords.words("english"))
 
-print("connecting to redis")
+# index of the job embeddings, shared with the broker, if not set similar jobs are found in a matrix
+# of the embeddings of all the jobs, loaded in memory the first time it is needed
+embedding_index = EmbeddingIndex(os.environ["EMBEDDING_INDEX_FOLDER"]) if "EMBEDDING_INDEX_FOLDER" in os.environ \
+    else None
+embedding_matrix = JobEmbeddingMatrix(int(os.environ.get("EMBEDDING_MATRIX_REFRESH_SECONDS", 10)),
+                                      int(os.environ.get("EMBEDDING_MATRIX_REFRESH_LAG_SECONDS", 300)))
+# requests are served by many threads, only one at a time refreshes or searches the embeddings
+embeddings_lock = threading.Lock()
+
+# fields of the documents used by the pages, only these are fetched from the db
+# jobs in a list of results, with the word counts of their description for the word cloud of a search
+__job_list_fields = ["id", "job_title", "employer_name", "employer_glassdoor_id", "city", "state", "country",
+                     "date_last_modify", "description_language"]
+__job_search_fields = __job_list_fields + ["word_counts"]
+__review_fields = ["title", "pros", "cons", "advice_to_management", "sentiment_score", "recommendation_tags",
+                   "word_counts"]
+# fields of reviews whose words are in the word cloud
+__review_word_count_fields = ["pros", "cons", "advice_to_management"]
+__company_list_fields = ["name", "glassdoor_id", "website", "headquarters", "industry", "date_last_modify",
+                         "overall_rating", "culture_and_values", "career_opportunities", "work_life_balance"]
+
+# connections are opened when first used, and not shared with forked processes
 redis_c = redis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], db=0)
-print("connected to redis")
 
 
-def job_details(request, id):
+# mongodb and redis clients are blocking, the views run the blocking part of a request on a thread of the
+# executor of the event loop, so that a worker serves many requests at the same time when the app is served
+# with uvicorn workers (see gunicorn.conf.py)
+async def job_details(request, id):
+    """
+    Returns a page containing details about a job offer, given the job mongodb id, see render_job_details.
+    """
+    return await sync_to_async(render_job_details, thread_sensitive=False)(request, id)
+
+
+async def company_details(request, id):
+    """
+    Returns a page containing details about a company, given the company glassdoor id, see
+    render_company_details.
+    """
+    return await sync_to_async(render_company_details, thread_sensitive=False)(request, id)
+
+
+async def search(request):
+    """
+    Returns a page with the search results that the user has queried for (jobs or companies), see render_search.
+    """
+    return await sync_to_async(render_search, thread_sensitive=False)(request)
+
+
+def render_job_details(request, id):
     """
     Returns a page containing details about a job offer, given the job mongodb id.
+    The context of the page is cached until the job or its company change.
     Args:
         request:
         id:
 
     Returns:
 
+    """
+    versions = Job.objects(id=id).only("date_last_modify", "employer_glassdoor_id")
+    if not versions:
+        return HttpResponse("Something went wrong :(")
+
+    key = page_cache_key(redis_c, "job_details", id, versions[0].date_last_modify, versions[0].employer_glassdoor_id)
+    context = get_cached_context(redis_c, key)
+    if context is None:
+        context = get_job_details_context(id)
+        if context is None:
+            return HttpResponse("Something went wrong :(")
+        cache_context(redis_c, key, context)
+    return render(request, "custom_client/job_details.html", context)
+
+
+def get_job_details_context(id):
+    """
+    Compute the context of the page of a job.
+    Args:
+        id: Mongodb id of the job.
+
+    Returns: The context, None if the job does not exist.
+
     """
     jobs = Job.objects(id=id)
     if not jobs:
-        return HttpResponse("Something went wrong :(")
+        return None
 
     job = jobs[0]._data
     job = {k: v for (k, v) in job.items() if v is not None}
@@ -54,10 +132,12 @@ def job_details(request, id):
         job["date_last_modify"] = job["date_last_modify"].date
 
     # no need to have the actual embedding, just to have information about its existence in the template
-    if "embedding" in job and len(job["embedding"]) == 300:
+    # (the document is already loaded with it, whether it is packed or a list of floats)
+    if get_embedding_array(job) is not None:
         job["embedding"] = True
     else:
         job.pop("embedding", None)
+    job.pop("embedding_data", None)
 
     # add company info if possible
     if "employer_glassdoor_id" in job:
@@ -66,22 +146,46 @@ def job_details(request, id):
             company = company[0]._data
             company = {k: v for (k, v) in company.items() if v is not None}
             context["company"] = company
-    return render(request, "custom_client/job_details.html", context)
+    return context
 
 
-def company_details(request, id):
+def render_company_details(request, id):
     """
     Returns a page containing details about a company, given the company glassdoor id.
+    The context of the page is cached until the company, its reviews or its jobs change.
     Args:
         request:
         id:
 
     Returns:
 
+    """
+    versions = Company.objects(glassdoor_id=id).only("date_last_modify")
+    if not versions:
+        return HttpResponse("Something went wrong :(")
+
+    key = page_cache_key(redis_c, "company_details", id, versions[0].date_last_modify, id)
+    context = get_cached_context(redis_c, key)
+    if context is None:
+        context = get_company_details_context(id)
+        if context is None:
+            return HttpResponse("Something went wrong :(")
+        cache_context(redis_c, key, context)
+    return render(request, "custom_client/company_details.html", context)
+
+
+def get_company_details_context(id):
+    """
+    Compute the context of the page of a company.
+    Args:
+        id: Glassdoor id of the company.
+
+    Returns: The context, None if the company does not exist.
+
     """
     companies = Company.objects(glassdoor_id=id)
     if not companies:
-        return HttpResponse("Something went wrong :(")
+        return None
 
     # company general info
     company = companies[0]._data
@@ -89,7 +193,7 @@ def company_details(request, id):
     context["company"] = company
 
     # reviews, word cloud from reviews and sentiment of reviews
-    reviews = Review.objects(employer_glassdoor_id=company["glassdoor_id"])
+    reviews = Review.objects(employer_glassdoor_id=company["glassdoor_id"]).only(*__review_fields)
     reviews = [review._data for review in reviews]
     context["reviews"] = reviews
 
@@ -100,6 +204,9 @@ def company_details(request, id):
     reviews_words = get_reviews_normalized_words_count(reviews, 255, 30)
     if len(reviews_words) > 0:
         context["frequent_words"] = reviews_words
+    # not used by the template, not worth caching
+    for review in reviews:
+        review.pop("word_counts", None)
 
     sentiments = [review["sentiment_score"] for review in reviews if review.get("sentiment_score", None)]
     if len(sentiments) > 0:
@@ -107,45 +214,32 @@ def company_details(request, id):
         context["reviews_sentiment_score"] = sentiments
 
     # job offers from said company
-    jobs = Job.objects(employer_glassdoor_id=company["glassdoor_id"])
+    jobs = Job.objects(employer_glassdoor_id=company["glassdoor_id"]).only(*__job_list_fields)
     jobs = [job._data for job in jobs]
     context["jobs"] = jobs
 
-    # get average over all companies of some metrics
-    group_dict = dict()
-    group_dict["_id"] = "averages"
-    avgs_fields = ["overall_rating", "culture_and_values", "career_opportunities", "work_life_balance",
-                   "senior_management", "ceo_rating", "biz_outlook", "recommend", "comp_and_benefits"]
-    avgs_fields = filter(lambda x: isinstance(company.get(x, None), float), avgs_fields)
-    for field in avgs_fields:
-        group_dict[field] = {"$avg": "$%s" % field}
-
-    pipeline = [
-        {"$group": group_dict}
-
-    ]
-    all_companies_avgs = list(Company.objects.aggregate(*pipeline))[0]
-    context["all_companies_avgs"] = all_companies_avgs
+    # get average over all companies, and over companies in the same industry, of some metrics
+    avgs_fields = [field for field in COMPANY_METRICS if isinstance(company.get(field, None), float)]
+    context["all_companies_avgs"] = get_companies_averages(None, avgs_fields)
 
-    # get average over companies in the same industry of som metrics
     industry = company.get("industry", None)
     if industry:
-        pipeline = [
-            {"$match": {"industry": industry}},
-            {"$group": group_dict}
-        ]
-        same_industry_companies_avgs = list(Company.objects.aggregate(*pipeline))[0]
-        context["same_industry_companies_avgs"] = same_industry_companies_avgs
+        context["same_industry_companies_avgs"] = get_companies_averages(industry, avgs_fields)
 
-    return render(request, "custom_client/company_details.html", context)
+    return context
 
 
 __search_employer_fields = ["overall_rating", "culture_and_values", "career_opportunities", "work_life_balance"]
 
+# results in a page of a search
+__default_page_size = 50
+__max_page_size = 200
+
 
-def search(request):
+def render_search(request):
     """
     Returns a page with the search results that the user has queried for (jobs or companies).
+    Results are paginated, the next page is requested with the cursor of the current one.
     Args:
         request:
 
@@ -168,6 +262,7 @@ def search(request):
             context["location_value"] = loc
 
         search_type = request.POST.get("search_type", None)
+        context["search_type_value"] = search_type
         if search_type == "company":
             context["searched_company"] = True
 
@@ -175,24 +270,40 @@ def search(request):
         if crawl == "true":
             context["crawl_value"] = crawl
 
+        page_size = request.POST.get("page_size", str(__default_page_size))
+        context["page_size_value"] = page_size
+        cursor = request.POST.get("cursor", "")
+
         # check that we receive correct stuff
-        incorrect_input = any(not isinstance(item, str) for item in [kw, loc, search_type, crawl])
+        incorrect_input = any(not isinstance(item, str) for item in [kw, loc, search_type, crawl, page_size, cursor])
         incorrect_input = incorrect_input or search_type not in ["job", "company"]
         incorrect_input = incorrect_input or crawl not in ["true", "false"]
+        incorrect_input = incorrect_input or not page_size.isdigit() or not 0 < int(page_size) <= __max_page_size
+        try:
+            cursor = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            incorrect_input = True
 
         if incorrect_input:
             return HttpResponse("Something went wrong :(")
 
+        # crawl only once, when the first page is requested
+        if cursor is not None:
+            context.pop("crawl_value", None)
+
         if search_type == "job":
-            return render_jobs_search(request, context, os.environ["CRAWLER_JOB_INPUT_QUEUE"], kw, loc)
+            return render_jobs_search(request, context, os.environ["CRAWLER_JOB_INPUT_QUEUE"], kw, loc,
+                                      int(page_size), cursor)
 
         elif search_type == "company":
-            return render_company_search(request, context, os.environ["CRAWLER_COMPANY_INPUT_QUEUE"], kw, loc)
+            return render_company_search(request, context, os.environ["CRAWLER_COMPANY_INPUT_QUEUE"], kw, loc,
+                                         int(page_size), cursor)
 
     return render_jobs(request, context, [])
 
 
-def render_company_search(request, context, crawler_company_input_queue, keyword, location):
+def render_company_search(request, context, crawler_company_input_queue, keyword, location,
+                          page_size=__default_page_size, cursor=None):
     """
     Given search keyword and location find related companies in the database and render the page, if crawl_value
     is true in the context dictionary this function also starts a crawl for given keyword and location.
@@ -203,6 +314,8 @@ def render_company_search(request, context, crawler_company_input_queue, keyword
         crawler_company_input_queue: Redis input queue of crawlers for company related tasks.
         keyword: Keyword of the search.
         location: Location of the search.
+        page_size: Number of companies in a page.
+        cursor: Cursor of the page, as returned by decode_cursor, None for the first page.
 
     Returns: Render of the template containing the search results.
 
@@ -211,23 +324,11 @@ def render_company_search(request, context, crawler_company_input_queue, keyword
         keyword = " ".join([keyword, location])
     elif location != "":
         keyword = location
-    if keyword != "":
-        companies = Company.objects().search_text(keyword, language="en").order_by('$text_score')
-    else:
-        companies = Company.objects().order_by('-date_last_modify')[:100]
 
-    # avg values for companies in the search result
-    group_dict = dict()
-    group_dict["_id"] = "averages"
-    for field in ["overall_rating", "culture_and_values", "career_opportunities", "work_life_balance"]:
-        group_dict[field] = {"$avg": "$%s" % field}
-    pipeline = [
-        {"$group": group_dict}
+    companies, context["next_cursor"] = find_page(Company, dict(), keyword, __company_list_fields, page_size, cursor)
 
-    ]
-    companies_avgs = list(companies.aggregate(*pipeline))
-
-    companies = [company._data for company in companies]
+    # avg values for companies in the page
+    companies_avgs = averages(companies, __search_employer_fields)
 
     for company in companies:
 
@@ -242,15 +343,16 @@ def render_company_search(request, context, crawler_company_input_queue, keyword
 
         for field in __search_employer_fields:
             if field in company and isinstance(company[field], float):
-                company[field + "_difference"] = round(company[field] - companies_avgs[0][field], 1)
+                company[field + "_difference"] = round(company[field] - companies_avgs[field], 1)
 
     context["companies"] = companies
     if context.get("crawl_value", False):
-        redis_c.lpush(crawler_company_input_queue, "%s|||sep|||%s" % (keyword, location))
+        transport.push(redis_c, crawler_company_input_queue, "%s|||sep|||%s" % (keyword, location))
     return render(request, "custom_client/index.html", context)
 
 
-def render_jobs_search(request, context, crawler_job_input_queue, keyword, location):
+def render_jobs_search(request, context, crawler_job_input_queue, keyword, location,
+                       page_size=__default_page_size, cursor=None):
     """
     Given search keyword and location find related jobs in the database and render the page, if crawl_value
     is true in the context dictionary this function also starts a crawl for given keyword and location.
@@ -261,33 +363,114 @@ def render_jobs_search(request, context, crawler_job_input_queue, keyword, locat
         crawler_job_input_queue: Redis input queue of crawlers for job related tasks.
         keyword: Keyword of the search.
         location: Location of the search.
+        page_size: Number of jobs in a page.
+        cursor: Cursor of the page, as returned by decode_cursor, None for the first page.
 
     Returns: Render of the template containing the search results.
 
     """
+    match = dict()
     if location != "":
-        loc_variations = [location, location.lower(), location.upper(), location.capitalize()]
-        query = Q(city=location)
-        for loc in loc_variations:
-            query = query | Q(city=loc) | Q(country=loc) | Q(state=loc)
+        loc_variations = list(set([location, location.lower(), location.upper(), location.capitalize()]))
+        match["$or"] = [{field: {"$in": loc_variations}} for field in ["city", "country", "state"]]
 
-        if keyword != "":
-            jobs = Job.objects(query).search_text(keyword, language="en").order_by('$text_score')
-        else:
-            jobs = Job.objects(query).order_by("-date_last_modify")
-    else:
-        if keyword != "":
-            jobs = Job.objects().search_text(keyword, language="en").order_by('$text_score')
-        else:
-            jobs = Job.objects().order_by("-date_last_modify")[:100]
+    jobs, context["next_cursor"] = find_page(Job, match, keyword, __job_search_fields, page_size, cursor)
 
     if context.get("crawl_value", False):
-        redis_c.lpush(crawler_job_input_queue, "%s|||sep|||%s" % (keyword, location))
-    jobs = [job._data for job in jobs]
+        transport.push(redis_c, crawler_job_input_queue, "%s|||sep|||%s" % (keyword, location))
 
     return render_jobs(request, context, jobs)
 
 
+def find_page(document, match, keyword, fields, page_size, cursor=None):
+    """
+    Find a page of documents, ordered by relevance if a keyword is given (text search), otherwise the most
+    recently modified first. Pages are found by keyset (the sort value and the id of the last document of the
+    previous page) so that any page costs the same as the first one.
+    Args:
+        document: mongoengine document class to search.
+        match: Filter of the documents.
+        keyword: Keywords of the text search, "" for none.
+        fields: Fields of the documents to fetch.
+        page_size: Number of documents in a page.
+        cursor: (sort value, id) of the last document of the previous page, None for the first page.
+
+    Returns: The documents of the page as dicts (with the id in "id"), and the cursor of the next page as
+        a string (None if this is the last page).
+
+    """
+    projection = {field: 1 for field in fields if field != "id"}
+    if keyword != "":
+        sort_field = "score"
+        match = dict(match, **{"$text": {"$search": keyword, "$language": "en"}})
+        projection["score"] = {"$meta": "textScore"}
+        pipeline = [{"$match": match}, {"$project": projection}]
+        if cursor is not None:
+            pipeline.append({"$match": after_cursor(sort_field, cursor)})
+        pipeline += [{"$sort": {sort_field: -1, "_id": -1}}, {"$limit": page_size + 1}]
+    else:
+        # the filter and the sort come first so that the index on the date is used
+        sort_field = "date_last_modify"
+        if cursor is not None:
+            match = {"$and": [match, after_cursor(sort_field, cursor)]}
+        pipeline = [{"$match": match}, {"$sort": {sort_field: -1, "_id": -1}}, {"$limit": page_size + 1},
+                    {"$project": projection}]
+
+    documents = list(document.objects.aggregate(*pipeline))
+    next_cursor = None
+    if len(documents) > page_size:
+        documents = documents[:page_size]
+        # documents without a date of modification come last, and can't be paged through
+        if documents[-1].get(sort_field, None) is not None:
+            next_cursor = encode_cursor(documents[-1][sort_field], documents[-1]["_id"])
+
+    for item in documents:
+        item["id"] = item.pop("_id")
+        item.pop("score", None)
+        # fields missing in a document are not in its dict, they are None in the data of a document
+        for field in fields:
+            item.setdefault(field, None)
+    return documents, next_cursor
+
+
+def after_cursor(sort_field, cursor):
+    """
+    Returns: Filter of the documents after a cursor, in descending order of sort_field and id.
+    """
+    value, last_id = cursor
+    return {"$or": [{sort_field: {"$lt": value}}, {sort_field: value, "_id": {"$lt": last_id}}]}
+
+
+def encode_cursor(value, last_id):
+    """
+    Args:
+        value: Sort value of the last document of a page, a text score or a date.
+        last_id: Id of the last document of a page.
+
+    Returns: The cursor of the next page, as a string.
+
+    """
+    if isinstance(value, datetime.datetime):
+        value = "d%d" % ((value - datetime.datetime(1970, 1, 1)) // datetime.timedelta(milliseconds=1))
+    else:
+        value = "s%r" % float(value)
+    return "%s|%s" % (value, last_id)
+
+
+def decode_cursor(cursor):
+    """
+    Returns: The (sort value, id) tuple of a cursor returned by encode_cursor, raises ValueError if it is not valid.
+    """
+    value, _, last_id = cursor.partition("|")
+    if not ObjectId.is_valid(last_id) or value[:1] not in ["d", "s"]:
+        raise ValueError("Not a valid cursor: %s" % cursor)
+    if value[0] == "d":
+        value = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=int(value[1:]))
+    else:
+        value = float(value[1:])
+    return value, ObjectId(last_id)
+
+
 def render_jobs(request, context, jobs):
     """
     Takes care of rendering the template with the correct information given some jobs documents.
@@ -302,14 +485,13 @@ def render_jobs(request, context, jobs):
 
     # get ids of employers for the given job offerings
     employer_glassdoor_ids = list(
-        set([job["employer_glassdoor_id"] for job in jobs if "employer_glassdoor_id" in job]))
+        set([job["employer_glassdoor_id"] for job in jobs if job.get("employer_glassdoor_id", None)]))
 
     # get frequent words of job offers for a word cloud
     frequent_words = get_job_normalized_words_count(jobs, 255, 30)
 
-    # get companies related to the found jobs and their average metrics
-    jobs_companies = get_jobs_companies(employer_glassdoor_ids)
-    jobs_companies_avgs = get_jobs_companies_averages(employer_glassdoor_ids)
+    # get companies related to the found jobs, by glassdoor id, and their average metrics
+    jobs_companies, jobs_companies_avgs = get_jobs_companies(employer_glassdoor_ids)
 
     # for each job add company ratings fields if possible
     for job in jobs:
@@ -323,24 +505,17 @@ def render_jobs(request, context, jobs):
         if "date_last_modify" in job and isinstance(job["date_last_modify"], datetime.datetime):
             job["date_last_modify"] = job["date_last_modify"].date
 
-        # add company(ies) info
-        if "employer_glassdoor_id" in job:
-            company = list(filter(lambda x: "glassdoor_id" in x and x["glassdoor_id"] == job["employer_glassdoor_id"],
-                                  jobs_companies))
-            if company:
-                company = company[0]
-            for field in __search_employer_fields:
-                if field in company and isinstance(company[field], float):
-                    job["emp_" + field] = company[field]
-                    job["emp_" + field + "_difference"] = round(company[field] - jobs_companies_avgs[0][field],
-                                                                1)
-                else:
-                    job["emp_" + field] = "-"
-        else:
-            for field in __search_employer_fields:
+        # add company info
+        company = jobs_companies.get(job.get("employer_glassdoor_id", None), dict())
+        for field in __search_employer_fields:
+            if isinstance(company.get(field, None), float):
+                job["emp_" + field] = company[field]
+                job["emp_" + field + "_difference"] = round(company[field] - jobs_companies_avgs[field], 1)
+            else:
                 job["emp_" + field] = "-"
-        context["jobs"] = jobs
-        context["frequent_words"] = frequent_words
+
+    context["jobs"] = jobs
+    context["frequent_words"] = frequent_words
 
     return render(request, "custom_client/index.html", context)
 
@@ -351,13 +526,21 @@ def render_jobs(request, context, jobs):
 
 def get_jobs_companies(companies_ids):
     """
-    Get companies related to given ids.
+    Get companies related to given ids and their average metrics, with a single aggregation.
     Args:
-        companies_ids:
+        companies_ids: List of glassdoor ids of companies.
 
-    Returns:
+    Returns: Dictionary mapping glassdoor ids to companies (as dicts with the metrics), and dictionary
+        mapping metrics to their average over the companies.
 
     """
+    if not companies_ids:
+        return dict(), dict()
+
+    group_dict = dict()
+    group_dict["_id"] = "averages"
+    for field in __search_employer_fields:
+        group_dict[field] = {"$avg": "$%s" % field}
     pipeline = [
         {
             "$match":
@@ -365,50 +548,78 @@ def get_jobs_companies(companies_ids):
                     "glassdoor_id": {"$in": companies_ids}
                 }
         },
-
+        {
+            "$facet":
+                {
+                    "companies": [{"$project": {field: 1 for field in ["glassdoor_id"] + __search_employer_fields}}],
+                    "averages": [{"$group": group_dict}]
+                }
+        }
     ]
-    return list(Company.objects.aggregate(*pipeline))
+    result = list(Company.objects.aggregate(*pipeline))[0]
+    companies = {company["glassdoor_id"]: company for company in result["companies"]}
+    return companies, result["averages"][0] if result["averages"] else dict()
 
 
-def get_jobs_companies_averages(companies_ids):
+def get_companies_averages(industry, fields):
     """
-    Get average metrics of companies related to given ids.
+    Get the average of some metrics over all the companies, or over the companies of an industry, from
+    the rollups kept by the broker, or with an aggregation over the companies if the rollups were not
+    built yet (see seed_company_metrics in the broker).
     Args:
-        companies_ids:
+        industry: Industry of the companies, None for all the companies.
+        fields: Metrics to average, see COMPANY_METRICS.
 
-    Returns:
+    Returns: Dictionary mapping the metrics to their average.
 
     """
+    key = industry_key(industry) if industry else ALL_COMPANIES_KEY
+    generation = get_built_generation()
+    rollup = CompanyMetrics.objects(key=rollup_key(generation, key)).first() if generation is not None else None
+    if rollup is not None:
+        return rollup.averages(fields)
+
     group_dict = dict()
     group_dict["_id"] = "averages"
-    for field in ["overall_rating", "culture_and_values", "career_opportunities", "work_life_balance"]:
+    for field in fields:
         group_dict[field] = {"$avg": "$%s" % field}
-    {"$group": group_dict}
-    pipeline = [
-        {
-            "$match":
-                {
-                    "glassdoor_id": {"$in": companies_ids}
-                }
-        },
-        {"$group": group_dict}
-    ]
-    return list(Company.objects.aggregate(*pipeline))
+    pipeline = [{"$match": {"industry": industry}}] if industry else []
+    pipeline.append({"$group": group_dict})
+    result = list(Company.objects.aggregate(*pipeline))
+    return result[0] if result else dict()
 
 
-def normalized_word_counts(data, factor, top_k):
+def averages(items, fields):
+    """
+    Get the average of some fields over a list of documents.
+    Args:
+        items: List of documents as dicts.
+        fields: Names of the fields to average, values that are not floats are ignored.
+
+    Returns: Dictionary mapping each field to its average, None for fields without values.
+
+    """
+    result = dict()
+    for field in fields:
+        values = [item[field] for item in items if isinstance(item.get(field, None), float)]
+        result[field] = sum(values) / len(values) if values else None
+    return result
+
+
+def normalized_word_counts(list_of_word_counts, factor, top_k):
     """
 
     Args:
-        data:
+        list_of_word_counts: List of word counts of documents, as stored in their word_counts field.
         factor: Factor by which the normalized count of each word should be multiplied.
         top_k: Keep only the top-k words with highest count.
 
     Returns:
 
     """
-    frequent_words = collections.Counter(
-        [word.lower() for word in data if word.lower() not in __stopwords and len(word) > 1]).most_common(top_k)
+    frequent_words = merge_word_counts(list_of_word_counts, top_k)
+    if not frequent_words:
+        return []
 
     # normalize and rescale
     values = normalize([[w[1] for w in frequent_words]], norm='l2')
@@ -421,6 +632,7 @@ def get_job_normalized_words_count(jobs, factor, top_k):
     """
     Normalize the count of each word w.r.t to the others and multiply by a factor the result (needed
     to have a more robust/predictable drawing of the word cloud.
+    Words are counted by the broker, only jobs it did not count words of yet have their description fetched.
     Args:
         jobs:
         factor: Factor by which the normalized count of each word should be multiplied.
@@ -431,19 +643,20 @@ def get_job_normalized_words_count(jobs, factor, top_k):
     if not jobs:
         return []
 
-    data = []
-    for job in jobs:
-        text = job.get("description_text", None)
-        if text:
-            data.extend(text.split())
+    list_of_word_counts = [job["word_counts"] for job in jobs if job.get("word_counts", None)]
+    not_counted = [job["id"] for job in jobs if not job.get("word_counts", None) and "id" in job]
+    if not_counted:
+        for job in Job.objects(id__in=not_counted).only("description_text"):
+            list_of_word_counts.append(count_words([job.description_text], __stopwords))
 
-    return normalized_word_counts(data, factor, top_k)
+    return normalized_word_counts(list_of_word_counts, factor, top_k)
 
 
 def get_reviews_normalized_words_count(reviews, factor, top_k):
     """
     Normalize the count of each word w.r.t to the others and multiply by a factor the result (needed
     to have a more robust/predictable drawing of the word cloud.
+    Words are counted by the broker, they are counted here only for reviews it did not count words of yet.
     Args:
         reviews:
         factor: Factor by which the normalized count of each word should be multiplied.
@@ -454,13 +667,15 @@ def get_reviews_normalized_words_count(reviews, factor, top_k):
     if not reviews:
         return []
 
-    data = []
+    list_of_word_counts = []
     for review in reviews:
-        for name in ["pros", "cons", "advice_to_management"]:
-            if name in review and review[name] is not None:
-                data.extend(review[name].split())
+        if review.get("word_counts", None):
+            list_of_word_counts.append(review["word_counts"])
+        else:
+            list_of_word_counts.append(count_words([review.get(name, None) for name in __review_word_count_fields],
+                                                   __stopwords))
 
-    return normalized_word_counts(data, factor, top_k)
+    return normalized_word_counts(list_of_word_counts, factor, top_k)
 
 
 def get_reviews_top_tags(reviews, top_k):
@@ -480,40 +695,63 @@ def get_reviews_top_tags(reviews, top_k):
     return tags
 
 
-def get_similar_jobs_by_embedding(job_id):
+def get_embedding_array(job):
+    """
+    Get the embedding of a job as a numpy array, whether it is stored as a list of floats or packed
+    in embedding_data (see modules.data_collections.Job.pack_embedding).
+    Args:
+        job: Data of a job document.
+
+    Returns: float32 array of EMBEDDING_DIMENSIONS values, or None if the job has no valid embedding.
+
+    """
+    data = job.get("embedding_data", None)
+    if data:
+        data = bytes(data)
+        if len(data) == 4 * EMBEDDING_DIMENSIONS:
+            return np.frombuffer(data, dtype="<f4")
+        if len(data) == 4 + EMBEDDING_DIMENSIONS:
+            # int8 values and their float32 scale
+            return np.frombuffer(data, dtype="<f4", count=1)[0] * np.frombuffer(data, dtype=np.int8, offset=4)
+        return None
+
+    embedding = job.get("embedding", None)
+    if embedding and len(embedding) == EMBEDDING_DIMENSIONS:
+        return np.array(embedding, dtype=np.float32)
+    return None
+
+
+def get_similar_jobs_by_embedding(job_id, k=20):
     """
     Given a job id, if no job with such id exist, or if the job exist but has no embedding
-    or its embedding is not valid an empty list is returned, otherwise the first 20 most similar jobs to the job
+    or its embedding is not valid an empty list is returned, otherwise the first k most similar jobs to the job
     are returned in a list.
     Similarity is computed using the cosine similarity. Jobs with no embedding are not considered.
-    NOTE: this implementation is something that i quickly put together and
-    not something that could/should be used in production, it get basically all jobs
-    from the db and compares their embedding with the one of the job we are looking similar items for.
+    The jobs are found in the embedding index if there is one, otherwise in the matrix of the embeddings
+    of all the jobs kept in memory.
     Args:
         job_id:
+        k: Number of similar jobs to return.
 
     Returns:
 
     """
-    input_job = Job.objects(id=job_id)
-    if not input_job or "embedding" not in input_job[0] or len(input_job[0]["embedding"]) != 300:
+    embeddings = embedding_index if embedding_index is not None else embedding_matrix
+    with embeddings_lock:
+        embeddings.refresh()
+        # copied, the row might be overwritten by another thread once the lock is released
+        input_job_embedding = embeddings.get(str(job_id))
+        input_job_embedding = np.array(input_job_embedding) if input_job_embedding is not None else None
+
+    if input_job_embedding is None:
+        input_job = Job.objects(id=job_id).only("embedding", "embedding_data")
+        input_job_embedding = get_embedding_array(input_job[0]._data) if input_job else None
+    if input_job_embedding is None:
         return []
-    input_job = input_job[0]
-
-    other_jobs = Job.objects(Q(id__ne=job_id) & Q(embedding__size=300))
-    other_jobs = [job._data for job in other_jobs]
-    input_job_embedding = np.array(input_job["embedding"])
-
-    # for each job get the cosine similarity and them sort them
-    for job in other_jobs:
-        job_embedding = np.array(job["embedding"])
-        job["cosine_similarity"] = \
-            dot(input_job_embedding, job_embedding) \
-            / (norm(input_job_embedding) * norm(job_embedding))
-    other_jobs = sorted(other_jobs, key=lambda x: x["cosine_similarity"], reverse=True)
-    other_jobs = other_jobs[:20]
-
-    # remove the added key just to be tidy
-    for job in other_jobs:
-        job.pop("cosine_similarity", None)
-    return other_jobs
+
+    with embeddings_lock:
+        similar_ids = [similar_id for similar_id, _ in embeddings.search(input_job_embedding, k,
+                                                                          exclude=str(job_id))]
+    other_jobs = Job.objects(id__in=similar_ids).only(*__job_search_fields)
+    other_jobs = {str(job.id): job._data for job in other_jobs}
+    return [other_jobs[similar_id] for similar_id in similar_ids if similar_id in other_jobs]
@@ -0,0 +1,20 @@
+"""
+For serving the client in production, instead of the development server of manage.py runserver:
+
+    gunicorn --config gunicorn.conf.py django_project.asgi:application
+
+The app is loaded once before forking the workers, each an uvicorn event loop serving many requests
+at the same time (the views run their mongodb and redis calls on threads, see custom_client/views.py).
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+# modules and nltk stopwords are loaded once, the embeddings are loaded by each worker when first needed
+preload_app = True
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+keepalive = 5
+accesslog = "-" if os.environ.get("GUNICORN_ACCESS_LOG", "false") == "true" else None
@@ -0,0 +1,108 @@
+"""
+Sends requests to a running client from --concurrency threads at the same time, and prints for each page the
+requests/s and the latency (50th and 99th percentile) of its requests: a search of jobs and a search of
+companies on the index (/), and company_details of the companies found by the search of companies, or of
+--company_ids.
+
+    python load_test.py --url http://127.0.0.1:8000 --keywords "data scientist" --requests 500 --concurrency 32
+"""
+
+import argparse
+import re
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def get_csrf_token(url):
+    """
+    Returns: The csrf cookie set by the index and the token of its search form, both needed to post a search.
+    """
+    with urllib.request.urlopen(url + "/") as response:
+        cookie = re.search(r"csrftoken=([^;]+)", response.headers.get("Set-Cookie", ""))
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.read().decode("utf-8"))
+    assert cookie and token, "The index did not set a csrf token."
+    return cookie.group(1), token.group(1)
+
+
+def search_request(url, csrf, keywords, search_type, page_size):
+    """
+    Returns: The request of a search on the index.
+    """
+    data = urllib.parse.urlencode({"csrfmiddlewaretoken": csrf[1], "keywords": keywords, "location": "",
+                                   "search_type": search_type, "start_crawl": "false",
+                                   "page_size": str(page_size)}).encode("utf-8")
+    return urllib.request.Request(url + "/", data=data, headers={"Cookie": "csrftoken=%s" % csrf[0]})
+
+
+def timed_request(request):
+    """
+    Returns: (seconds taken, body of the response, None if the request failed).
+    """
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            body = response.read().decode("utf-8")
+    except OSError as e:
+        print(str(e))
+        body = None
+    return time.perf_counter() - start, body
+
+
+def run(name, requests, concurrency):
+    """
+    Send requests from concurrency threads and print their throughput and latency.
+    Args:
+        name: Name of the page, for the report.
+        requests: List of urllib requests (or urls).
+        concurrency: Number of requests sent at the same time.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, requests))
+    total = time.perf_counter() - start
+
+    seconds = [seconds for seconds, body in results if body is not None]
+    errors = len(results) - len(seconds)
+    if not seconds:
+        print("%s: all the %d requests failed" % (name, errors))
+        return
+    print("%s: %d requests in %.1fs, %.1f requests/s, latency p50 %.1fms p99 %.1fms, %d errors" %
+          (name, len(results), total, len(results) / total, 1000 * np.percentile(seconds, 50),
+           1000 * np.percentile(seconds, 99), errors))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8000")
+    parser.add_argument('--keywords', type=str, default="engineer")
+    parser.add_argument('--page_size', type=int, default=50)
+    # requests sent for each page
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    # glassdoor ids of the companies whose pages are requested, by default the ones found by the search
+    parser.add_argument('--company_ids', type=str, nargs="*", default=[])
+    args = parser.parse_args()
+    args = args.__dict__
+    print("Passed args:")
+    print(args)
+    assert args["requests"] > 0 and args["concurrency"] > 0, "requests and concurrency should be positive integers."
+
+    url = args["url"].rstrip("/")
+    csrf = get_csrf_token(url)
+
+    for search_type in ["job", "company"]:
+        run("search %s" % search_type, [search_request(url, csrf, args["keywords"], search_type, args["page_size"])
+                                        for _ in range(args["requests"])], args["concurrency"])
+
+    company_ids = args["company_ids"]
+    if not company_ids:
+        _, body = timed_request(search_request(url, csrf, args["keywords"], "company", args["page_size"]))
+        company_ids = sorted(set(re.findall(r'href="/company_details([^"]+)"', body or "")))
+    if not company_ids:
+        print("no companies found for company_details, pass some with --company_ids")
+    else:
+        run("company_details", ["%s/company_details%s" % (url, urllib.parse.quote(company_ids[i % len(company_ids)]))
+                                for i in range(args["requests"])], args["concurrency"])
@@ -1,6 +1,63 @@
+import array
+import sys
 import datetime
 from mongoengine import *
 
+EMBEDDING_DIMENSIONS = 300
+
+# ways of storing the embedding of a job: "list" of floats in Job.embedding, or packed in Job.embedding_data
+# as "float32" (4 little-endian bytes per value) or "int8" (a float32 scale, then a signed byte per value)
+EMBEDDING_STORAGES = ["list", "float32", "int8"]
+
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def pack_embedding(values, storage):
+    """
+    Pack an embedding to be stored in Job.embedding_data.
+    Args:
+        values: List of EMBEDDING_DIMENSIONS floats.
+        storage: "float32" or "int8".
+
+    Returns: bytes.
+
+    """
+    assert storage in ["float32", "int8"], "Unknown packed embedding storage %s" % storage
+    if storage == "float32":
+        return _little_endian(array.array("f", values)).tobytes()
+
+    # symmetric quantization with a scale per vector, the largest value (in absolute value) is 127
+    scale = max(abs(value) for value in values) / 127. or 1.
+    quantized = array.array("b", [max(-127, min(127, int(round(value / scale)))) for value in values])
+    return _little_endian(array.array("f", [scale])).tobytes() + quantized.tobytes()
+
+
+def unpack_embedding(data):
+    """
+    Unpack an embedding packed by pack_embedding, the storage is given by the size of the data.
+    Args:
+        data: bytes.
+
+    Returns: List of EMBEDDING_DIMENSIONS floats.
+
+    """
+    if len(data) == 4 * EMBEDDING_DIMENSIONS:
+        values = array.array("f")
+        values.frombytes(data)
+        return _little_endian(values).tolist()
+
+    assert len(data) == 4 + EMBEDDING_DIMENSIONS, "Packed embedding of unknown size %d" % len(data)
+    scale = array.array("f")
+    scale.frombytes(data[:4])
+    scale = _little_endian(scale)[0]
+    quantized = array.array("b")
+    quantized.frombytes(data[4:])
+    return [value * scale for value in quantized]
+
 
 class Job(DynamicDocument):
     """
@@ -14,6 +71,11 @@ class Job(DynamicDocument):
     description_html = StringField(required=True)
     description_language = StringField(required=True, max_length=3)
     embedding = ListField(FloatField(), max_length=300)
+    # the embedding packed as float32 or int8 (see pack_embedding), used instead of embedding
+    # depending on the storage configured in the broker
+    embedding_data = BinaryField(required=False)
+    # counts of the most frequent words of the description, as [word, count] pairs (see WordCounts.count_words)
+    word_counts = ListField(required=False)
 
     city = StringField(required=False, max_length=50)
     state = StringField(required=False, max_length=50)
@@ -23,10 +85,21 @@ class Job(DynamicDocument):
     employer_glassdoor_id = StringField(required=False, max_length=50)
     date_of_posting = DateTimeField(default=datetime.datetime.utcnow)
     date_last_modify = DateTimeField(default=datetime.datetime.utcnow)
+
+    def get_embedding(self):
+        """
+        Returns: The embedding of the job as a list of floats, whatever its storage, or None.
+        """
+        if self.embedding_data:
+            return unpack_embedding(self.embedding_data)
+        if self.embedding and len(self.embedding) == EMBEDDING_DIMENSIONS:
+            return list(self.embedding)
+        return None
+
     meta = {
         "indexes": [
             #  #name stands for an hash index, $name stands for a text index, name stands for a normal btree index
-            "date_of_posting"
+            "date_of_posting",
             "date_last_modify",
             "#description_text",
             "#description_title",
@@ -0,0 +1,40 @@
+import collections
+
+# words whose count is kept for each document, the most frequent ones
+DOCUMENT_WORDS = 100
+
+
+def count_words(texts, stopwords, top_k=DOCUMENT_WORDS):
+    """
+    Count the words of the texts of a document, as shown in the word clouds of the client: texts are
+    split on whitespace, words are lowercased, stopwords and single characters are left out.
+    Args:
+        texts: List of strings, None items are ignored.
+        stopwords: Set of lowercase words to leave out.
+        top_k: Number of words to keep, the most frequent ones.
+
+    Returns: List of [word, count] pairs, the most frequent first, as stored in the word_counts field
+        of jobs and reviews.
+
+    """
+    counter = collections.Counter()
+    for text in texts:
+        if text:
+            counter.update(word for word in text.lower().split() if len(word) > 1 and word not in stopwords)
+    return [[word, count] for word, count in counter.most_common(top_k)]
+
+
+def merge_word_counts(list_of_word_counts, top_k):
+    """
+    Args:
+        list_of_word_counts: List of word counts of documents, as returned by count_words.
+        top_k: Number of words to keep, the most frequent ones.
+
+    Returns: List of (word, count) tuples of all the documents, the most frequent first.
+
+    """
+    counter = collections.Counter()
+    for word_counts in list_of_word_counts:
+        for word, count in word_counts or []:
+            counter[word] += count
+    return counter.most_common(top_k)
@@ -0,0 +1,333 @@
+"""
+Index of the job embeddings, for finding the jobs most similar to a job (cosine similarity) without
+scanning the job collection.
+
+The index lives in a folder shared by the broker, that appends to it the embeddings it receives, and
+the client, that searches it:
+ - snapshot.json: the current generation of the index, and the backend it was saved with.
+ - ids_<generation>.npy, vectors_<generation>.npy: job ids and normalized float32 embeddings of a snapshot,
+    a removed job has an empty id and a zero vector.
+ - hnsw_<generation>.faiss: the faiss HNSW graph over the vectors of the snapshot, with the "hnsw" backend.
+ - log_<generation>: embeddings added since the snapshot, records of the 24 characters of the job id
+    followed by its embedding packed as float32 (a zero embedding removes the job), appended
+    by the broker (see EmbeddingIndex.py there).
+ - lock: flock-ed exclusively while appending to the log or saving a snapshot.
+Readers apply the log to the snapshot they loaded, once the log is long enough the reader saves what it
+has as the next generation (see EmbeddingIndex.refresh), so the broker never has to load the index.
+
+Two backends are available, chosen with EMBEDDING_INDEX_BACKEND:
+ - "hnsw" (default when faiss is installed): approximate search on a faiss HNSW graph.
+ - "flat": exact search with a matrix-vector product in numpy.
+"""
+
+import fcntl
+import json
+import os
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+from modules.data_collections.Job import EMBEDDING_DIMENSIONS, pack_embedding
+
+ID_LENGTH = 24
+RECORD_SIZE = ID_LENGTH + 4 * EMBEDDING_DIMENSIONS
+
+EMBEDDING_INDEX_BACKENDS = ["hnsw", "flat"]
+
+# neighbours of each node of the HNSW graph, and size of the candidate lists when building and searching it
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# a snapshot is saved when the log holds this many records, and rebuilt without the removed jobs when
+# they are more than this fraction of the snapshot
+COMPACT_RECORDS = int(os.environ.get("EMBEDDING_INDEX_COMPACT_RECORDS", 10000))
+REBUILD_REMOVED_FRACTION = 0.2
+
+
+class _Lock(object):
+    """
+    Exclusive flock on the lock file of an index folder.
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, "lock")
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def read_generation(folder):
+    """
+    Returns: The current generation of the index in the folder, and the backend of its snapshot
+        (None for generation 0, which has no snapshot).
+    """
+    try:
+        with open(os.path.join(folder, "snapshot.json")) as f:
+            snapshot = json.load(f)
+        return snapshot["generation"], snapshot["backend"]
+    except FileNotFoundError:
+        return 0, None
+
+
+def append_embeddings(folder, ids, embeddings):
+    """
+    Append embeddings to the log of the index in a folder.
+    Args:
+        folder: Folder of the index, created if needed.
+        ids: List of job ids, as strings.
+        embeddings: List with the embedding of each job, as lists of EMBEDDING_DIMENSIONS floats,
+            None to remove the job from the index.
+    """
+    records = bytearray()
+    for job_id, embedding in zip(ids, embeddings):
+        assert len(job_id) == ID_LENGTH, "Not a valid job id: %s" % job_id
+        records += job_id.encode("ascii")
+        records += pack_embedding(embedding if embedding else [0.] * EMBEDDING_DIMENSIONS, "float32")
+    if not records:
+        return
+
+    os.makedirs(folder, exist_ok=True)
+    with _Lock(folder):
+        generation, _ = read_generation(folder)
+        with open(os.path.join(folder, "log_%d" % generation), "ab") as log:
+            log.write(records)
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex(object):
+    """
+    In memory copy of the index of a folder, kept up to date with refresh.
+    """
+
+    def __init__(self, folder, backend=None):
+        """
+        Args:
+            folder: Folder of the index.
+            backend: One of EMBEDDING_INDEX_BACKENDS, by default EMBEDDING_INDEX_BACKEND or
+                "hnsw" if faiss is installed and "flat" otherwise.
+        """
+        backend = backend or os.environ.get("EMBEDDING_INDEX_BACKEND", "hnsw" if faiss is not None else "flat")
+        assert backend in EMBEDDING_INDEX_BACKENDS, \
+            "Unknown embedding index backend %s, should be one of %s" % (backend, EMBEDDING_INDEX_BACKENDS)
+        assert backend != "hnsw" or faiss is not None, "The hnsw embedding index backend needs faiss"
+        self.folder = folder
+        self.backend = backend
+        self.generation = None
+        self.log_offset = 0
+        self.clear()
+
+    def clear(self):
+        # the first self.size rows of self.vectors are used, the others are room for adding rows
+        self.vectors = np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        self.size = 0
+        self.ids = []
+        self.rows = dict()
+        self.removed = 0
+        self.hnsw = self.new_hnsw() if self.backend == "hnsw" else None
+
+    def new_hnsw(self):
+        hnsw = faiss.IndexHNSWFlat(EMBEDDING_DIMENSIONS, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+        return hnsw
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self, generation, backend):
+        """
+        Load a snapshot, the hnsw graph is rebuilt if it was saved with the other backend.
+        """
+        self.clear()
+        self.generation, self.log_offset = generation, 0
+        if generation == 0:
+            return
+
+        self.ids = [str(job_id) for job_id in np.load(os.path.join(self.folder, "ids_%d.npy" % generation))]
+        self.vectors = np.load(os.path.join(self.folder, "vectors_%d.npy" % generation))
+        self.size = len(self.ids)
+        self.rows = {job_id: row for row, job_id in enumerate(self.ids) if job_id}
+        self.removed = self.size - len(self.rows)
+        if self.backend == "hnsw":
+            if backend == "hnsw":
+                self.hnsw = faiss.read_index(os.path.join(self.folder, "hnsw_%d.faiss" % generation))
+                self.hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+            else:
+                self.hnsw.add(self.vectors)
+
+    def refresh(self):
+        """
+        Apply the records appended to the log since the last refresh, loading the current snapshot if
+        it changed, and save a new snapshot if the log is long enough.
+        """
+        generation, backend = read_generation(self.folder)
+        if generation != self.generation:
+            try:
+                self.load(generation, backend)
+            except FileNotFoundError:
+                # a newer snapshot was saved meanwhile, the files of this one are gone
+                return self.refresh()
+
+        if self.read_log() >= COMPACT_RECORDS:
+            self.compact()
+
+    def compact(self):
+        """
+        Save a snapshot with the whole log applied, unless another reader saved a newer one meanwhile.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with _Lock(self.folder):
+            if read_generation(self.folder)[0] == self.generation:
+                self.read_log()
+                self.save()
+
+    def read_log(self):
+        """
+        Apply the complete records of the log after the last one applied.
+        Returns: Number of records in the log.
+        """
+        try:
+            with open(os.path.join(self.folder, "log_%d" % self.generation), "rb") as log:
+                log.seek(self.log_offset)
+                data = log.read()
+        except FileNotFoundError:
+            return self.log_offset // RECORD_SIZE
+
+        records = len(data) // RECORD_SIZE
+        if records > 0:
+            data = data[:records * RECORD_SIZE]
+            ids = [data[i:i + ID_LENGTH].decode("ascii") for i in range(0, len(data), RECORD_SIZE)]
+            vectors = np.frombuffer(data, dtype=np.dtype([("id", "S%d" % ID_LENGTH),
+                                                         ("vector", "<f4", EMBEDDING_DIMENSIONS)]))["vector"]
+            self.update(ids, vectors)
+            self.log_offset += records * RECORD_SIZE
+        return self.log_offset // RECORD_SIZE
+
+    def update(self, ids, vectors):
+        """
+        Args:
+            ids: List of job ids.
+            vectors: Array with the embedding of each job, a zero embedding removes the job.
+        """
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        # the same job might be updated more than once, the last update wins
+        last_updates = {job_id: position for position, job_id in enumerate(ids)}
+        added_ids, added_vectors = [], []
+        for position, (job_id, vector) in enumerate(zip(ids, vectors)):
+            if last_updates[job_id] != position:
+                continue
+            row = self.rows.pop(job_id, None)
+            if row is not None:
+                if self.backend == "flat" and vector.any():
+                    # replaced in place, the hnsw graph can't change the vector of a node
+                    self.vectors[row] = vector
+                    self.rows[job_id] = row
+                    continue
+                self.vectors[row] = 0
+                self.ids[row] = ""
+                self.removed += 1
+            if vector.any():
+                self.rows[job_id] = self.size + len(added_ids)
+                added_ids.append(job_id)
+                added_vectors.append(vector)
+
+        if added_ids:
+            self.append_rows(added_ids, np.stack(added_vectors))
+
+    def append_rows(self, ids, vectors):
+        if self.size + len(ids) > len(self.vectors):
+            capacity = max(2 * len(self.vectors), self.size + len(ids), 1024)
+            grown = np.zeros((capacity, EMBEDDING_DIMENSIONS), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+        self.vectors[self.size:self.size + len(ids)] = vectors
+        self.ids += ids
+        self.size += len(ids)
+        if self.hnsw is not None:
+            self.hnsw.add(vectors)
+
+    def save(self):
+        """
+        Save the index as the next generation, removing the files of the current one. Should be called
+        holding the lock of the folder, after reading the whole log.
+        """
+        if self.removed > REBUILD_REMOVED_FRACTION * self.size:
+            live_rows = sorted(self.rows.values())
+            ids, vectors = [self.ids[row] for row in live_rows], self.vectors[live_rows]
+            self.clear()
+            self.append_rows(ids, vectors)
+            self.rows = {job_id: row for row, job_id in enumerate(self.ids)}
+
+        old_generation, generation = self.generation, self.generation + 1
+        np.save(os.path.join(self.folder, "ids_%d.npy" % generation), np.array(self.ids, dtype="U%d" % ID_LENGTH))
+        np.save(os.path.join(self.folder, "vectors_%d.npy" % generation), self.vectors[:self.size])
+        if self.hnsw is not None:
+            faiss.write_index(self.hnsw, os.path.join(self.folder, "hnsw_%d.faiss" % generation))
+
+        snapshot_path = os.path.join(self.folder, "snapshot.json")
+        with open(snapshot_path + ".tmp", "w") as f:
+            json.dump({"generation": generation, "backend": self.backend}, f)
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        self.generation, self.log_offset = generation, 0
+
+        for name in ["ids_%d.npy", "vectors_%d.npy", "hnsw_%d.faiss", "log_%d"]:
+            try:
+                os.remove(os.path.join(self.folder, name % old_generation))
+            except FileNotFoundError:
+                pass
+
+    def get(self, job_id):
+        """
+        Returns: The normalized embedding of a job, None if it is not in the index.
+        """
+        row = self.rows.get(job_id, None)
+        return self.vectors[row] if row is not None else None
+
+    def search(self, embedding, k, exclude=None):
+        """
+        Find the jobs whose embeddings are the most similar to an embedding.
+        Args:
+            embedding: Array of EMBEDDING_DIMENSIONS floats.
+            k: Number of jobs to find.
+            exclude: Id of a job to leave out of the results, e.g. the one the embedding belongs to.
+
+        Returns: List of up to k (job id, cosine similarity) tuples, the most similar first.
+
+        """
+        if not self.rows or k <= 0:
+            return []
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+
+        if self.hnsw is None:
+            similarities = self.vectors[:self.size] @ query[0]
+            # removed jobs have a zero vector, they might be among the candidates
+            candidates = min(k + 1 + self.removed, self.size)
+            rows = np.argpartition(-similarities, candidates - 1)[:candidates]
+            rows = rows[np.argsort(-similarities[rows], kind="stable")]
+            results = [(self.ids[row], float(similarities[row])) for row in rows]
+        else:
+            # removed jobs are still nodes of the graph, asking for more neighbours until enough are found
+            candidates = k + 1
+            while True:
+                similarities, rows = self.hnsw.search(query, min(candidates, self.size))
+                results = [(self.ids[row], float(similarity))
+                           for row, similarity in zip(rows[0], similarities[0]) if row >= 0 and self.ids[row]]
+                if len(results) > k or candidates >= self.size:
+                    break
+                candidates *= 4
+
+        return [(job_id, similarity) for job_id, similarity in results if job_id and job_id != exclude][:k]
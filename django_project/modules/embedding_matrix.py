@@ -0,0 +1,155 @@
+"""
+For keeping in memory the embeddings of all the jobs, as a matrix of normalized float32 rows, so that the
+jobs most similar to a job are found with a single matrix-vector product.
+
+The matrix is loaded from the db the first time it is used, then only the jobs modified since the last
+refresh (by date_last_modify, the broker updates it when it stores an embedding) are reloaded. The broker
+sets date_last_modify before writing a whole batch, and several broker workers write at the same time, so
+jobs are not written in date_last_modify order: each refresh also reloads the jobs modified up to
+lag_seconds before the last one loaded, skipping the ones already loaded with the same date_last_modify.
+"""
+
+import datetime
+import time
+import numpy as np
+from mongoengine import Q
+
+from modules.data_collections.Job import Job, EMBEDDING_DIMENSIONS, unpack_embedding
+
+
+def job_embedding(job):
+    """
+    Returns: The embedding of a job document as a float32 array, None if it has no valid embedding.
+    """
+    if job.embedding_data:
+        data = bytes(job.embedding_data)
+        if len(data) in [4 * EMBEDDING_DIMENSIONS, 4 + EMBEDDING_DIMENSIONS]:
+            return np.array(unpack_embedding(data), dtype=np.float32)
+        return None
+    if job.embedding and len(job.embedding) == EMBEDDING_DIMENSIONS:
+        return np.array(job.embedding, dtype=np.float32)
+    return None
+
+
+class JobEmbeddingMatrix(object):
+    """
+    Normalized embeddings of all the jobs with one, and the id of the job of each row.
+    """
+
+    def __init__(self, refresh_seconds=10, lag_seconds=300):
+        """
+        Args:
+            refresh_seconds: The db is not queried for modified jobs more often than this.
+            lag_seconds: How much earlier than the last job loaded a job might be written, a few times the
+                longest time the broker takes to process a batch.
+        """
+        self.refresh_seconds = refresh_seconds
+        self.lag = datetime.timedelta(seconds=lag_seconds)
+        self.last_refresh = 0
+        # the first self.size rows are used, the others are room for adding rows
+        self.vectors = np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+        self.size = 0
+        self.ids = []
+        self.rows = dict()
+        # date_last_modify of the last modified job loaded, None before the first load
+        self.watermark = None
+        # date_last_modify of the jobs loaded that were modified less than self.lag before the watermark
+        self.recent = dict()
+
+    def __len__(self):
+        return self.size
+
+    def refresh(self):
+        """
+        Load the embeddings of the jobs modified since the last refresh.
+        """
+        if time.time() - self.last_refresh < self.refresh_seconds:
+            return
+        self.last_refresh = time.time()
+
+        if self.watermark is None:
+            jobs = Job.objects(Q(embedding__size=EMBEDDING_DIMENSIONS) | Q(embedding_data__exists=True))
+            self.watermark = datetime.datetime.min
+        else:
+            # jobs modified before the watermark might have been written after the last refresh
+            jobs = Job.objects(date_last_modify__gte=self.since())
+        jobs = jobs.only("id", "embedding", "embedding_data", "date_last_modify").no_cache()
+
+        for job in jobs:
+            job_id = str(job.id)
+            if job.date_last_modify and self.recent.get(job_id, None) == job.date_last_modify:
+                continue
+            self.update(job_id, job_embedding(job))
+            if job.date_last_modify:
+                self.recent[job_id] = job.date_last_modify
+                self.watermark = max(self.watermark, job.date_last_modify)
+
+        self.recent = {job_id: date for job_id, date in self.recent.items() if date >= self.since()}
+
+    def since(self):
+        """
+        Returns: The date_last_modify from which jobs are reloaded, lag before the watermark.
+        """
+        if self.watermark - datetime.datetime.min < self.lag:
+            return datetime.datetime.min
+        return self.watermark - self.lag
+
+    def update(self, job_id, embedding):
+        """
+        Set the embedding of a job, None to remove the job.
+        """
+        row = self.rows.get(job_id, None)
+        norm = np.linalg.norm(embedding) if embedding is not None else 0
+
+        if norm == 0:
+            if row is not None:
+                # the last row takes the place of the removed one
+                last_id = self.ids[self.size - 1]
+                self.vectors[row] = self.vectors[self.size - 1]
+                self.ids[row] = last_id
+                self.rows[last_id] = row
+                del self.rows[job_id]
+                self.ids.pop()
+                self.size -= 1
+            return
+
+        if row is None:
+            if self.size == len(self.vectors):
+                grown = np.zeros((max(2 * self.size, 1024), EMBEDDING_DIMENSIONS), dtype=np.float32)
+                grown[:self.size] = self.vectors[:self.size]
+                self.vectors = grown
+            row = self.size
+            self.rows[job_id] = row
+            self.ids.append(job_id)
+            self.size += 1
+        self.vectors[row] = embedding / norm
+
+    def get(self, job_id):
+        """
+        Returns: The normalized embedding of a job, None if it is not in the matrix.
+        """
+        row = self.rows.get(job_id, None)
+        return self.vectors[row] if row is not None else None
+
+    def search(self, embedding, k, exclude=None):
+        """
+        Find the jobs whose embeddings are the most similar to an embedding.
+        Args:
+            embedding: Array of EMBEDDING_DIMENSIONS floats.
+            k: Number of jobs to find.
+            exclude: Id of a job to leave out of the results, e.g. the one the embedding belongs to.
+
+        Returns: List of up to k (job id, cosine similarity) tuples, the most similar first.
+
+        """
+        if self.size == 0 or k <= 0:
+            return []
+        embedding = np.asarray(embedding, dtype=np.float32)
+        similarities = self.vectors[:self.size] @ (embedding / max(np.linalg.norm(embedding), 1e-12))
+        if exclude in self.rows:
+            similarities[self.rows[exclude]] = -np.inf
+
+        k = min(k, self.size)
+        rows = np.argpartition(-similarities, k - 1)[:k]
+        rows = rows[np.argsort(-similarities[rows], kind="stable")]
+        return [(self.ids[row], float(similarities[row])) for row in rows if similarities[row] > -np.inf]
@@ -0,0 +1,20 @@
+"""
+For connecting the client to mongodb, the views and the management commands connect with the same
+arguments, mongoengine refusing to register the same connection twice with different ones (the views
+are imported by the system checks before a management command runs).
+"""
+
+import os
+from mongoengine import connect
+
+
+def connect_mongodb():
+    """
+    Connect mongoengine to the db of MONGODB_NAME, MONGODB_HOST and MONGODB_PORT.
+    The client is not connected until the first query, so that the gunicorn workers forked after loading
+    the app (see gunicorn.conf.py) each open their own pool of up to MONGODB_MAX_POOL_SIZE connections.
+    """
+    for name in ["MONGODB_NAME", "MONGODB_HOST", "MONGODB_PORT"]:
+        assert name in os.environ, "%s environment variable is missing." % name
+    connect(os.environ["MONGODB_NAME"], host=os.environ["MONGODB_HOST"], port=int(os.environ["MONGODB_PORT"]),
+            maxPoolSize=int(os.environ.get("MONGODB_MAX_POOL_SIZE", 100)), connect=False)
@@ -0,0 +1,56 @@
+"""
+For caching in redis the context computed for the company_details and job_details pages.
+
+A cached context is keyed by the date_last_modify of the document of the page and by the generation
+of its company, which the broker increments whenever it writes the company, its reviews or its jobs
+(see PageCache.py in the broker, the key of the generation has to be the same), so that a context is
+never read again once the data it was computed from changed, and expires after PAGE_CACHE_TTL seconds.
+"""
+
+import os
+import pickle
+
+# seconds a context is kept in the cache, 0 to not cache contexts
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", 86400))
+
+
+def company_generation_key(glassdoor_id):
+    return "page_cache:generation:%s" % glassdoor_id
+
+
+def page_cache_key(redis_c, page, document_id, date_last_modify, glassdoor_id):
+    """
+    Get the key of the cached context of a page.
+    Args:
+        redis_c: redis connection.
+        page: Name of the page, e.g. "company_details".
+        document_id: Id of the document shown by the page.
+        date_last_modify: date_last_modify of the document shown by the page, None if not set.
+        glassdoor_id: Glassdoor id of the company the page is about, None if not known.
+
+    Returns: The key, None if contexts are not cached.
+
+    """
+    if PAGE_CACHE_TTL <= 0:
+        return None
+    generation = redis_c.get(company_generation_key(glassdoor_id)) if glassdoor_id else None
+    date_last_modify = date_last_modify.timestamp() if date_last_modify else 0
+    return "page_cache:%s:%s:%.6f:%d" % (page, document_id, date_last_modify, int(generation or 0))
+
+
+def get_cached_context(redis_c, key):
+    """
+    Returns: The context cached with a key, None if it is not cached (or if key is None).
+    """
+    if key is None:
+        return None
+    cached = redis_c.get(key)
+    return pickle.loads(cached) if cached is not None else None
+
+
+def cache_context(redis_c, key, context):
+    """
+    Cache the context of a page for PAGE_CACHE_TTL seconds, nothing is done if key is None.
+    """
+    if key is not None:
+        redis_c.setex(key, PAGE_CACHE_TTL, pickle.dumps(context, protocol=pickle.HIGHEST_PROTOCOL))
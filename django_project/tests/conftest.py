@@ -0,0 +1,48 @@
+"""
+For testing the client with pytest (python -m pytest django_project/tests), the views are imported with the
+environment they need, their mongodb connection being made to mongomock.
+"""
+
+import os
+import sys
+import mongomock
+import pytest
+from mongoengine import connect, disconnect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name, value in [("CRAWLER_JOB_INPUT_QUEUE", "crawler_job_input"), ("CRAWLER_COMPANY_INPUT_QUEUE",
+                    "crawler_company_input"), ("REDIS_HOST", "localhost"), ("REDIS_PORT", "6379"),
+                    ("MONGODB_NAME", "client_test"), ("MONGODB_HOST", "localhost"), ("MONGODB_PORT", "27017"),
+                    ("DJANGO_SETTINGS_MODULE", "django_project.settings")]:
+    os.environ.setdefault(name, value)
+
+import modules.mongodb
+
+
+def connect_mongomock():
+    connect(os.environ["MONGODB_NAME"], host=os.environ["MONGODB_HOST"], port=int(os.environ["MONGODB_PORT"]),
+            mongo_client_class=mongomock.MongoClient)
+
+
+modules.mongodb.connect_mongodb = connect_mongomock
+
+import django
+
+django.setup()
+
+from modules.data_collections.Company import Company
+from modules.data_collections.CompanyMetrics import CompanyMetrics
+from modules.data_collections.Job import Job
+from modules.data_collections.Review import Review
+
+
+@pytest.fixture
+def mongodb():
+    # the broker tests might have registered their own connection
+    disconnect()
+    connect_mongomock()
+    yield
+    # dropped through the documents, so that their indexes are created again on the next connection
+    for document in [Company, CompanyMetrics, Job, Review]:
+        document.drop_collection()
+    disconnect()
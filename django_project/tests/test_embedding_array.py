@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from custom_client.views import get_embedding_array
+from modules.data_collections.Job import EMBEDDING_DIMENSIONS, pack_embedding
+
+EMBEDDING = list(np.random.RandomState(0).uniform(-1, 1, EMBEDDING_DIMENSIONS))
+
+
+def test_list_and_packed_embeddings():
+    assert get_embedding_array({"embedding": EMBEDDING}) == pytest.approx(EMBEDDING, abs=1e-6)
+    float32 = get_embedding_array({"embedding_data": pack_embedding(EMBEDDING, "float32")})
+    assert float32.dtype == np.float32 and float32 == pytest.approx(EMBEDDING, abs=1e-6)
+    # packed embeddings are used instead of the list
+    int8 = get_embedding_array({"embedding": [0.] * EMBEDDING_DIMENSIONS,
+                                "embedding_data": pack_embedding(EMBEDDING, "int8")})
+    assert int8 == pytest.approx(EMBEDDING, abs=1. / 127)
+
+
+def test_missing_or_invalid_embeddings():
+    assert get_embedding_array({}) is None
+    assert get_embedding_array({"embedding": []}) is None
+    assert get_embedding_array({"embedding": EMBEDDING[:10]}) is None
+    assert get_embedding_array({"embedding_data": b"\x00" * 10}) is None
@@ -0,0 +1,53 @@
+import datetime
+
+import pytest
+from bson import ObjectId
+
+from custom_client.views import find_page, encode_cursor, decode_cursor
+from modules.data_collections.Job import Job
+
+FIELDS = ["id", "job_title", "employer_name", "date_last_modify"]
+
+
+def save_jobs(count, date):
+    jobs = []
+    for i in range(count):
+        job = Job(job_title="job %d" % i, employer_name="company", description_text="text",
+                  description_html="text", description_language="en",
+                  # two jobs share each date, the id breaks the tie
+                  date_last_modify=date - datetime.timedelta(days=i // 2))
+        job.save(validate=False)
+        jobs.append(job)
+    return jobs
+
+
+def test_pages_follow_each_other(mongodb):
+    jobs = save_jobs(7, datetime.datetime(2020, 1, 10))
+    expected = sorted(jobs, key=lambda job: (job.date_last_modify, job.id), reverse=True)
+
+    found, cursor = [], None
+    for _ in range(4):
+        page, cursor = find_page(Job, {}, "", FIELDS, 3, decode_cursor(cursor) if cursor else None)
+        found += page
+        if cursor is None:
+            break
+    assert [job["id"] for job in found] == [job.id for job in expected]
+    assert len(page) == 1 and cursor is None
+    assert set(found[0]) == set(FIELDS)
+
+
+def test_filter_and_exact_last_page(mongodb):
+    save_jobs(4, datetime.datetime(2020, 1, 10))
+    page, cursor = find_page(Job, {"job_title": {"$in": ["job 0", "job 1"]}}, "", FIELDS, 2)
+    assert sorted(job["job_title"] for job in page) == ["job 0", "job 1"]
+    assert cursor is None
+
+
+def test_cursor_round_trip():
+    last_id = ObjectId()
+    date = datetime.datetime(2020, 1, 10, 12, 30, 15, 250000)
+    assert decode_cursor(encode_cursor(date, last_id)) == (date, last_id)
+    assert decode_cursor(encode_cursor(1.25, last_id)) == (1.25, last_id)
+    for cursor in ["", "x1|%s" % last_id, "s1.0|not an id"]:
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
@@ -0,0 +1,29 @@
+import datetime
+import os
+import sys
+
+import fakeredis
+
+from modules.page_cache import page_cache_key, get_cached_context, cache_context
+
+# the broker increments the generations the keys are built from
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                "broker"))
+from PageCache import invalidate_company_pages
+
+
+def test_contexts_are_invalidated_by_the_broker():
+    redis_c = fakeredis.FakeRedis()
+    date = datetime.datetime(2020, 1, 10)
+    key = page_cache_key(redis_c, "company_details", "1", date, "1")
+    assert get_cached_context(redis_c, key) is None
+    cache_context(redis_c, key, {"company": {"name": "company"}})
+    assert get_cached_context(redis_c, page_cache_key(redis_c, "company_details", "1", date, "1")) == \
+        {"company": {"name": "company"}}
+
+    # a write of the broker, or a newer version of the document, changes the key
+    invalidate_company_pages(redis_c, ["1", None])
+    assert get_cached_context(redis_c, page_cache_key(redis_c, "company_details", "1", date, "1")) is None
+    assert page_cache_key(redis_c, "company_details", "1", date + datetime.timedelta(seconds=1), "1") != \
+        page_cache_key(redis_c, "company_details", "1", date, "1")
+    assert get_cached_context(redis_c, None) is None
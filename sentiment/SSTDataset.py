@@ -15,14 +15,11 @@ class SSTDataset(Dataset):
 
         self.maxlen = maxlen
 
-    def __len__(self):
-        return len(self.df)
-
-    def __getitem__(self, index):
-        # Selecting the sentence and label at the specified index in the data frame
-        sentence = self.df.loc[index, "sentence"]
-        label = self.df.loc[index, "label"]
+        # sentences are tokenized once, their lengths are needed to batch them by length
+        self.tokens_ids = [self.tokenize(sentence) for sentence in self.df["sentence"]]
+        self.lengths = [len(tokens_ids) for tokens_ids in self.tokens_ids]
 
+    def tokenize(self, sentence):
         # tokenize in a way that BERT expects
         tokens = self.tokenizer.tokenize(sentence)
         # data should being with [CLS], sentences should be separated (and end) with [SEP]
@@ -30,18 +27,16 @@ class SSTDataset(Dataset):
         # truncate sequences that are too long
         tokens = tokens[:self.maxlen - 1] + ["[SEP]"]
 
-        # add padding it sequence is not long enough, so that sequences of different
-        # length can fit in the same tensor
-        tokens = tokens + ["[PAD]"] * (self.maxlen - len(tokens))
+        # tokens to their id in BERT vocab, padding is added to each batch by batching.collate
+        return torch.tensor(self.tokenizer.convert_tokens_to_ids(tokens))
 
-        # tokens to their id in BERT vocab
-        tokens_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-        tokens_ids = torch.tensor(tokens_ids)
+    def __len__(self):
+        return len(self.df)
 
-        # attention mask: 1 for non PAD tokens, 0 otherwise
-        attn_mask = (tokens_ids != 0).long()
+    def __getitem__(self, index):
+        # Selecting the sentence and label at the specified index in the data frame
+        label = self.df.loc[index, "label"]
 
         # no need for segment ids to signal which tokens belong to which sentence
         # of a pair since the input are not paired sentences
-        return tokens_ids, attn_mask, label
-
+        return self.tokens_ids[index], label
@@ -0,0 +1,109 @@
+"""
+For batching sequences of token ids of different length, used both for inference and training.
+Sequences are padded only up to the longest sequence of their batch, and batches are made of
+sequences of similar length, so that little of the attention compute is spent on [PAD] tokens.
+"""
+
+import random
+import torch
+from torch.utils.data import Sampler
+
+# id of [PAD] in the BERT vocab
+PAD_ID = 0
+
+
+def pad_sequences(sequences, length=None):
+    """
+    Pad sequences of token ids to the same length.
+    Args:
+        sequences: List of 1-d tensors of token ids.
+        length: Length to pad to, the length of the longest sequence if not given.
+
+    Returns: Tensor of token ids and tensor of attention masks (1 for non PAD tokens, 0 otherwise),
+        both of shape [number of sequences, length].
+
+    """
+    length = length or max(len(sequence) for sequence in sequences)
+    tokens_ids = torch.full((len(sequences), length), PAD_ID, dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        tokens_ids[i, :len(sequence)] = sequence
+    attn_masks = (tokens_ids != PAD_ID).long()
+    return tokens_ids, attn_masks
+
+
+def length_batches(lengths, batch_size):
+    """
+    Split indices in batches of indices of sequences of similar length.
+    Args:
+        lengths: List of lengths of sequences.
+        batch_size: Max number of sequences in a batch.
+
+    Returns: List of lists of indices, from the batch of the shortest sequences to the one of the longest.
+
+    """
+    indices = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+
+def collate(samples):
+    """
+    collate_fn for a DataLoader of (tokens ids, label) samples, pads the batch to its longest sequence.
+    Args:
+        samples: List of (1-d tensor of token ids, label) tuples.
+
+    Returns: Tensor of token ids, tensor of attention masks, tensor of labels.
+
+    """
+    tokens_ids, attn_masks = pad_sequences([tokens_ids for tokens_ids, _ in samples])
+    labels = torch.tensor([label for _, label in samples])
+    return tokens_ids, attn_masks, labels
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler yielding batches of indices of sequences of similar length.
+    Indices are shuffled and split in buckets of bucket_batches batches, each bucket is sorted by length
+    and split in batches, and batches are shuffled again, so that batches are still random.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, bucket_batches=100):
+        """
+        Args:
+            lengths: List of lengths of the sequences of the dataset.
+            batch_size: Number of sequences in a batch.
+            shuffle: Whether to shuffle the sequences (and the batches) at each epoch.
+            drop_last: Whether to drop the batches that are smaller than batch_size.
+            bucket_batches: Number of batches in a bucket.
+        """
+        super(BucketBatchSampler, self).__init__(lengths)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_batches = bucket_batches
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            batches += [[bucket[i] for i in batch]
+                        for batch in length_batches([self.lengths[i] for i in bucket], self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            # only the last batch of each bucket can be smaller than batch_size
+            full_buckets, remainder = divmod(len(self.lengths), self.batch_size * self.bucket_batches)
+            return full_buckets * self.bucket_batches + remainder // self.batch_size
+        return sum((min(self.batch_size * self.bucket_batches, len(self.lengths) - start) + self.batch_size - 1)
+                   // self.batch_size
+                   for start in range(0, len(self.lengths), self.batch_size * self.bucket_batches))
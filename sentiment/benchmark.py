@@ -0,0 +1,133 @@
+"""
+Replays a fixed corpus of reviews through the sentiment model, the same way main.py does, and prints
+the throughput and the share of [PAD] tokens with sequences padded to --maxlen, padded dynamically, and
+padded dynamically with the token ids cache. With --scripted_model the model exported by export.py is
+replayed too, on cpu. The latency of a batch (50th and 99th percentile) is printed for each run.
+
+The corpus is either a json lines file, one review per line as a dictionary mapping field names to text
+(the "inputs" sent to the sentiment worker), or a tsv file with a "sentence" column (e.g. data/SST-2/dev.tsv)
+whose sentences are grouped --fields sentences per review.
+
+    python benchmark.py --checkpoint models/trained_model --corpus data/SST-2/dev.tsv
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+from batching import length_batches
+from tokenization import load_tokenizer, prepare_inputs, TokenIdsCache
+from main import compute_sentiments, load_model
+
+
+def load_corpus(filename, fields):
+    """
+    Args:
+        filename: json lines or tsv file, see the description of the module.
+        fields: Number of sentences of a tsv file in a review.
+
+    Returns: List of dictionaries mapping field names to text.
+
+    """
+    if filename.endswith(".tsv"):
+        sentences = list(pd.read_csv(filename, delimiter="\t")["sentence"])
+        return [{"field_%d" % j: sentence for j, sentence in enumerate(sentences[i:i + fields])}
+                for i in range(0, len(sentences), fields)]
+
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def padded_tokens(lengths, max_length, max_sequences, dynamic_padding):
+    """
+    Returns: Number of tokens (PAD included) fed to the model for sequences of the given lengths.
+    """
+    if not dynamic_padding:
+        return len(lengths) * max_length
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in length_batches(lengths, max_sequences))
+
+
+def replay(model, tokenizer, device, corpus, args, dynamic_padding, cache=None):
+    """
+    Compute the sentiments of the corpus in batches of args["batch_size"] reviews.
+    The statistics are computed with a separate cache, so that they do not change its hit rate.
+
+    Returns: The sentiments of the reviews, the seconds taken by each batch, the number of tokens and
+        of padded tokens.
+
+    """
+    sentiments = []
+    seconds, tokens, padded = [], 0, 0
+    lengths_cache = TokenIdsCache(args["token_cache_size"])
+    for i in range(0, len(corpus), args["batch_size"]):
+        reviews_inputs = corpus[i:i + args["batch_size"]]
+        start = time.time()
+        sentiments += compute_sentiments(model, tokenizer, device, args["maxlen"], reviews_inputs,
+                                         args["max_sequences"], dynamic_padding, cache)
+        seconds.append(time.time() - start)
+
+        lengths = [len(tokens_ids) for tokens_ids in prepare_inputs(
+            tokenizer, args["maxlen"], [text for inputs in reviews_inputs for text in inputs.values()], lengths_cache)]
+        tokens += sum(lengths)
+        padded += padded_tokens(lengths, args["maxlen"], args["max_sequences"], dynamic_padding)
+    return sentiments, seconds, tokens, padded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--corpus', type=str, required=True)
+    parser.add_argument('--fields', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--maxlen', type=int, default=230)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_sequences', type=int, default=64)
+    parser.add_argument('--token_cache_size', type=int, default=50000)
+    # model exported by export.py
+    parser.add_argument('--scripted_model', type=str, required=False)
+    args = parser.parse_args()
+    args = args.__dict__
+    print("Passed args:")
+    print(args)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print("Found device: %s" % device)
+
+    model, _ = load_model(dict(args, scripted_model=None), device)
+    tokenizer = load_tokenizer()
+
+    corpus = load_corpus(args["corpus"], args["fields"])[:args["limit"]]
+    sequences = sum(len(inputs) for inputs in corpus)
+    print("replaying %d reviews, %d sequences" % (len(corpus), sequences))
+
+    runs = [("padded to maxlen", model, device, False, 0), ("dynamic padding", model, device, True, 0),
+            ("dynamic padding and token cache", model, device, True, args["token_cache_size"])]
+    if args["scripted_model"]:
+        cpu = torch.device("cpu")
+        scripted_model, _ = load_model(args, cpu)
+        runs.append(("exported model", scripted_model, cpu, True, args["token_cache_size"]))
+
+    results = dict()
+    for name, run_model, run_device, dynamic_padding, cache_size in runs:
+        cache = TokenIdsCache(cache_size)
+        sentiments, seconds, tokens, padded = replay(run_model, tokenizer, run_device, corpus, args,
+                                                     dynamic_padding, cache)
+        results[name] = sentiments
+        total = sum(seconds)
+        print("%s: %.1fs, %.1f reviews/s, %.1f sequences/s, batch latency p50 %.1fms p99 %.1fms, "
+              "%.1f%% of tokens are [PAD], %s" %
+              (name, total, len(corpus) / total, sequences / total, 1000 * np.percentile(seconds, 50),
+               1000 * np.percentile(seconds, 99), 100. * (padded - tokens) / padded, cache.stats()))
+
+    max_difference = max([abs(fixed[field] - dynamic[field])
+                          for fixed, dynamic in zip(results["padded to maxlen"], results["dynamic padding"])
+                          for field in fixed] or [0])
+    print("max difference between the sentiments: %g" % max_difference)
+    if args["scripted_model"]:
+        max_difference = max([abs(original[field] - exported[field])
+                              for original, exported in zip(results["dynamic padding"], results["exported model"])
+                              for field in original] or [0])
+        print("max difference between the sentiments of the exported model: %g" % max_difference)
@@ -0,0 +1,89 @@
+"""
+Exports a checkpoint saved by train.py for serving on cpu: the Linear layers (of DistilBERT and of the
+classifier on top of it) are dynamically quantized to int8, and the model is traced to TorchScript.
+The args of the checkpoint are saved in the TorchScript file, see load_model in main.py.
+
+    python export.py --checkpoint models/trained_model --output models/trained_model_quantized.pt \
+        --dev_data data/SST-2/dev.tsv
+
+With --dev_data the accuracy of the checkpoint and of the exported model are compared on the
+SST-2 dev set with evaluate from train.py, and the export fails (the exported model is removed) if
+the accuracy drops by more than --max_accuracy_drop. Latency can be compared with benchmark.py.
+"""
+
+import argparse
+import json
+import os
+import torch
+import torch.nn as nn
+
+from model import SentimentClassifier
+
+
+def export(model, example_length=32):
+    """
+    Quantize and trace a model.
+    Args:
+        model: SentimentClassifier, on cpu.
+        example_length: Length of the example sequences used for tracing, sequences of any
+            length can be used with the traced model.
+
+    Returns: The quantized TorchScript model.
+
+    """
+    model.eval()
+    quantized = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    # any valid input does, it only has to go through all the layers
+    seq = torch.randint(1000, 2000, (2, example_length), dtype=torch.long)
+    attn_masks = torch.ones(2, example_length, dtype=torch.long)
+    attn_masks[1, example_length // 2:] = 0
+    with torch.no_grad():
+        return torch.jit.trace(quantized, (seq, attn_masks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    # SST-2 tsv file to compare the accuracy of the checkpoint and of the exported model on
+    parser.add_argument('--dev_data', type=str, required=False)
+    # with --dev_data, the export fails if the accuracy of the exported model is lower than this much
+    parser.add_argument('--max_accuracy_drop', type=float, default=0.01)
+    parser.add_argument('--batch_size', type=int, default=32)
+    args = parser.parse_args()
+    args = args.__dict__
+    print("Passed args:")
+    print(args)
+
+    device = torch.device("cpu")
+    model = SentimentClassifier()
+    checkpoint = torch.load(args["checkpoint"], map_location=device)
+    model.load_state_dict(checkpoint["model_state_dict"])
+
+    print("quantizing and tracing the model...")
+    scripted_model = export(model)
+    torch.jit.save(scripted_model, args["output"],
+                   _extra_files={"args.json": json.dumps(checkpoint["args"], default=str)})
+    print("exported model saved to %s" % args["output"])
+
+    if args["dev_data"]:
+        from torch.utils.data import DataLoader
+        from SSTDataset import SSTDataset
+        from batching import collate, BucketBatchSampler
+        from train import evaluate
+
+        dataset = SSTDataset(filename=args["dev_data"], maxlen=checkpoint["args"]["maxlen"])
+        loader = DataLoader(dataset, collate_fn=collate,
+                            batch_sampler=BucketBatchSampler(dataset.lengths, args["batch_size"], shuffle=False))
+        criterion = nn.BCEWithLogitsLoss()
+        evaluate_args = {"device": device}
+        accuracies = dict()
+        for name, evaluated_model in [("checkpoint", model), ("exported model", torch.jit.load(args["output"]))]:
+            accuracies[name], loss = evaluate(evaluated_model, criterion, loader, evaluate_args)
+            print("%s: dev accuracy %.4f, dev loss %.4f" % (name, accuracies[name], loss))
+
+        if accuracies["checkpoint"] - accuracies["exported model"] > args["max_accuracy_drop"]:
+            os.remove(args["output"])
+            raise SystemExit("The exported model loses more than %.4f of dev accuracy, %s removed." %
+                             (args["max_accuracy_drop"], args["output"]))
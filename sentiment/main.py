@@ -1,36 +1,140 @@
 import os
+import json
+import time
 import argparse
-import ast
 import torch
 import redis
-from transformers import DistilBertTokenizer
 
 from model import SentimentClassifier
+from tokenization import load_tokenizer, prepare_inputs, TokenIdsCache
+from result_cache import SentimentResultCache
+from batching import pad_sequences, length_batches
+from message_codec import codec
+from queue_transport import transport, lag_report
+
+# seconds between two reports of the lag of the input queue
+LAG_REPORT_EVERY = 30
 
 # error message written here to not repeat myself
 dict_field_error_message = "Received input is either not a dict or it is missing required fields, which are:" \
                            "_id, inputs. Inputs should be mapped to a dictionary mapping keys to strings"
 
 
-def prepare_input(tokenizer, max_length, sentence):
-    tokens = tokenizer.tokenize(sentence)
-    # data should being with [CLS], sentences should be separated (and end) with [SEP]
-    tokens = ["[CLS]"] + tokens
-    # truncate sequences that are too long
-    tokens = tokens[:max_length - 1] + ["[SEP]"]
-
-    # add padding it sequence is not long enough, so that sequences of different
-    # length can fit in the same tensor
-    tokens = tokens + ["[PAD]"] * (max_length - len(tokens))
+def load_model(args, device):
+    """
+    Load the model to serve, either a checkpoint saved by train.py or a TorchScript model saved by export.py.
+    Args:
+        args: Dictionary of arguments, with "checkpoint" or "scripted_model".
+        device: Device to load the model on.
 
-    # tokens to their id in BERT vocab
-    tokens_ids = tokenizer.convert_tokens_to_ids(tokens)
-    tokens_ids = torch.tensor(tokens_ids)
+    Returns: The model, in eval mode, and the arguments of the training it comes from.
 
-    # attention mask: 1 for non PAD tokens, 0 otherwise
-    attn_mask = (tokens_ids != 0).long()
+    """
+    if args["scripted_model"]:
+        # the training args are saved alongside the TorchScript code by export.py
+        extra_files = {"args.json": ""}
+        model = torch.jit.load(args["scripted_model"], map_location=device, _extra_files=extra_files)
+        model.eval()
+        return model, json.loads(extra_files["args.json"])
 
-    return tokens_ids, attn_mask
+    model = SentimentClassifier()
+    model.to(device)  # Enable gpu support for the model
+    checkpoint = torch.load(args["checkpoint"], map_location=device)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+    return model, checkpoint["args"]
+
+
+def validate_input(received_input):
+    """
+    Check that a decoded task has the fields needed to compute its sentiments.
+    Args:
+        received_input: Decoded task.
+
+    Raises:
+        AssertionError: if the task is not valid.
+    """
+    assert isinstance(received_input, dict), dict_field_error_message
+    assert "id" in received_input, dict_field_error_message
+    assert "inputs" in received_input, dict_field_error_message
+    assert isinstance(received_input["inputs"], dict), dict_field_error_message
+    assert all([isinstance(value, str) for value in received_input["inputs"].values()]), dict_field_error_message
+
+
+def collect_tasks(redis_connection, input_queue, batch_size, max_wait):
+    """
+    Wait for a task, then keep collecting tasks until there are batch_size of them or
+    max_wait seconds have passed since the first one arrived.
+    Args:
+        redis_connection: redis connection.
+        input_queue: Name of the input queue.
+        batch_size: Maximum number of tasks to collect.
+        max_wait: Maximum number of seconds to wait for more tasks after the first one.
+
+    Returns: List of (queue, message id, raw task) tuples, with at least one element.
+
+    """
+    tasks = transport.pop(redis_connection, [input_queue], batch_size)
+    deadline = time.time() + max_wait
+    while len(tasks) < batch_size and time.time() < deadline:
+        more_tasks = transport.pop_nowait(redis_connection, [input_queue], batch_size - len(tasks))
+        if more_tasks:
+            tasks += more_tasks
+        else:
+            time.sleep(min(0.005, max(deadline - time.time(), 0)))
+    return tasks
+
+
+def compute_sentiments(model, tokenizer, device, max_length, reviews_inputs, max_sequences=64,
+                       dynamic_padding=True, cache=None, result_cache=None):
+    """
+    Compute the sentiment of the fields of many reviews. Fields are sorted by token length and
+    split in forward passes of at most max_sequences sequences of similar length, each padded only
+    to its longest sequence. Fields whose sentiment is in the result cache are not computed again,
+    and the same text appearing more than once in the batch is computed once.
+    Args:
+        model: SentimentClassifier, in eval mode.
+        tokenizer: DistilBertTokenizerFast.
+        device: Device of the model.
+        max_length: Max length of sequences.
+        reviews_inputs: List of dictionaries (one per review) mapping field names to text.
+        max_sequences: Max number of sequences in a forward pass.
+        dynamic_padding: If False every sequence is padded to max_length, as done before
+            batches were padded dynamically, only useful for comparisons.
+        cache: Optional TokenIdsCache.
+        result_cache: Optional SentimentResultCache.
+
+    Returns: List of dictionaries (one per review) mapping field names to their sentiment.
+
+    """
+    names = [(review_index, input_name) for review_index, inputs in enumerate(reviews_inputs)
+             for input_name in inputs]
+    items = list(dict.fromkeys((input_name, reviews_inputs[review_index][input_name])
+                               for review_index, input_name in names))
+
+    cached = result_cache.get_many(items) if result_cache is not None else [None] * len(items)
+    results = {item: value for item, value in zip(items, cached) if value is not None}
+    missing = [item for item, value in zip(items, cached) if value is None]
+
+    sequences = prepare_inputs(tokenizer, max_length, [text for _, text in missing], cache)
+    output = [None] * len(sequences)
+    with torch.no_grad():
+        for batch in length_batches([len(sequence) for sequence in sequences], max_sequences):
+            tokens_ids, attn_masks = pad_sequences([sequences[i] for i in batch],
+                                                   None if dynamic_padding else max_length)
+            logits = model.forward(tokens_ids.to(device), attn_masks.to(device))
+            for i, value in zip(batch, torch.sigmoid(logits).squeeze(1).tolist()):
+                output[i] = value
+
+    results.update(zip(missing, output))
+    if result_cache is not None:
+        result_cache.put_many(missing, output)
+
+    # fan the results back out to their review
+    sentiments = [dict() for _ in reviews_inputs]
+    for review_index, input_name in names:
+        sentiments[review_index][input_name] = results[(input_name, reviews_inputs[review_index][input_name])]
+    return sentiments
 
 
 if __name__ == "__main__":
@@ -44,28 +148,41 @@ if __name__ == "__main__":
 
     # checkpoint to use (from models/)
     parser.add_argument('--checkpoint', type=str, required=False)
+    # TorchScript (quantized) model saved by export.py to use instead of a checkpoint, runs on cpu
+    parser.add_argument('--scripted_model', type=str, required=False)
     # max len of sequences
     parser.add_argument('--maxlen', type=int, required=False)
+    # max number of reviews whose sentiments are computed together
+    parser.add_argument('--batch_size', type=int, default=16)
+    # max seconds to wait for a batch to fill up after its first review arrived
+    parser.add_argument('--max_wait', type=float, default=0.05)
+    # max number of sequences (fields of reviews) in a forward pass, grouped by length
+    parser.add_argument('--max_sequences', type=int, default=64)
+    # max number of texts whose token ids are cached, 0 to disable the cache
+    parser.add_argument('--token_cache_size', type=int, default=50000)
+    # do not cache in redis the sentiments of texts
+    parser.add_argument('--no_result_cache', action='store_true')
+    # seconds after which a sentiment cached in redis expires, 0 for never
+    parser.add_argument('--result_cache_ttl', type=int, default=30 * 24 * 3600)
     args = parser.parse_args()
     args = args.__dict__
     print("Passed args:")
     print(args)
+    assert args["batch_size"] > 0, "The batch size should be a positive integer."
+    assert args["checkpoint"] or args["scripted_model"], "Either a checkpoint or a scripted model is required."
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # quantized models only run on cpu
+    device = torch.device('cuda' if torch.cuda.is_available() and not args["scripted_model"] else 'cpu')
     print("Found device: %s" % device)
 
     print("loading model...")
-    model = SentimentClassifier()
-    model.to(device)  # Enable gpu support for the model
-
-    checkpoint = torch.load(args["checkpoint"], map_location=device)
-    model.load_state_dict(checkpoint["model_state_dict"])
-    model.eval()
-    tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased")
+    model, model_args = load_model(args, device)
+    tokenizer = load_tokenizer()
+    token_cache = TokenIdsCache(args["token_cache_size"])
     print("model loaded")
 
     if not args["maxlen"]:
-        args["maxlen"] = checkpoint["args"]["maxlen"]
+        args["maxlen"] = model_args["maxlen"]
         print("using maxlen from import checkpoint, new args:")
         print(args)
 
@@ -73,56 +190,58 @@ if __name__ == "__main__":
     redis_connection = redis.Redis(host=os.environ["REDIS_HOST"], port=os.environ["REDIS_PORT"], charset="utf-8")
     print("connected to redis")
 
+    result_cache = None
+    if not args["no_result_cache"]:
+        # keys depend on the checkpoint, so that sentiments computed by another model are not used
+        result_cache = SentimentResultCache(redis_connection,
+                                            "sentiment_cache:%s:" % os.path.basename(args["scripted_model"] or
+                                                                                     args["checkpoint"]),
+                                            args["result_cache_ttl"] or None)
+
+    last_lag_report = 0
     print("starting work")
     while True:
-        print("waiting for task")
-        task = redis_connection.blpop(input_queue, 0)
-        print("obtained task")
-
-        try:
-            received_input = task[1].decode("utf-8")
-            received_input = ast.literal_eval(received_input)
-            assert isinstance(received_input, dict), dict_field_error_message
-            assert "id" in received_input, dict_field_error_message
-            assert "inputs" in received_input, dict_field_error_message
-            assert isinstance(received_input["inputs"], dict), dict_field_error_message
-            assert all(
-                [isinstance(value, str) for value in received_input["inputs"].values()]), dict_field_error_message
-
-            # prepare input data
-            inputs = received_input["inputs"]
-            inputs_names = inputs.keys()
-
-            sentences_masks = [prepare_input(tokenizer, args["maxlen"],
-                                             inputs[input_name]) for input_name in inputs_names]
-            sentences = torch.cat([sent.unsqueeze(0) for (sent, _) in sentences_masks])
-            sentences = sentences.to(device)
-            masks = torch.cat([mask.unsqueeze(0) for (_, mask) in sentences_masks])
-            masks = masks.to(device)
-
-            logits = model.forward(sentences, masks)
-            output = torch.sigmoid(logits)
-
-            output = output.squeeze(1)
-            output = output.tolist()
-
-            print("sentiment computed, pushing to queue")
-            del received_input["inputs"]
-            # make it into a list so that no newlines are added when converting to string
-            received_input["sentiments"] = {name: value for name, value in zip(inputs_names, output)}
-            print(received_input)
-            redis_connection.lpush(output_queue, str(received_input))
-
-        except AssertionError as e:
-            print(str(e))
-        except (SyntaxError, ValueError):
-            print("Data from sentiment analysis input not a valid python dict, discarding input:\n%s" % received_input)
-        except Exception as e:
-            print("Unexpected exception occurred:")
-            print(str(e))
-            print("Pushing None to queue")
-
-            del received_input["inputs"]
-            received_input["sentiments"] = str(None)
-            print(received_input)
-            redis_connection.lpush(output_queue, str(received_input))
+        print("waiting for tasks")
+        tasks = collect_tasks(redis_connection, input_queue, args["batch_size"], args["max_wait"])
+        print("obtained %d tasks" % len(tasks))
+
+        received_inputs = []
+        for task in tasks:
+            try:
+                received_input = codec.decode(task[2])
+                validate_input(received_input)
+                received_inputs.append(received_input)
+            except AssertionError as e:
+                print(str(e))
+            except ValueError:
+                print("Data from sentiment analysis input not a valid message, discarding input:\n%s" % task[2])
+
+        if received_inputs:
+            start = time.time()
+            try:
+                sentiments = compute_sentiments(model, tokenizer, device, args["maxlen"],
+                                                [received_input["inputs"] for received_input in received_inputs],
+                                                args["max_sequences"], cache=token_cache,
+                                                result_cache=result_cache)
+                print("sentiments of %d reviews computed in %.3fs, pushing to queue" %
+                      (len(received_inputs), time.time() - start))
+            except Exception as e:
+                print("Unexpected exception occurred:")
+                print(str(e))
+                print("Pushing None to queue")
+                sentiments = [None] * len(received_inputs)
+
+            redis_pipe = redis_connection.pipeline(transaction=False)
+            for received_input, review_sentiments in zip(received_inputs, sentiments):
+                del received_input["inputs"]
+                received_input["sentiments"] = review_sentiments
+                transport.push(redis_pipe, output_queue, codec.encode(received_input))
+            redis_pipe.execute()
+
+        transport.ack(redis_connection, tasks)
+        if time.time() - last_lag_report > LAG_REPORT_EVERY:
+            last_lag_report = time.time()
+            print("queues: %s" % lag_report(redis_connection, [input_queue]))
+            print(token_cache.stats())
+            if result_cache is not None:
+                print(result_cache.stats())
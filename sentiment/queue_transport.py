@@ -0,0 +1,425 @@
+"""
+Transport for the queues exchanged through redis by crawlers, broker, workers and client.
+The same module is copied in each service.
+
+Two transports are available, chosen with the QUEUE_TRANSPORT environment variable:
+ - "list" (default): redis lists, pushed with LPUSH and popped with a lua script/BLPOP. A task
+    is gone as soon as it is popped, if the process handling it crashes the task is lost.
+ - "stream": redis streams with consumer groups, pushed with XADD and read with XREADGROUP. A task
+    stays pending until it is acknowledged (XACK) after being handled, tasks left pending for
+    too long by a consumer (e.g. a crashed replica) are claimed by the other consumers of the group.
+    Replicas of a service share a group, named STREAM_GROUP or after the hostname (the service
+    name in docker compose), each task is delivered to only one of them.
+    STREAM_CLAIM_IDLE_MS and STREAM_MAXLEN tune the claiming of pending tasks and the trimming of streams.
+Messages are opaque to the transport, see the message codec for their format.
+Every popped task is a (queue, message id, raw message) tuple, message ids are None for lists.
+"""
+
+import os
+import socket
+import time
+import uuid
+
+# pops up to ARGV[1] items from the given lists, in the order in which the lists are given,
+# returning a flat list of queue, item, queue, item, ...
+# being a script it is executed atomically and costs a single round trip
+pop_batch_script = """
+local remaining = tonumber(ARGV[1])
+local result = {}
+for _, queue in ipairs(KEYS) do
+    if remaining <= 0 then
+        break
+    end
+    local items = redis.call('LRANGE', queue, 0, remaining - 1)
+    if #items > 0 then
+        redis.call('LTRIM', queue, #items, -1)
+        for _, item in ipairs(items) do
+            table.insert(result, queue)
+            table.insert(result, item)
+        end
+        remaining = remaining - #items
+    end
+end
+return result
+"""
+
+TRANSPORTS = ["list", "stream"]
+
+# field of a stream entry holding the message
+STREAM_FIELD = b"m"
+
+# pending entries of a stream listed at once, and at most, when looking for tasks to claim
+PENDING_PAGE = 100
+MAX_PENDING_SCANNED = 1000
+
+
+def next_stream_id(message_id):
+    """
+    Returns: The smallest stream entry id greater than the given one.
+    """
+    message_id = message_id.decode("utf-8") if isinstance(message_id, bytes) else message_id
+    milliseconds, sequence = message_id.split("-")
+    return "%s-%d" % (milliseconds, int(sequence) + 1)
+
+
+class ListTransport(object):
+    """
+    Queues as redis lists.
+    """
+    name = "list"
+
+    def __init__(self):
+        self.pop_scripts = dict()
+
+    def push(self, redis_c, queue, message):
+        """
+        Push a message to a queue.
+        Args:
+            redis_c: redis connection or pipeline.
+            queue: Name of the queue.
+            message: Encoded message.
+        """
+        redis_c.lpush(queue, message)
+
+    def pop_nowait(self, redis_c, queues, count):
+        """
+        Pop up to count tasks without blocking, earlier queues have priority.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks.
+
+        Returns: List of (queue, None, raw message) tuples, possibly empty.
+
+        """
+        if count <= 0:
+            return []
+        if id(redis_c) not in self.pop_scripts:
+            self.pop_scripts[id(redis_c)] = redis_c.register_script(pop_batch_script)
+        result = self.pop_scripts[id(redis_c)](keys=queues, args=[count])
+        return [(result[i].decode("utf-8"), None, result[i + 1]) for i in range(0, len(result), 2)]
+
+    def pop(self, redis_c, queues, count=1):
+        """
+        Pop up to count tasks, blocking until at least one is available, earlier queues have priority.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks.
+
+        Returns: List of (queue, None, raw message) tuples, with at least one element.
+
+        """
+        tasks = self.pop_nowait(redis_c, queues, count)
+        if tasks:
+            return tasks
+
+        # nothing to do, wait for a task and then take anything that arrived with it
+        task = redis_c.blpop(queues, 0)
+        tasks = [(task[0].decode("utf-8"), None, task[1])]
+        return tasks + self.pop_nowait(redis_c, queues, count - 1)
+
+    def ack(self, redis_c, tasks):
+        """
+        Acknowledge handled tasks, nothing to do for lists.
+        Args:
+            redis_c: redis connection.
+            tasks: List of (queue, message id, ...) tuples.
+        """
+        pass
+
+    def lag(self, redis_c, queue):
+        """
+        Args:
+            redis_c: redis connection.
+            queue: Name of the queue.
+
+        Returns: Dictionary with the number of tasks waiting in the queue.
+
+        """
+        return {"queue": queue, "length": redis_c.llen(queue)}
+
+
+class StreamTransport(object):
+    """
+    Queues as redis streams read through a consumer group.
+    """
+    name = "stream"
+
+    def __init__(self, group, consumer=None, claim_idle_ms=60000, max_deliveries=5, block_ms=5000, maxlen=None):
+        """
+        Args:
+            group: Name of the consumer group, shared by the replicas of a service.
+            consumer: Name of this consumer, unique in the group, defaults to the hostname and a random suffix.
+            claim_idle_ms: Tasks pending for longer than this are claimed from other consumers.
+            max_deliveries: Tasks delivered more than this many times are acknowledged and discarded.
+            block_ms: Max time a read blocks before looking again for tasks to claim.
+            maxlen: Approximate max length of streams, older entries are trimmed when pushing.
+        """
+        self.group = group
+        self.consumer = consumer or "%s-%s" % (socket.gethostname(), uuid.uuid4().hex[:8])
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.block_ms = block_ms
+        self.maxlen = maxlen
+        self.groups_created = set()
+        self.last_claim = 0
+        # tasks read beyond the count asked for, returned by the next pops
+        self.buffered = []
+
+    def push(self, redis_c, queue, message):
+        """
+        Push a message to a queue.
+        Args:
+            redis_c: redis connection or pipeline.
+            queue: Name of the queue.
+            message: Encoded message.
+        """
+        if self.maxlen:
+            redis_c.xadd(queue, {STREAM_FIELD: message}, maxlen=self.maxlen, approximate=True)
+        else:
+            redis_c.xadd(queue, {STREAM_FIELD: message})
+
+    def create_groups(self, redis_c, queues):
+        """
+        Create the consumer group (and the stream) for queues that do not have it yet.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+        """
+        for queue in queues:
+            if queue in self.groups_created:
+                continue
+            try:
+                redis_c.xgroup_create(queue, self.group, id="0", mkstream=True)
+            except Exception as e:
+                # the group already exists
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self.groups_created.add(queue)
+
+    def pending_of_others(self, redis_c, queue, count):
+        """
+        Find tasks left pending for too long by other consumers of the group, the ones pending for this
+        consumer are still being handled (or buffered) by it.
+        Args:
+            redis_c: redis connection.
+            queue: Name of the queue.
+            count: Maximum number of tasks.
+
+        Returns: List of pending entries, as returned by xpending_range.
+
+        """
+        consumers = (self.consumer, self.consumer.encode("utf-8"))
+        found = []
+        start = "-"
+        scanned = 0
+        while len(found) < count and scanned < MAX_PENDING_SCANNED:
+            page = redis_c.xpending_range(queue, self.group, start, "+", PENDING_PAGE)
+            scanned += len(page)
+            found.extend(item for item in page
+                         if item["consumer"] not in consumers and item["time_since_delivered"] >= self.claim_idle_ms)
+            if len(page) < PENDING_PAGE:
+                break
+            start = next_stream_id(page[-1]["message_id"])
+        return found[:count]
+
+    def claim(self, redis_c, queues, count):
+        """
+        Claim tasks left pending for too long by other consumers of the group.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks.
+
+        Returns: List of (queue, message id, raw message) tuples.
+
+        """
+        tasks = []
+        for queue in queues:
+            if len(tasks) >= count:
+                break
+            pending = self.pending_of_others(redis_c, queue, count - len(tasks))
+            if not pending:
+                continue
+
+            # poison tasks would otherwise be claimed forever
+            discarded = [item["message_id"] for item in pending if item["times_delivered"] >= self.max_deliveries]
+            if discarded:
+                print("Discarding %d tasks of %s delivered too many times" % (len(discarded), queue))
+                redis_c.xack(queue, self.group, *discarded)
+
+            message_ids = [item["message_id"] for item in pending if item["message_id"] not in discarded]
+            if message_ids:
+                claimed = redis_c.xclaim(queue, self.group, self.consumer, self.claim_idle_ms, message_ids)
+                tasks.extend((queue, message_id, fields[STREAM_FIELD])
+                             for message_id, fields in claimed if fields and STREAM_FIELD in fields)
+        return tasks
+
+    def read_streams(self, redis_c, queues, count, block_ms):
+        """
+        Read new tasks for the group with a single XREADGROUP.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks for each queue.
+            block_ms: Max time to wait for tasks, None to not wait.
+
+        Returns: List of (queue, message id, raw message) tuples.
+
+        """
+        result = redis_c.xreadgroup(self.group, self.consumer, {queue: ">" for queue in queues},
+                                    count=count, block=block_ms)
+        tasks = []
+        for queue, entries in result or []:
+            queue = queue.decode("utf-8") if isinstance(queue, bytes) else queue
+            tasks.extend((queue, message_id, fields[STREAM_FIELD]) for message_id, fields in entries)
+        return tasks
+
+    def read(self, redis_c, queues, count, block_ms):
+        """
+        Read up to count new tasks for the group, earlier queues have priority.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks.
+            block_ms: Max time to wait for tasks, None to not wait.
+
+        Returns: List of (queue, message id, raw message) tuples.
+
+        """
+        if block_ms is None:
+            # a queue at a time, so that later queues are read only if the earlier ones do not fill the count
+            tasks = []
+            for queue in queues:
+                if len(tasks) >= count:
+                    break
+                tasks += self.read_streams(redis_c, [queue], count - len(tasks), None)
+            return tasks
+
+        # a blocking read returns up to count tasks of each queue, the ones beyond count (already delivered to
+        # this consumer) are returned by the next pops
+        tasks = self.read_streams(redis_c, queues, count, block_ms)
+        self.buffered.extend(tasks[count:])
+        return tasks[:count]
+
+    def take_buffered(self, queues, count):
+        """
+        Returns: Up to count of the tasks of the given queues read beyond the count of an earlier pop.
+        """
+        tasks = [task for task in self.buffered if task[0] in queues][:count]
+        self.buffered = [task for task in self.buffered if task not in tasks]
+        return tasks
+
+    def pop_nowait(self, redis_c, queues, count):
+        """
+        Get up to count tasks without blocking, see pop.
+        """
+        self.create_groups(redis_c, queues)
+        tasks = self.take_buffered(queues, count)
+        if len(tasks) < count and time.time() - self.last_claim >= self.claim_idle_ms / 1000.:
+            self.last_claim = time.time()
+            tasks += self.claim(redis_c, queues, count - len(tasks))
+        if len(tasks) < count:
+            tasks += self.read(redis_c, queues, count - len(tasks), None)
+        return tasks
+
+    def pop(self, redis_c, queues, count=1):
+        """
+        Get up to count tasks, blocking until at least one is available, earlier queues have priority.
+        Tasks claimed from other consumers come first. Tasks must be acknowledged with ack once handled.
+        Args:
+            redis_c: redis connection.
+            queues: List of names of queues.
+            count: Maximum number of tasks.
+
+        Returns: List of (queue, message id, raw message) tuples, with at least one element.
+
+        """
+        while True:
+            tasks = self.pop_nowait(redis_c, queues, count)
+            if tasks:
+                return tasks
+            tasks = self.read(redis_c, queues, count, self.block_ms)
+            if tasks:
+                return tasks
+
+    def ack(self, redis_c, tasks):
+        """
+        Acknowledge handled tasks, so that they are not delivered again.
+        Args:
+            redis_c: redis connection.
+            tasks: List of (queue, message id, ...) tuples.
+        """
+        by_queue = dict()
+        for task in tasks:
+            if task[1] is not None:
+                by_queue.setdefault(task[0], []).append(task[1])
+        if not by_queue:
+            return
+        pipe = redis_c.pipeline(transaction=False)
+        for queue, message_ids in by_queue.items():
+            pipe.xack(queue, self.group, *message_ids)
+        pipe.execute()
+
+    def lag(self, redis_c, queue):
+        """
+        Args:
+            redis_c: redis connection.
+            queue: Name of the queue.
+
+        Returns: Dictionary with the length of the stream, the tasks pending (delivered but not
+            acknowledged) for the group, and the lag of the group (tasks not delivered yet).
+
+        """
+        self.create_groups(redis_c, [queue])
+        info = [group for group in redis_c.xinfo_groups(queue)
+                if group["name"] in (self.group, self.group.encode("utf-8"))][0]
+        length = redis_c.xlen(queue)
+        lag = info.get("lag", None)
+        if lag is None:
+            # redis < 7 does not report it, count (up to 10000) entries after the last delivered one
+            last_delivered = info["last-delivered-id"]
+            if last_delivered in (b"0-0", "0-0"):
+                lag = length
+            else:
+                lag = max(len(redis_c.xrange(queue, min=last_delivered, max="+", count=10001)) - 1, 0)
+        return {"queue": queue, "group": self.group, "length": length,
+                "pending": info["pending"], "lag": lag}
+
+
+def get_transport():
+    """
+    Get the transport configured through the QUEUE_TRANSPORT environment variable.
+
+    Returns: A ListTransport or a StreamTransport.
+
+    """
+    name = os.environ.get("QUEUE_TRANSPORT", "list")
+    assert name in TRANSPORTS, "Unknown queue transport %s, should be one of %s" % (name, TRANSPORTS)
+    if name == "list":
+        return ListTransport()
+    maxlen = int(os.environ["STREAM_MAXLEN"]) if os.environ.get("STREAM_MAXLEN", None) else None
+    # should be longer than the time needed to handle a task (e.g. a crawl)
+    claim_idle_ms = int(os.environ.get("STREAM_CLAIM_IDLE_MS", 60000))
+    return StreamTransport(os.environ.get("STREAM_GROUP", socket.gethostname()), claim_idle_ms=claim_idle_ms,
+                           maxlen=maxlen)
+
+
+# transport configured for this process
+transport = get_transport()
+
+
+def lag_report(redis_c, queues):
+    """
+    Describe how many tasks are waiting in some queues (and, for streams, how many are pending for
+    the group of this service).
+    Args:
+        redis_c: redis connection.
+        queues: List of names of queues.
+
+    Returns: A string to be printed.
+
+    """
+    return "; ".join(" ".join("%s=%s" % (key, value) for key, value in transport.lag(redis_c, queue).items())
+                     for queue in queues)
@@ -0,0 +1,67 @@
+"""
+For caching in redis the sentiment computed for a text, keyed by the hash of the name of the
+field and of the text, so that texts that were already scored (e.g. a review crawled again
+with the same pros and cons) are never fed to the model again.
+"""
+
+import hashlib
+
+
+class SentimentResultCache(object):
+    """
+    Cache of sentiments in redis, counting hits and misses.
+    """
+
+    def __init__(self, redis_c, prefix, ttl=None):
+        """
+        Args:
+            redis_c: redis connection.
+            prefix: Prefix of the keys, it should change when the model changes.
+            ttl: Seconds after which a cached sentiment expires, never if None.
+        """
+        self.redis_c = redis_c
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, text):
+        return self.prefix + hashlib.sha1(("%s\x00%s" % (name, text)).encode("utf-8")).hexdigest()
+
+    def get_many(self, items):
+        """
+        Args:
+            items: List of (field name, text) tuples.
+
+        Returns: List with the cached sentiment of each item, None for items that are not cached.
+
+        """
+        if not items:
+            return []
+        values = self.redis_c.mget([self.key(name, text) for name, text in items])
+        values = [float(value) if value is not None else None for value in values]
+        hits = sum(value is not None for value in values)
+        self.hits += hits
+        self.misses += len(values) - hits
+        return values
+
+    def put_many(self, items, values):
+        """
+        Args:
+            items: List of (field name, text) tuples.
+            values: List with the sentiment of each item.
+        """
+        if not items:
+            return
+        redis_pipe = self.redis_c.pipeline(transaction=False)
+        for (name, text), value in zip(items, values):
+            redis_pipe.set(self.key(name, text), repr(value), ex=self.ttl)
+        redis_pipe.execute()
+
+    def stats(self):
+        """
+        Returns: A string describing the use of the cache, to be printed.
+        """
+        lookups = self.hits + self.misses
+        return "result cache: hit rate %.1f%% (%d hits, %d misses)" % (
+            100. * self.hits / lookups if lookups else 0, self.hits, self.misses)
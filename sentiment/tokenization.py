@@ -0,0 +1,99 @@
+"""
+For turning text into the token ids fed to the model, with the rust backed fast tokenizer
+and a LRU cache of the token ids of the texts seen most recently (job titles such as
+"Software Engineer" or "Anonymous Employee" come up over and over again).
+"""
+
+import collections
+import torch
+from transformers import DistilBertTokenizerFast
+
+
+def load_tokenizer():
+    return DistilBertTokenizerFast.from_pretrained("distilbert-base-uncased")
+
+
+def normalize_text(text):
+    # the tokenizer is uncased and splits on whitespace, this does not change the resulting tokens
+    return " ".join(text.lower().split())
+
+
+class TokenIdsCache(object):
+    """
+    LRU cache mapping normalized texts to their token ids, counting hits and misses.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size: Max number of texts in the cache, 0 to disable it.
+        """
+        assert size >= 0, "The size of the cache should be a non negative integer."
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Args:
+            key: Normalized text.
+
+        Returns: Its token ids, or None if they are not in the cache.
+
+        """
+        tokens_ids = self.items.get(key, None)
+        if tokens_ids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return tokens_ids
+
+    def put(self, key, tokens_ids):
+        if self.size == 0:
+            return
+        self.items[key] = tokens_ids
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns: A string describing the use of the cache, to be printed.
+        """
+        lookups = self.hits + self.misses
+        return "token cache: %d/%d texts, hit rate %.1f%% (%d hits, %d misses)" % (
+            len(self.items), self.size, 100. * self.hits / lookups if lookups else 0, self.hits, self.misses)
+
+
+def prepare_inputs(tokenizer, max_length, sentences, cache=None):
+    """
+    Turn sentences into token ids, [CLS] sentence [SEP], truncated to max_length.
+    Sentences that are not in the cache are encoded together in a single batch.
+    Args:
+        tokenizer: DistilBertTokenizerFast.
+        max_length: Max length of sequences.
+        sentences: List of strings.
+        cache: Optional TokenIdsCache, it should be used with a single max_length.
+
+    Returns: List of 1-d tensors of token ids, not padded (see batching.py).
+
+    """
+    keys = [normalize_text(sentence) for sentence in sentences]
+    tokens_ids = [cache.get(key) if cache is not None else None for key in keys]
+
+    missing = [i for i, ids in enumerate(tokens_ids) if ids is None]
+    if missing:
+        # a text repeated in the batch is encoded once
+        missing_keys = list(collections.OrderedDict.fromkeys(keys[i] for i in missing))
+        encoded = tokenizer.batch_encode_plus(missing_keys, add_special_tokens=True, max_length=max_length,
+                                              return_token_type_ids=False, return_attention_masks=False)
+        encoded = {key: torch.tensor(ids) for key, ids in zip(missing_keys, encoded["input_ids"])}
+        for i in missing:
+            tokens_ids[i] = encoded[keys[i]]
+        if cache is not None:
+            for key, ids in encoded.items():
+                cache.put(key, ids)
+
+    return tokens_ids
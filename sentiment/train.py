@@ -7,6 +7,7 @@ import argparse
 
 from model import SentimentClassifier
 from SSTDataset import SSTDataset
+from batching import collate, BucketBatchSampler
 
 
 def get_accuracy_from_logits(logits, labels):
@@ -16,15 +17,21 @@ def get_accuracy_from_logits(logits, labels):
     return acc
 
 
+def get_device(args):
+    # the gpu given in args, unless another device (e.g. cpu) is given explicitly
+    return args["device"] if args.get("device", None) else torch.device("cuda", args["gpu"])
+
+
 def evaluate(model, criterion, dataloader, args):
     model.eval()
 
     mean_acc, mean_loss = 0, 0
     count = 0
+    device = get_device(args)
 
     with torch.no_grad():
         for seq, attn_masks, labels in dataloader:
-            seq, attn_masks, labels = seq.cuda(args["gpu"]), attn_masks.cuda(args["gpu"]), labels.cuda(args["gpu"])
+            seq, attn_masks, labels = seq.to(device), attn_masks.to(device), labels.to(device)
             logits = model(seq, attn_masks)
             mean_loss += criterion(logits.squeeze(-1), labels.float()).item()
             mean_acc += get_accuracy_from_logits(logits, labels)
@@ -132,10 +139,13 @@ if __name__ == "__main__":
     dataset_train = SSTDataset(filename='data/SST-2/train.tsv', maxlen=args["maxlen"])
     dataset_validation = SSTDataset(filename='data/SST-2/dev.tsv', maxlen=args["maxlen"])
 
-    train_loader = DataLoader(dataset_train, batch_size=args["batch_size"], num_workers=5,
-                              shuffle=True, drop_last=True)
-    val_loader = DataLoader(dataset_validation, batch_size=args["batch_size"], num_workers=5,
-                            shuffle=True, drop_last=True)
+    # batches of sentences of similar length, padded to their longest sentence
+    train_loader = DataLoader(dataset_train, num_workers=5, collate_fn=collate,
+                              batch_sampler=BucketBatchSampler(dataset_train.lengths, args["batch_size"],
+                                                               shuffle=True, drop_last=True))
+    val_loader = DataLoader(dataset_validation, num_workers=5, collate_fn=collate,
+                            batch_sampler=BucketBatchSampler(dataset_validation.lengths, args["batch_size"],
+                                                             shuffle=True, drop_last=True))
 
     starting_epoch = 0
     if checkpoint: